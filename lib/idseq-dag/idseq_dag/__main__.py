@@ -29,6 +29,10 @@ def main():
     parser.add_argument('--no-lazy-run', dest='lazy_run', action='store_false')
     parser.add_argument('--key-path-s3', dest='key_path_s3', help='ssh key')
     parser.add_argument('--no-versioned-output', dest='versioned_output', action='store_false')
+    parser.add_argument('--step-costs-json', dest='step_costs_json',
+                        help='historical step durations in seconds keyed by step output target, to run the critical path first')
+    parser.add_argument('--step-cache-dir', dest='step_cache_dir',
+                        help='local directory caching step results by their inputs, to skip rerunning unchanged steps')
 
     parser.set_defaults(lazy_run=True)
     parser.set_defaults(versioned_output=True)
@@ -38,7 +42,9 @@ def main():
     try:
         flow = PipelineFlow(lazy_run=args.lazy_run,
                             dag_json=args.dag_json,
-                            versioned_output=args.versioned_output)
+                            versioned_output=args.versioned_output,
+                            step_costs_json=args.step_costs_json,
+                            step_cache_dir=args.step_cache_dir)
         log.write("everything is awesome. idseq dag is valid~")
     except:
         parser.print_help()
@@ -112,5 +118,20 @@ def run_step():
         exit(json.dumps(dict(wdl_error_message=True, error=type(e).__name__, cause=str(e), step_description_md=step_instance.step_description())))
 
 
+def chrome_trace():
+    import idseq_dag.util.log as log
+
+    parser = argparse.ArgumentParser(
+        description="Convert idseq_dag JSON logs to a Chrome trace, to view in chrome://tracing or ui.perfetto.dev")
+    parser.add_argument('log_files', nargs='*', help='JSON log files (default: stdin)')
+    parser.add_argument('-o', '--output', help='trace file to write (default: stdout)')
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        inputs = [stack.enter_context(open(f)) for f in args.log_files] or [sys.stdin]
+        output_file = stack.enter_context(open(args.output, "w")) if args.output else sys.stdout
+        log.write_chrome_trace((line for f in inputs for line in f), output_file)
+
+
 if __name__ == "__main__":
     main()
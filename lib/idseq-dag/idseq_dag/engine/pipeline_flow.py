@@ -1,3 +1,4 @@
+import heapq
 import importlib
 import json
 import os
@@ -5,6 +6,9 @@ import time
 import threading
 import traceback
 import datetime
+import statistics
+from collections import defaultdict
+
 import pytz
 
 import idseq_dag
@@ -13,7 +17,8 @@ import idseq_dag.util.command as command
 import idseq_dag.util.log as log
 import idseq_dag.util.count as count
 from idseq_dag.util.trace_lock import TraceLock
-from idseq_dag.engine.pipeline_step import PipelineStep, InvalidInputFileError
+from idseq_dag.engine.pipeline_step import CompletionRegistry, PipelineStep, ResourceBudget, InvalidInputFileError
+from idseq_dag.engine.step_cache import StepResultCache
 
 DEFAULT_OUTPUT_DIR_LOCAL = '/mnt/idseq/results/%d' % os.getpid()
 DEFAULT_REF_DIR_LOCAL = '/mnt/idseq/ref'
@@ -21,12 +26,15 @@ PURGE_SENTINEL_DIR = DEFAULT_REF_DIR_LOCAL + "/purge_sentinel"
 PURGE_SENTINEL = PURGE_SENTINEL_DIR + "/purge_nothing_newer_than_me"
 
 class PipelineFlow(object):
-    def __init__(self, lazy_run, dag_json, versioned_output):
+    def __init__(self, lazy_run, dag_json, versioned_output, step_costs_json=None, step_cache_dir=None):
         '''
             See examples/example_dag.json and
                 idseq_dag.main.validate_dag_json for more details.
+            step_costs_json optionally gives historical step durations used to plan the critical path first.
+            step_cache_dir optionally enables a local cache of step results keyed by their inputs.
         '''
         self.lazy_run = lazy_run
+        self.step_costs = PipelineFlow.load_step_costs(step_costs_json)
         dag = PipelineFlow.parse_and_validate_conf(dag_json)
         self.targets = dag["targets"]
         self.steps = dag["steps"]
@@ -43,6 +51,11 @@ class PipelineFlow(object):
         idseq_dag.util.s3.config["PURGE_SENTINEL"] = PURGE_SENTINEL
         # idseq_dag.util.s3.config["REF_FETCH_LOG_DIR"] = os.path.join(self.ref_dir_local, "fetch_log")
         self.large_file_list = []
+        # Lets steps start as soon as their inputs are written or downloaded
+        self.completion_registry = CompletionRegistry()
+        # Keeps steps from running at the same time when they wouldn't fit on this machine together
+        self.resource_budget = ResourceBudget.for_this_machine()
+        self.step_cache = StepResultCache(step_cache_dir) if step_cache_dir else None
 
         command.make_dirs(self.output_dir_local)
         command.make_dirs(self.ref_dir_local)
@@ -117,6 +130,8 @@ class PipelineFlow(object):
             Traverse through the targets and steps and calculate
             1. the large file download priority based on the how deep the step is
             2. if a step needs to be run based on the existence of output file and lazy run parameter
+            Steps are visited in topological order, most expensive remaining chain of steps first,
+            so step threads start and large files download along the critical path first.
         '''
         covered_targets = {}
         large_file_download_list = []
@@ -124,43 +139,43 @@ class PipelineFlow(object):
         for target_name in self.given_targets.keys():
             covered_targets[target_name] = {'depth': 0,
                                             'lazy_run': self.lazy_run, 's3_downloadable': True}
-        steps_complete = set()
-        while len(steps_complete) < len(self.steps):
-            # run until all the steps can be run
-            current_targets = {}
-            for step in self.steps:
-                if step["out"] not in steps_complete:
-                    step_can_be_run = True
-                    depth_max = 0
-                    lazy_run = True
-                    for target in step["in"]:
-                        if target not in covered_targets:
-                            step_can_be_run = False
-                            break
-                        else:
-                            depth_max = max(covered_targets[target]['depth'], depth_max)
-                            if covered_targets[target]['lazy_run'] == False:
-                                lazy_run = False
-                    if step_can_be_run:  # All the input is satisfied
-                        steps_complete.add(step["out"])
-                        file_list = self.targets[step["out"]]
-                        if lazy_run and idseq_dag.util.s3.check_s3_presence_for_file_list(self.output_dir_s3, file_list):
-                            # output can be lazily generated. touch the output
-                            # idseq_dag.util.s3.touch_s3_file_list(self.output_dir_s3, file_list)
-                            s3_downloadable = True
-                        else:
-                            # steps need to be run
-                            lazy_run = False
-                            s3_downloadable = False
-                            step_list.append(step)
-                            # The following can be changed to append if we want to get the round information
-                            large_file_download_list += step["additional_files"].values()
-                        # update targets available for the next round
-                        current_targets[step["out"]] = {
-                            'depth': (depth_max + 1), 'lazy_run': lazy_run, 's3_downloadable': s3_downloadable}
-            covered_targets.update(current_targets)
+        given_targets = set(self.given_targets.keys())
+        dag_order = _topological_order(self.steps, given_targets, priority=lambda i: i)
+        critical_path = _critical_path_costs(dag_order, self.step_costs)
+        for step in _topological_order(self.steps, given_targets,
+                                       priority=lambda i: (-critical_path[self.steps[i]["out"]], i)):
+            depth_max = 0
+            lazy_run = True
+            for target in step["in"]:
+                depth_max = max(covered_targets[target]['depth'], depth_max)
+                if covered_targets[target]['lazy_run'] == False:
+                    lazy_run = False
+            file_list = self.targets[step["out"]]
+            if lazy_run and idseq_dag.util.s3.check_s3_presence_for_file_list(self.output_dir_s3, file_list):
+                # output can be lazily generated. touch the output
+                # idseq_dag.util.s3.touch_s3_file_list(self.output_dir_s3, file_list)
+                s3_downloadable = True
+            else:
+                # steps need to be run
+                lazy_run = False
+                s3_downloadable = False
+                step_list.append(step)
+                # The following can be changed to append if we want to get the round information
+                large_file_download_list += step["additional_files"].values()
+            covered_targets[step["out"]] = {
+                'depth': (depth_max + 1), 'lazy_run': lazy_run, 's3_downloadable': s3_downloadable}
         return (step_list, large_file_download_list, covered_targets)
 
+    @staticmethod
+    def load_step_costs(step_costs_json):
+        ''' Historical step durations in seconds, keyed by step output target, e.g. {"host_filter_out": 3600} '''
+        if not step_costs_json:
+            return {}
+        with open(step_costs_json) as f:
+            step_costs = json.load(f)
+        log.log_event("pipeline_flow.step_costs_loaded", values={"file": step_costs_json, "contents": step_costs})
+        return step_costs
+
     @staticmethod
     def fetch_input_files_from_s3(input_files, input_dir_s3, result_dir_local):
         for f in input_files:
@@ -208,6 +223,7 @@ class PipelineFlow(object):
             PipelineFlow.fetch_input_files_from_s3(input_files=self.targets[target],
                                                    input_dir_s3=input_path_s3,
                                                    result_dir_local=self.output_dir_local)
+        self.completion_registry.mark_done(os.path.join(self.output_dir_local, f) for f in self.targets[target])
 
         if target in self.given_targets and self.given_targets[target].get("count_reads"):
             with log.log_context("count_input_reads", {"target": target}):
@@ -283,7 +299,10 @@ class PipelineFlow(object):
             step_inputs = [self.targets[itarget] for itarget in step["in"]]
             step_instance = StepClass(step["out"], step_inputs, step_output,
                                       self.output_dir_local, self.output_dir_s3, self.ref_dir_local,
-                                      step["additional_files"], step["additional_attributes"])
+                                      step["additional_files"], step["additional_attributes"],
+                                      completion_registry=self.completion_registry,
+                                      resource_budget=self.resource_budget,
+                                      step_cache=self.step_cache)
             step_instance.start()
             step_instances.append(step_instance)
         # Collecting stats files
@@ -303,6 +322,52 @@ class PipelineFlow(object):
         log.write("all steps are done")
 
 
+def _topological_order(steps, available_targets, priority):
+    '''
+    Kahn's algorithm: order steps so that every step comes after the steps generating its inputs.
+    Among the steps whose inputs are all available, the one with the lowest priority(index)
+    comes first.
+    '''
+    consumers = defaultdict(list)
+    missing_inputs = []
+    for i, step in enumerate(steps):
+        missing = set(step["in"]) - available_targets
+        missing_inputs.append(len(missing))
+        for target in missing:
+            consumers[target].append(i)
+    ready = [(priority(i), i) for i, num_missing in enumerate(missing_inputs) if num_missing == 0]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        _, i = heapq.heappop(ready)
+        order.append(steps[i])
+        for j in consumers[steps[i]["out"]]:
+            missing_inputs[j] -= 1
+            if missing_inputs[j] == 0:
+                heapq.heappush(ready, (priority(j), j))
+    if len(order) < len(steps):
+        blocked = [step["out"] for i, step in enumerate(steps) if missing_inputs[i]]
+        raise ValueError("steps %s depend on each other and can't be run" % blocked)
+    return order
+
+
+def _critical_path_costs(dag_order, step_costs):
+    '''
+    For each step output, the estimated cost of the most expensive chain of steps starting
+    with that step. Steps without a historical cost are assumed to take the median one.
+    '''
+    default_cost = statistics.median(step_costs.values()) if step_costs else 1
+    consumers = defaultdict(list)
+    for step in dag_order:
+        for target in set(step["in"]):
+            consumers[target].append(step["out"])
+    critical_path = {}
+    for step in reversed(dag_order):
+        downstream = max((critical_path[out] for out in consumers[step["out"]]), default=0)
+        critical_path[step["out"]] = step_costs.get(step["out"], default_cost) + downstream
+    return critical_path
+
+
 def _get_name_from_path(dag_json: str) -> str:
     """
     Returns a useful stage name from a dag_json file page for when the dag_json
@@ -2,9 +2,9 @@ import datetime
 import json
 import os
 import threading
-import time
 import traceback
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, IntEnum
 
 import pytz
@@ -14,7 +14,7 @@ import idseq_dag.util.log as log
 import idseq_dag.util.s3
 import idseq_dag.util.count as count
 
-from idseq_dag.util.count import load_duplicate_cluster_sizes
+from idseq_dag.util.count import shared_duplicate_cluster_sizes
 from idseq_dag.exceptions import InvalidInputFileError, InvalidOutputFileError
 
 
@@ -26,12 +26,97 @@ class StepStatus(IntEnum):
     INVALID_INPUT = 4  # an error occurred when validating the input file
 
 
+# How often steps check for .done files written by other processes, in seconds
+INPUT_FILES_POLL_INTERVAL = 5
+
+
+class CompletionRegistry(object):
+    '''
+    Local files that steps of the same PipelineFlow have finished writing. Steps
+    waiting for their input files sleep on the registry's condition and are woken
+    up as soon as an upstream step or download marks a file done, instead of
+    polling for its .done file.
+    '''
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = set()
+
+    def mark_done(self, local_files):
+        with self._condition:
+            self._done.update(local_files)
+            self._condition.notify_all()
+
+    def is_done(self, local_file):
+        return local_file in self._done
+
+    def notify_all(self):
+        ''' Wake up all waiting steps so they can check whether they should terminate '''
+        with self._condition:
+            self._condition.notify_all()
+
+    def wait_for(self, predicate, timeout):
+        ''' Wait until predicate() is true, re-checking it on every notification and at least every timeout seconds '''
+        with self._condition:
+            while not self._condition.wait_for(predicate, timeout):
+                pass
+
+
+class ResourceBudget(object):
+    '''
+    Token buckets of CPUs and memory (GiB) shared by the steps of a PipelineFlow.
+    A step takes its reservation out of the buckets before it runs and puts it back
+    afterwards, so steps whose reservations don't fit wait instead of pushing the
+    machine into swap. A reservation larger than the whole budget is admitted
+    once nothing else holds any tokens.
+    '''
+
+    def __init__(self, cpus, memory_gb):
+        self.capacity = {"cpus": cpus, "memory_gb": memory_gb}
+        self.available = dict(self.capacity)
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def for_this_machine():
+        memory_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30
+        return ResourceBudget(os.cpu_count(), memory_gb)
+
+    def _clamp(self, reservation):
+        return {k: min(reservation.get(k, 0), capacity) for k, capacity in self.capacity.items()}
+
+    def _fits(self, reservation):
+        return all(self.available[k] >= v for k, v in reservation.items())
+
+    def acquire(self, reservation, should_terminate):
+        ''' Wait until reservation fits, unless should_terminate() becomes true first. Returns whether it was acquired. '''
+        reservation = self._clamp(reservation)
+        with self._condition:
+            self._condition.wait_for(lambda: self._fits(reservation) or should_terminate())
+            if not self._fits(reservation):
+                return False
+            for k, v in reservation.items():
+                self.available[k] -= v
+            return True
+
+    def release(self, reservation):
+        reservation = self._clamp(reservation)
+        with self._condition:
+            for k, v in reservation.items():
+                self.available[k] += v
+            self._condition.notify_all()
+
+    def notify_all(self):
+        ''' Wake up all waiting steps so they can check whether they should terminate '''
+        with self._condition:
+            self._condition.notify_all()
+
+
 class PipelineStep(object):
     ''' Each Pipeline Run Step i.e. run_star, run_bowtie2, etc '''
 
     def __init__(self, name, input_files, output_files,
                  output_dir_local, output_dir_s3, ref_dir_local,
-                 additional_files, additional_attributes):
+                 additional_files, additional_attributes, completion_registry=None, resource_budget=None, step_cache=None):
         ''' Set up all the input_files and output_files here '''
         self.name = name
         self.input_files = input_files  # list of list files
@@ -71,6 +156,13 @@ class PipelineStep(object):
         self.input_file_error = None
         self.upload_results_with_checksum = False
 
+        # Shared by the steps of a PipelineFlow. A step on its own only sees .done files.
+        self.completion_registry = completion_registry or CompletionRegistry()
+        # Shared by the steps of a PipelineFlow. A step on its own runs unconstrained.
+        self.resource_budget = resource_budget
+        # Optional StepResultCache restoring the outputs of a previous run with the same inputs
+        self.step_cache = step_cache
+
     @abstractmethod
     def run(self):
         ''' implement what is actually being run in this step '''
@@ -82,6 +174,9 @@ class PipelineStep(object):
     def stop_waiting(self):
         ''' stop waiting to run '''
         self.should_terminate = True
+        self.completion_registry.notify_all()
+        if self.resource_budget:
+            self.resource_budget.notify_all()
 
     def save_counts(self):
         if self.counts_dict:
@@ -111,11 +206,18 @@ class PipelineStep(object):
             else:
                 self._files_seen.add(f)
 
-            # upload to S3 - TODO(Boris): parallelize the following with better calls
-            s3_path = self.s3_path(f)
-            idseq_dag.util.s3.upload_with_retries(f, s3_path, checksum=self.upload_results_with_checksum)
-        for f in self.additional_output_folders_hidden:
-            idseq_dag.util.s3.upload_folder_with_retries(f, self.s3_path(f), checksum=self.upload_results_with_checksum)
+        # Each upload retries on its own and waits for the s3 upload semaphores, so the
+        # pool only needs to be large enough to keep those busy.
+        with ThreadPoolExecutor(max_workers=idseq_dag.util.s3.MAX_CONCURRENT_UPLOAD_OPERATIONS) as executor:
+            futures = [executor.submit(idseq_dag.util.s3.upload_with_retries, f, self.s3_path(f),
+                                       checksum=self.upload_results_with_checksum)
+                       for f in files_to_upload]
+            futures += [executor.submit(idseq_dag.util.s3.upload_folder_with_retries, f, self.s3_path(f),
+                                        checksum=self.upload_results_with_checksum)
+                        for f in self.additional_output_folders_hidden]
+            # Raises the first failure, after the remaining uploads have finished
+            for future in futures:
+                future.result()
         self.status = StepStatus.UPLOADED
 
     @staticmethod
@@ -137,17 +239,24 @@ class PipelineStep(object):
                     self._files_seen.add(f)
 
                 local_file = os.path.join(self.output_dir_local, f)
-                while True:
-                    if os.path.exists(local_file) and os.path.exists(self.done_file(local_file)):
-                        flist.append(local_file)
-                        break
-                    else:
-                        if self.should_terminate:
-                            # If the step is not supposed to be run any more.
-                            raise RuntimeError("Step %s being terminated" % self.name)
-                        time.sleep(5)
+                self.completion_registry.wait_for(lambda: self.input_file_ready(local_file) or self.should_terminate,
+                                                  INPUT_FILES_POLL_INTERVAL)
+                if not self.input_file_ready(local_file):
+                    # If the step is not supposed to be run any more.
+                    raise RuntimeError("Step %s being terminated" % self.name)
+                flist.append(local_file)
             self.input_files_local.append(flist)
 
+    def input_file_ready(self, local_file):
+        # The .done file is the fallback for files written outside of this PipelineFlow
+        return self.completion_registry.is_done(local_file) or \
+            (os.path.exists(local_file) and os.path.exists(self.done_file(local_file)))
+
+    def wait_for_resources(self):
+        ''' Wait for the step's resource reservation to fit in the budget shared with the other steps '''
+        if self.resource_budget and not self.resource_budget.acquire(self.resource_reservation(), lambda: self.should_terminate):
+            raise RuntimeError("Step %s being terminated" % self.name)
+
     def validate_input_files(self):
         ''' Validate input files before running the step.
         Should assign any error encountered to self.input_file_error
@@ -170,6 +279,7 @@ class PipelineStep(object):
             done_file = self.done_file(f)
             fmt_now = datetime.datetime.now(tz=pytz.UTC).strftime("%a %b %e %H:%M:%S %Z %Y")
             command.write_text_to_file(fmt_now, done_file)
+        self.completion_registry.mark_done(self.output_files_local())
         self.count_reads()
 
     def wait_until_finished(self):
@@ -208,17 +318,39 @@ class PipelineStep(object):
                 self.status = StepStatus.INVALID_INPUT
                 return
 
-            with log.log_context("substep_run", v):
-                self.run()
-            with log.log_context("substep_validate", v):
-                self.validate()
+            if self.step_cache:
+                with log.log_context("substep_restore_cached_results", v):
+                    restored = self.step_cache.restore(self)
+            else:
+                restored = False
+
+            if restored:
+                with log.log_context("substep_validate", v):
+                    self.validate()
+            else:
+                with log.log_context("substep_wait_for_resources", dict(v, **self.resource_reservation())):
+                    self.wait_for_resources()
+                try:
+                    with log.log_context("substep_run", v):
+                        # Keep make_space in other runs from evicting the references this step uses
+                        with idseq_dag.util.s3.pinned_references():
+                            self.run()
+                    if self.step_cache:
+                        with log.log_context("substep_cache_results", v):
+                            self.step_cache.store(self)
+                    with log.log_context("substep_validate", v):
+                        self.validate()
+                finally:
+                    if self.resource_budget:
+                        self.resource_budget.release(self.resource_reservation())
             with log.log_context("substep_save_progress", v):
                 self.save_progress()
             with log.log_context("substep_save_counts", v):
                 self.save_counts()
+        # Set before uploading starts so a fast upload's UPLOADED status isn't overwritten
+        self.status = StepStatus.FINISHED
         self.upload_thread = threading.Thread(target=self.uploading_results)
         self.upload_thread.start()
-        self.status = StepStatus.FINISHED
 
     def start(self):
         ''' function to be called after instantiation to start running the step '''
@@ -251,6 +383,16 @@ class PipelineStep(object):
         '''
         return {"IDseq Docs": "https://github.com/chanzuckerberg/idseq-dag/wiki"}
 
+    def resource_reservation(self):
+        ''' Returns the estimated peak CPUs and memory (GiB) used by run().
+
+        Steps wait for their reservation to fit in the machine's budget before they run.
+        By default, a step reserves what its additional attributes "reserved_cpus" and
+        "reserved_memory_gb" say, or one CPU and no memory.
+        '''
+        return {"cpus": self.additional_attributes.get("reserved_cpus", 1),
+                "memory_gb": self.additional_attributes.get("reserved_memory_gb", 0)}
+
 
 class PipelineCountingStep(PipelineStep):
 
@@ -269,7 +411,7 @@ for this, and not all of them (not all steps count their outputs)."""
         self.should_count_reads = True
         self.counts_dict[counter_name] = count.reads_in_group(
             file_group=fasta_files,
-            cluster_sizes=load_duplicate_cluster_sizes(self.input_cluster_sizes_path()),
+            cluster_sizes=shared_duplicate_cluster_sizes(self.input_cluster_sizes_path()),
             cluster_key=cluster_key)
 
     def count_reads(self):
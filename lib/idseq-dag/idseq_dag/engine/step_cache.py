@@ -0,0 +1,141 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import threading
+
+import idseq_dag
+import idseq_dag.util.command as command
+import idseq_dag.util.log as log
+
+MANIFEST = "manifest.json"
+OUTPUTS = "outputs"
+
+
+def _copy(src, dst):
+    '''
+    Copy src to dst, replacing dst.  Never a hardlink: a step that reruns without a cache
+    hit opens its outputs with "w", which would truncate the cached copy through the link.
+    '''
+    if os.path.lexists(dst):
+        os.remove(dst)
+    shutil.copy2(src, dst)
+
+
+def _copy_tree(src, dst):
+    if os.path.lexists(dst):
+        shutil.rmtree(dst)
+    shutil.copytree(src, dst, copy_function=_copy)
+
+
+class StepResultCache(object):
+    '''
+    Local cache of step outputs, keyed by a hash of the step class source, its additional
+    attributes and files, and the contents of its input files. A step whose key is cached
+    restores its outputs by copy instead of running, so rerunning a DAG after changing
+    one step only reruns the steps downstream of it, without needing S3.
+
+    The step class source is hashed along with every module of idseq_dag, since a step's
+    results also depend on the util modules it calls.
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        command.make_dirs(self.cache_dir)
+        # Input files are hashed once per (path, size, mtime), no matter how many steps read them
+        self._digests = {}
+        self._lock = threading.Lock()
+        self._code_digest = None
+
+    def file_digest(self, path):
+        st = os.stat(path)
+        stat_key = (path, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if stat_key in self._digests:
+                return self._digests[stat_key]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                digest.update(chunk)
+        with self._lock:
+            self._digests[stat_key] = digest.hexdigest()
+        return self._digests[stat_key]
+
+    def code_digest(self):
+        ''' Digest of the source of every module in the idseq_dag package '''
+        if self._code_digest is None:
+            package_dir = os.path.dirname(idseq_dag.__file__)
+            digest = hashlib.sha256()
+            for dirpath, dirnames, filenames in os.walk(package_dir):
+                dirnames.sort()
+                for filename in sorted(f for f in filenames if f.endswith(".py")):
+                    path = os.path.join(dirpath, filename)
+                    digest.update(os.path.relpath(path, package_dir).encode())
+                    digest.update(self.file_digest(path).encode())
+            self._code_digest = digest.hexdigest()
+        return self._code_digest
+
+    def key(self, step):
+        step_class = type(step)
+        key = hashlib.sha256()
+        key.update(f"{step_class.__module__}.{step_class.__qualname__}".encode())
+        key.update(self.file_digest(inspect.getsourcefile(step_class)).encode())
+        key.update(self.code_digest().encode())
+        key.update(json.dumps([step.output_files, step.additional_files, step.additional_attributes],
+                              sort_keys=True).encode())
+        for target in step.input_files_local:
+            for f in target:
+                key.update(self.file_digest(f).encode())
+        return key.hexdigest()
+
+    def restore(self, step):
+        ''' Restore the step's outputs if they are cached. Returns whether they were. '''
+        cached_dir = os.path.join(self.cache_dir, self.key(step))
+        if not os.path.isfile(os.path.join(cached_dir, MANIFEST)):
+            return False
+        with open(os.path.join(cached_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+        for f in manifest["files"]:
+            dst = os.path.join(step.output_dir_local, f)
+            command.make_dirs(os.path.dirname(dst))
+            _copy(os.path.join(cached_dir, OUTPUTS, f), dst)
+        for f in manifest["folders"]:
+            _copy_tree(os.path.join(cached_dir, OUTPUTS, f), os.path.join(step.output_dir_local, f))
+        # Files and folders that run() would have registered for upload
+        step.additional_output_files_hidden += [os.path.join(step.output_dir_local, f) for f in manifest["additional_output_files_hidden"]]
+        step.additional_output_files_visible += [os.path.join(step.output_dir_local, f) for f in manifest["additional_output_files_visible"]]
+        step.additional_output_folders_hidden += [os.path.join(step.output_dir_local, f) for f in manifest["additional_output_folders_hidden"]]
+        log.log_event("step_cache_hit", values={"step": step.name, "cached_dir": cached_dir})
+        return True
+
+    def store(self, step):
+        ''' Cache the step's outputs, right after run() and before count_reads() adds its count file. '''
+        manifest = {
+            "step": step.name,
+            "additional_output_files_hidden": [step.relative_path(f) for f in step.additional_output_files_hidden],
+            "additional_output_files_visible": [step.relative_path(f) for f in step.additional_output_files_visible],
+            "additional_output_folders_hidden": [step.relative_path(f) for f in step.additional_output_folders_hidden],
+        }
+        manifest["files"] = [step.relative_path(f) for f in step.output_files_local()] + \
+            manifest["additional_output_files_hidden"] + manifest["additional_output_files_visible"]
+        manifest["folders"] = manifest["additional_output_folders_hidden"]
+        if any(f.startswith("..") for f in manifest["files"] + manifest["folders"]):
+            log.write(f"Not caching results of step {step.name}: some of them are outside of {step.output_dir_local}")
+            return
+
+        cached_dir = os.path.join(self.cache_dir, self.key(step))
+        tmp_dir = f"{cached_dir}.tmp.{os.getpid()}.{threading.get_ident()}"
+        command.make_dirs(tmp_dir)
+        for f in manifest["files"]:
+            command.make_dirs(os.path.dirname(os.path.join(tmp_dir, OUTPUTS, f)))
+            _copy(os.path.join(step.output_dir_local, f), os.path.join(tmp_dir, OUTPUTS, f))
+        for f in manifest["folders"]:
+            _copy_tree(os.path.join(step.output_dir_local, f), os.path.join(tmp_dir, OUTPUTS, f))
+        with open(os.path.join(tmp_dir, MANIFEST), "w") as f:
+            json.dump(manifest, f)
+        try:
+            os.rename(tmp_dir, cached_dir)
+        except OSError:
+            # Another run cached the same results first
+            shutil.rmtree(tmp_dir)
@@ -1,5 +1,6 @@
 from typing import Iterable, List
 
+from .s3quilt_pure import DEFAULT_MAX_GAP
 from .s3quilt_pure import download_chunks as _download_chunks
 from .s3quilt_pure import download_chunks_to_file as _download_chunks_to_file
 
@@ -15,6 +16,7 @@ def download_chunks(
     starts: Iterable[int],
     lengths: Iterable[int],
     concurrency: int = 100,
+    max_gap: int = DEFAULT_MAX_GAP,
 ) -> List[str]:
     """
     Download multiple chunks from an S3 object in parallel.
@@ -25,11 +27,12 @@ def download_chunks(
         starts: Iterable of starting byte positions
         lengths: Iterable of chunk lengths
         concurrency: Number of concurrent downloads (default: 100)
+        max_gap: Merge chunks separated by at most this many bytes into one request
         
     Returns:
         List of chunk data as strings
     """
-    return _download_chunks(bucket, key, list(starts), list(lengths), concurrency)
+    return _download_chunks(bucket, key, list(starts), list(lengths), concurrency, max_gap)
 
 
 def download_chunks_to_file(
@@ -39,6 +42,7 @@ def download_chunks_to_file(
     starts: Iterable[int],
     lengths: Iterable[int],
     concurrency: int = 100,
+    max_gap: int = DEFAULT_MAX_GAP,
 ) -> None:
     """
     Download multiple chunks from an S3 object and save to a file.
@@ -50,5 +54,6 @@ def download_chunks_to_file(
         starts: Iterable of starting byte positions
         lengths: Iterable of chunk lengths
         concurrency: Number of concurrent downloads (default: 100)
+        max_gap: Merge chunks separated by at most this many bytes into one request
     """
-    _download_chunks_to_file(bucket, key, filepath, list(starts), list(lengths), concurrency)
\ No newline at end of file
+    _download_chunks_to_file(bucket, key, filepath, list(starts), list(lengths), concurrency, max_gap)
\ No newline at end of file
@@ -61,6 +61,10 @@ class PipelineStepBlastContigs(PipelineStep):  # pylint: disable=abstract-method
     # so we may broaden the scope of this mutex.
     cya_lock = multiprocessing.RLock()
 
+    def resource_reservation(self):
+        # blastx runs with 32 threads
+        return dict(super().resource_reservation(), cpus=32)
+
     def run(self):
         '''
             1. summarize hits
@@ -173,8 +177,8 @@ class PipelineStepBlastContigs(PipelineStep):  # pylint: disable=abstract-method
         ''' generate new m8 and hit_summary based on consolidated_dict and read2blastm8 '''
         # Generate new hit summary
         new_read_ids = added_reads.keys()
-        with open(hit_summary_path) as hit_summary_f, open(refined_hit_summary_path, "w") as refined_hit_summary_f:
-            refined_hit_summary_writer = HitSummaryMergedWriter(refined_hit_summary_f)
+        with open(hit_summary_path) as hit_summary_f, open(refined_hit_summary_path, "w") as refined_hit_summary_f, \
+                HitSummaryMergedWriter(refined_hit_summary_f, sidecar=True) as refined_hit_summary_writer:
             for read in HitSummaryReader(hit_summary_f):
                 refined_hit_summary_writer.writerow(consolidated_dict[read["read_id"]])
             # add the reads that are newly blasted
@@ -66,9 +66,9 @@ def _merge_taxon_counts(
                 read=nr_hit_dict.get("species_taxid"),
             )
 
-    with open(merged_m8_filename, "w") as output_blastn_6_f, open(merged_hit_filename, "w") as output_hit_summary_f:
+    with open(merged_m8_filename, "w") as output_blastn_6_f, open(merged_hit_filename, "w") as output_hit_summary_f, \
+            HitSummaryMergedWriter(output_hit_summary_f, sidecar=True) as output_hit_summary_writer:
         output_blastn_6_writer = BlastnOutput6NTRerankedWriter(output_blastn_6_f)
-        output_hit_summary_writer = HitSummaryMergedWriter(output_hit_summary_f)
 
         with open(nt_m8) as input_nt_blastn_6_f, open(nt_hitsummary2_tab) as input_nt_hit_summary_f:
             # first pass for NR and output to m8 files if assignment should come from NT
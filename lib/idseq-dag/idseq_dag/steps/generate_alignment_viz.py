@@ -253,7 +253,10 @@ class PipelineStepGenerateAlignmentViz(PipelineStep):
                                                   nt_s3_path):
         parsed = urlparse(nt_s3_path)
         chunk_size = 500
-        accession_ids_generator = (a_id for a_id in accession2seq.keys() if a_id in nt_loc_dict)
+        # In NT order, so that neighbouring accessions land in the same batch, where
+        # download_chunks fetches them with a single request
+        accession_ids_generator = iter(sorted((a_id for a_id in accession2seq.keys() if a_id in nt_loc_dict),
+                                              key=lambda a_id: nt_loc_dict[a_id][0]))
         accession_ids = list(itertools.islice(accession_ids_generator, 0, chunk_size))
         while accession_ids:
             accession_ranges = [nt_loc_dict[a_id] for a_id in accession_ids]
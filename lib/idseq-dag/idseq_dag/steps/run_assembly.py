@@ -9,7 +9,7 @@ import idseq_dag.util.command as command
 import idseq_dag.util.command_patterns as command_patterns
 
 from idseq_dag.util.m8 import MIN_CONTIG_SIZE
-from idseq_dag.util.count import get_read_cluster_size, load_duplicate_cluster_sizes, READ_COUNTING_MODE, ReadCountingMode
+from idseq_dag.util.count import get_read_cluster_size, shared_duplicate_cluster_sizes, READ_COUNTING_MODE, ReadCountingMode
 
 
 # TODO: replace this with a simpler function. we don't really need the whole sam file
@@ -19,7 +19,7 @@ def generate_info_from_sam(bowtie_sam_file, read2contig, duplicate_cluster_sizes
     base_counts = defaultdict(int)
     seen = set()
     if duplicate_cluster_sizes_path:
-        duplicate_cluster_sizes = load_duplicate_cluster_sizes(duplicate_cluster_sizes_path)
+        duplicate_cluster_sizes = shared_duplicate_cluster_sizes(duplicate_cluster_sizes_path)
     with open(bowtie_sam_file, "r", encoding='utf-8') as samf:
         for line in samf:
             if line[0] == '@':
@@ -88,6 +88,10 @@ class PipelineStepRunAssembly(PipelineStep):
     ```
     """
 
+    def resource_reservation(self):
+        # spades runs with 32 threads and is capped at the "memory" attribute (GiB)
+        return {"cpus": 32, "memory_gb": int(self.additional_attributes.get('memory', 100))}
+
     def run(self):
         """
            Run Assembly
@@ -1,3 +1,4 @@
+import logging
 import multiprocessing
 import random
 import subprocess
@@ -8,6 +9,8 @@ import time
 import glob as _glob
 import shutil
 import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import wraps
 from typing import Union
 import pkg_resources
@@ -45,6 +48,131 @@ class Updater(object):
         self.exited = True
 
 
+def _read_proc_file(pid, name):
+    with open(f"/proc/{pid}/{name}") as f:
+        return f.read()
+
+
+def _proc_cpu_seconds(pid):
+    ''' CPU seconds of a process and of the children it has waited for, from /proc/<pid>/stat.
+    The command name may contain spaces, so split after it. '''
+    fields = _read_proc_file(pid, "stat").rsplit(")", 1)[1].split()
+    utime, stime, cutime, cstime = (int(field) for field in fields[11:15])
+    return (utime + stime + cutime + cstime) / os.sysconf("SC_CLK_TCK")
+
+
+def _proc_status(pid):
+    ''' RSS and peak RSS in kB, and thread count, from /proc/<pid>/status '''
+    status = {}
+    for line in _read_proc_file(pid, "status").splitlines():
+        key, _, value = line.partition(":")
+        if key in ("VmRSS", "VmHWM", "Threads"):
+            status[key] = int(value.split()[0])
+    return status
+
+
+def _proc_io(pid):
+    ''' (read_bytes, write_bytes) of a process and of the children it has waited for, from /proc/<pid>/io '''
+    io = dict(line.split(": ") for line in _read_proc_file(pid, "io").splitlines())
+    return int(io["read_bytes"]), int(io["write_bytes"])
+
+
+def _proc_children(pid):
+    ''' Children of all the threads of a process, from /proc/<pid>/task/<tid>/children '''
+    children = []
+    for tid in os.listdir(f"/proc/{pid}/task"):
+        children += [int(child) for child in _read_proc_file(pid, f"task/{tid}/children").split()]
+    return children
+
+
+def _process_tree(root_pid):
+    ''' root_pid and its descendants. Kernels without /proc/<pid>/task/<tid>/children
+    need a scan of the parent of every process instead. '''
+    get_children = _proc_children
+    if not os.path.exists(f"/proc/{root_pid}/task/{root_pid}/children"):
+        children = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    ppid = int(_read_proc_file(entry, "stat").rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue  # The process exited
+                children.setdefault(ppid, []).append(int(entry))
+        get_children = lambda pid: children.get(pid, [])  # noqa: E731
+    pids = [root_pid]
+    tree = []
+    while pids:
+        pid = pids.pop()
+        tree.append(pid)
+        try:
+            pids += get_children(pid)
+        except (OSError, ValueError):
+            continue  # The process exited
+    return tree
+
+
+class ProcessTreeUsage(object):
+    """Resource usage of a process and all its descendants, sampled from /proc.
+
+    Peak RSS is the largest sampled total RSS of the tree, or the largest
+    per-process high water mark if that's higher. CPU seconds and I/O bytes
+    are those of the last sample, in which each process also counts the
+    children it has waited for, so processes that start and end between
+    samples are counted once their parent reaps them. Take a last sample of
+    the exited root process before reaping it, then pass its rusage to
+    reaped(), which adds the peak RSS and CPU seconds the kernel reports.
+    """
+
+    def __init__(self):
+        self.num_samples = 0
+        self.peak_rss_kb = 0
+        self.peak_threads = 0
+        self.cpu_seconds = {}
+        self.io_bytes = {}
+        self.pids = set()
+
+    def sample(self, root_pid):
+        cpu_seconds = {}
+        io_bytes = {}
+        rss_kb = 0
+        threads = 0
+        for pid in _process_tree(root_pid):
+            self.pids.add(pid)
+            try:
+                cpu_seconds[pid] = _proc_cpu_seconds(pid)
+                io_bytes[pid] = _proc_io(pid)
+                status = _proc_status(pid)
+                rss_kb += status.get("VmRSS", 0)
+                self.peak_rss_kb = max(self.peak_rss_kb, status.get("VmHWM", 0))
+                threads += status.get("Threads", 0)
+            except (OSError, IndexError, ValueError, KeyError):
+                # The process exited, or its io isn't readable. Keep what was last seen of it.
+                for usage, last_usage in ((cpu_seconds, self.cpu_seconds), (io_bytes, self.io_bytes)):
+                    if pid not in usage and pid in last_usage:
+                        usage[pid] = last_usage[pid]
+        self.cpu_seconds = cpu_seconds
+        self.io_bytes = io_bytes
+        self.peak_rss_kb = max(self.peak_rss_kb, rss_kb)
+        self.peak_threads = max(self.peak_threads, threads)
+        self.num_samples += 1
+
+    def reaped(self, root_pid, rusage):
+        """Add the rusage that wait4 returned for the root process"""
+        self.peak_rss_kb = max(self.peak_rss_kb, rusage.ru_maxrss)
+        self.cpu_seconds[root_pid] = max(self.cpu_seconds.get(root_pid, 0), rusage.ru_utime + rusage.ru_stime)
+
+    def summary(self):
+        return {
+            "peak_rss_mb": round(self.peak_rss_kb / 1024, 1),
+            "cpu_seconds": round(sum(self.cpu_seconds.values()), 2),
+            "read_bytes": sum(r for r, _ in self.io_bytes.values()),
+            "write_bytes": sum(w for _, w in self.io_bytes.values()),
+            "peak_threads": self.peak_threads,
+            "num_processes": len(self.pids),
+            "num_samples": self.num_samples,
+        }
+
+
 class CommandTracker(Updater):
     """CommandTracker is for running external and remote commands and
     monitoring their progress with log updates and timeouts.
@@ -55,6 +183,9 @@ class CommandTracker(Updater):
     def __init__(self, update_period=15):
         super(CommandTracker, self).__init__(
             update_period, self.print_update_and_enforce_timeout)
+        self.usage = ProcessTreeUsage()
+        # Held while reaping self.proc, so the timer thread doesn't reap it first
+        self.proc_lock = threading.Lock()
         # User can set the watchdog to a function that takes self.id and
         # t_elapsed as single arg
         self.proc = None  # Value indicates registered subprocess.
@@ -70,9 +201,13 @@ class CommandTracker(Updater):
         """Log an update after every polling period to indicate the command is
         still active.
         """
-        if self.proc is None or self.proc.poll() is None:
+        if self.proc is None or self.poll() is None:
             log.write("Command %d still running after %3.1f seconds." %
                       (self.id, t_elapsed))
+            if self.proc is not None and os.path.isdir("/proc"):
+                with self.proc_lock:
+                    if self.proc.returncode is None:
+                        self.usage.sample(self.proc.pid)
         else:
             # This should be uncommon, unless there is lengthy python
             # processing following the command in the same CommandTracker
@@ -83,12 +218,34 @@ class CommandTracker(Updater):
                 (self.id, t_elapsed))
         self.enforce_timeout(t_elapsed)
 
+    def poll(self):
+        with self.proc_lock:
+            return self.proc.poll()
+
+    def wait(self):
+        """Wait for self.proc to exit and reap it. Where there is a /proc, first
+        take a last sample of its resource usage, so that commands shorter than
+        update_period are measured too, and so is everything after the last sample.
+        """
+        if os.path.isdir("/proc"):
+            try:
+                os.waitid(os.P_PID, self.proc.pid, os.WEXITED | os.WNOWAIT)
+            except ChildProcessError:
+                pass  # Already reaped
+            with self.proc_lock:
+                if self.proc.returncode is None:
+                    self.usage.sample(self.proc.pid)
+                    _, status, rusage = os.wait4(self.proc.pid, 0)
+                    self.usage.reaped(self.proc.pid, rusage)
+                    self.proc.returncode = os.waitstatus_to_exitcode(status)
+        return self.proc.wait()
+
     def enforce_timeout(self, t_elapsed):
         """Check the timeout and send SIGTERM then SIGKILL to end a command's
         execution.
         """
         if self.timeout is None or not self.proc or \
-                t_elapsed <= self.timeout or self.proc.poll() is not None:
+                t_elapsed <= self.timeout or self.poll() is not None:
             # Skip if unregistered subprocess, subprocess not yet timed out,
             # or subprocess already exited.
             pass
@@ -112,6 +269,11 @@ class CommandTracker(Updater):
                 "SIGKILL." % (self.id, time.time() - self.t_sigkill_sent)
             log.write(msg)
 
+    def __exit__(self, *args):
+        super(CommandTracker, self).__exit__(*args)
+        if self.usage.num_samples:
+            log.log_event("command_resource_usage", values=dict(cid=f"Command {self.id}", **self.usage.summary()))
+
 
 class ProgressFile(object):
     def __init__(self, progress_file):
@@ -186,6 +348,112 @@ def run_in_subprocess(target):
     return wrapper
 
 
+# Resources loaded by the WorkerPool initializer of this worker process
+_worker_resources = {}
+
+
+def worker_resource(name):
+    """Return the resource loaded under name by the WorkerPool initializer of this worker process."""
+    return _worker_resources[name]
+
+
+def _init_worker(configure_logger, initializer, initargs):
+    if configure_logger:
+        log.configure_logger()
+    if initializer:
+        _worker_resources.update(initializer(*initargs))
+
+
+def _worker_context(forkserver_user={}):  # pylint: disable=dangerous-default-value
+    """
+    The forkserver start method, for WorkerPools of the first process to start one.  A process
+    forked from it, e.g. by run_in_subprocess, inherits the state of its forkserver without
+    being able to use it, so its WorkerPools spawn their workers instead.
+    """
+    if forkserver_user.setdefault("pid", os.getpid()) == os.getpid():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+class WorkerPool(object):
+    """
+    Persistent pool of worker processes, for functions called many times, e.g. once per slice
+    of the input, that run_in_subprocess would fork a new process for every time.
+
+    Workers are started by the forkserver or spawn method, so they don't inherit the memory,
+    threads and locks of the pipeline process, and they are reused across calls.  The optional initializer
+    runs once in each worker, and returns a dict of read-only resources, e.g. lineage maps, that
+    the target function looks up with worker_resource() instead of opening them on every call:
+
+         def open_lineage_map(lineage_map_path):
+             return {"lineage_map": open_file_db_by_extension(lineage_map_path, "lll")}
+
+         def compute_something(x):
+             lineage_map = worker_resource("lineage_map")
+             ...
+
+         with WorkerPool(num_workers, open_lineage_map, (lineage_map_path,)) as pool:
+             pool.map(compute_something, xs)
+
+    Target functions, their arguments and their return values have to be pickled, so targets
+    must be module-level functions, not closures.  As with run_in_subprocess, a target that
+    raises, or exits with a non-zero code, fails the call with a RuntimeError.
+    """
+
+    def __init__(self, num_workers, initializer=None, initargs=()):
+        configure_logger = bool(logging.getLogger(log.__name__).handlers)
+        self.executor = ProcessPoolExecutor(num_workers, mp_context=_worker_context(),
+                                            initializer=_init_worker,
+                                            initargs=(configure_logger, initializer, initargs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+    @staticmethod
+    def _result(future, target, args, kwargs):
+        try:
+            return future.result()
+        except SystemExit as e:
+            # Same exit code as a multiprocessing.Process whose target calls sys.exit()
+            exitcode = e.code if isinstance(e.code, int) or e.code is None else 1
+            if not exitcode:
+                return None
+            cause = e
+        except BrokenProcessPool as e:
+            raise RuntimeError(f"Failed {target.__qualname__} on {list(args)}, {kwargs}: a worker process died") from e
+        except Exception as e:  # pylint: disable=broad-except
+            exitcode = 1
+            cause = e
+        raise RuntimeError(f"Failed {target.__qualname__} with code {exitcode} on {list(args)}, {kwargs}") from cause
+
+    def run(self, target, *args, **kwargs):
+        """Call target in a worker process, and return its result."""
+        return self._result(self.executor.submit(target, *args, **kwargs), target, args, kwargs)
+
+    def map(self, target, seq):
+        """
+        Like the built-in map function, but calls target in the worker processes.  Waits for
+        all of the calls to finish before raising the error of the first one that failed.
+        """
+        calls = [((arg,), self.executor.submit(target, arg)) for arg in seq]
+        errors = []
+        results = []
+        for args, future in calls:
+            try:
+                results.append(self._result(future, target, args, {}))
+            except RuntimeError as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+        return results
+
+
 def retry(operation, MAX_TRIES=3):
     """Retry decorator for external commands."""
     # Note the use of a separate random generator for retries so transient
@@ -242,9 +510,13 @@ def execute(command: Union[command_patterns.CommandPattern, str],
             grace_period: int = None,
             capture_stdout: bool = False,
             merge_stderr: bool = False,
-            log_context_mode: log.LogContextMode = log.LogContextMode.START_END_LOG_EVENTS) -> Union[str, None]:
+            log_context_mode: log.LogContextMode = log.LogContextMode.START_END_LOG_EVENTS,
+            stdin: int = None) -> Union[str, None]:
     """Primary way to start external commands in subprocesses and handle
     execution with logging.
+
+    The child reads from the stdin file descriptor if given, or else from the
+    parent's stdin.
     """
     if not isinstance(command, command_patterns.CommandPattern):
         # log warning if using legacy format
@@ -265,15 +537,18 @@ def execute(command: Union[command_patterns.CommandPattern, str],
                     # Capture only stdout. Child stderr = parent stderr unless
                     # merge_stderr specified. Child input = parent stdin.
                     ct.proc = cmd.open(
-                        stdin=sys.stdin.fileno(),
+                        stdin=sys.stdin.fileno() if stdin is None else stdin,
                         stdout=subprocess.PIPE,
                         stderr=subprocess.STDOUT if merge_stderr else sys.stderr.fileno()
                     )
-                    stdout, _ = ct.proc.communicate()
+                    # Like communicate(), but reaping the command with ct.wait()
+                    with ct.proc.stdout:
+                        stdout = ct.proc.stdout.read()
+                    ct.wait()
                 else:
                     # Capture nothing. Child inherits parent stdin/out/err.
-                    ct.proc = cmd.open()
-                    ct.proc.wait()
+                    ct.proc = cmd.open(stdin=stdin)
+                    ct.wait()
                     stdout = None
 
                 lctx.values.update({"returncode": ct.proc.returncode})
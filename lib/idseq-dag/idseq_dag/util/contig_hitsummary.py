@@ -34,15 +34,14 @@ def summarize_hits(
             open_file_db_by_extension(accession_to_taxid_path, "L") as accession_to_taxid, \
             open_file_db_by_extension(taxid_to_lineage_path, "lll") as taxid_to_lineage, \
             open(m8_reassigned_output_path, 'w') as m8_out_f, \
-            open(hitsummary_output_path, 'w') as hitsummary_out_f:
+            open(hitsummary_output_path, 'w') as hitsummary_out_f, \
+            HitSummaryMergedWriter(hitsummary_out_f, sidecar=True) as hitsummary_writer:
 
         if db_type.lower() == "nt":
             m8_writer = BlastnOutput6NTRerankedWriter(m8_out_f)
         else:
             m8_writer = BlastnOutput6Writer(m8_out_f)
 
-        hitsummary_writer = HitSummaryMergedWriter(hitsummary_out_f)
-
         if db_type.lower() == "nt":
             reader = BlastnOutput6NTRerankedReader(
                 in_f,
@@ -1,4 +1,7 @@
-import gzip
+import threading
+import weakref
+import zlib
+from collections import OrderedDict
 from enum import Enum
 from subprocess import run, PIPE
 import os
@@ -15,32 +18,96 @@ READ_COUNTING_MODE = ReadCountingMode.COUNT_ALL
 
 GZIP_MAGIC_HEADER = b'\037\213'
 
+COUNT_READ_SIZE = 2**20
+
+# Read counts by (path, inode, size, mtime), so counting a file again doesn't read it again
+_read_counts = {}
+_read_counts_lock = threading.Lock()
+
+
+def _decompressed_chunks(fh):
+    ''' Stream the contents of gzipped fh in large chunks, decompressing every member '''
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    member_started = False
+    for chunk in iter(lambda: fh.read(COUNT_READ_SIZE), b""):
+        while chunk:
+            member_started = True
+            yield decompressor.decompress(chunk)
+            if not decompressor.eof:
+                break
+            # Another gzip member may start right after the end of this one
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            member_started = False
+    if member_started and not decompressor.eof:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+
+def _count_in_chunks(chunks):
+    ''' The first character of the chunks and the lines starting with ">" in them if it's ">", else their lines '''
+    first_char = b""
+    previous_last_char = b""
+    record_starts = 0
+    newlines = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if not first_char:
+            first_char = chunk[:1]
+            previous_last_char = b"\n"
+        if first_char == b">":
+            # Lines starting with ">", like grep -c '^>'
+            record_starts += chunk.count(b"\n>") + (previous_last_char == b"\n" and chunk[:1] == b">")
+        else:
+            # Like wc -l
+            newlines += chunk.count(b"\n")
+        previous_last_char = chunk[-1:]
+    return first_char, record_starts if first_char == b">" else newlines
+
+
+def _count_in_file(fh, first_char):
+    ''' Like _count_in_chunks for uncompressed fh, using grep and wc, which are faster than python for this '''
+    cmd = "grep -c '^>'" if first_char == b">" else "wc -l"
+    return int(run(cmd, stdin=fh, stdout=PIPE, check=True, shell=True).stdout)
+
+
+def _reads(filename, first_char, count):
+    if not first_char:
+        return 0
+    if first_char == b">":
+        return count
+    if first_char == b"@":
+        if count % 4 != 0:
+            raise InvalidFileFormatError(f"The .fastq file {os.path.basename(filename)} has an invalid number of lines.")
+        return count // 4
+    raise InvalidFileFormatError(f"The file format of {os.path.basename(filename)} was not recognized.  Please ensure your file is a valid .fasta/.fastq file.")
+
+
 def count_reads(filename):
     '''
-    Count reads in a given FASTA or FASTQ file.
+    Count reads in a given FASTA or FASTQ file, optionally gzipped.
+
+    Counts are remembered for the life of the process, so counting the same file
+    again, with the same size and modification time, doesn't read it again.
     '''
-    with open(filename, "rb") as gz_fh:
-        is_gzipped = True if gz_fh.read(2).startswith(GZIP_MAGIC_HEADER) else False
-    with gzip.open(filename) if is_gzipped else open(filename, mode="rb") as fmt_fh:
-        chunk = fmt_fh.read(1)
-        if len(chunk) == 0:
-            return 0
-        first_char = chunk.decode()[0]
-    with open(filename, "rb") as fh:
-        if first_char == ">":
-            cmd = "grep -c '^>'"
-            if is_gzipped:
-                cmd = "gunzip | " + cmd
-            return int(run(cmd, stdin=fh, stdout=PIPE, check=True, shell=True).stdout)
-        elif first_char == "@":
-            cmd = "wc -l"
-            if is_gzipped:
-                cmd = "gunzip | " + cmd
-            num_lines = int(run(cmd, stdin=fh, stdout=PIPE, check=True, shell=True).stdout)
-            if num_lines % 4 != 0:
-                raise InvalidFileFormatError(f"The .fastq file {os.path.basename(filename)} has an invalid number of lines.")
-            return num_lines // 4
-        raise InvalidFileFormatError(f"The file format of {os.path.basename(filename)} was not recognized.  Please ensure your file is a valid .fasta/.fastq file.")
+    st = os.stat(filename)
+    key = (os.path.realpath(filename), st.st_ino, st.st_size, st.st_mtime_ns)
+    with _read_counts_lock:
+        num_reads = _read_counts.get(key)
+    if num_reads is None:
+        # Unbuffered, so that the seek moves the file offset grep and wc read from
+        with open(filename, "rb", buffering=0) as fh:
+            head = fh.read(2)
+            fh.seek(0)
+            if head.startswith(GZIP_MAGIC_HEADER):
+                first_char, count = _count_in_chunks(_decompressed_chunks(fh))
+            else:
+                first_char = head[:1]
+                count = _count_in_file(fh, first_char) if first_char in (b">", b"@") else 0
+        num_reads = _reads(filename, first_char, count)
+        with _read_counts_lock:
+            _read_counts[key] = num_reads
+    return num_reads
 
 
 reads = count_reads
@@ -97,12 +164,77 @@ def get_read_cluster_size(duplicate_cluster_sizes, read_id):
     return cluster_size
 
 
-def load_duplicate_cluster_sizes(filename):
-    duplicate_cluster_sizes = {}
+def _read_duplicate_cluster_sizes(filename):
     with open(filename, "r") as f:
         for line in f:
             cluster_size_str, read_id = line.split(None, 1)
-            duplicate_cluster_sizes[read_id.strip()] = int(cluster_size_str)
+            yield read_id.strip(), int(cluster_size_str)
+
+
+def load_duplicate_cluster_sizes(filename):
+    return dict(_read_duplicate_cluster_sizes(filename))
+
+
+class SharedDuplicateClusterSizes(dict):
+    ''' Read-only dict of duplicate cluster sizes, returned by shared_duplicate_cluster_sizes '''
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Duplicate cluster sizes are shared by all steps and can't be modified")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+
+# Number of the most recently used SharedDuplicateClusterSizes kept loaded after nobody references them
+SHARED_DUPLICATE_CLUSTER_SIZES_CACHE_SIZE = 2
+
+# Live SharedDuplicateClusterSizes by (path, size, mtime). An entry goes away with the last reference to it.
+_shared_duplicate_cluster_sizes = weakref.WeakValueDictionary()
+# The most recently used of them, oldest first, referenced here so that steps that run one
+# after the other share them too
+_recent_duplicate_cluster_sizes = OrderedDict()
+_shared_duplicate_cluster_sizes_lock = threading.Lock()
+# Locks of the entries being loaded, by key
+_shared_duplicate_cluster_sizes_loading = {}
+
+
+def _use_shared_duplicate_cluster_sizes(key, duplicate_cluster_sizes):
+    # Call with _shared_duplicate_cluster_sizes_lock held
+    _shared_duplicate_cluster_sizes[key] = duplicate_cluster_sizes
+    _recent_duplicate_cluster_sizes[key] = duplicate_cluster_sizes
+    _recent_duplicate_cluster_sizes.move_to_end(key)
+    while len(_recent_duplicate_cluster_sizes) > SHARED_DUPLICATE_CLUSTER_SIZES_CACHE_SIZE:
+        _recent_duplicate_cluster_sizes.popitem(last=False)
+
+
+def shared_duplicate_cluster_sizes(filename):
+    '''
+    Like load_duplicate_cluster_sizes, but all the threads of this process that use the same
+    file share one read-only copy instead of each parsing their own.  The copy is freed once
+    nobody references it and it is not one of the SHARED_DUPLICATE_CLUSTER_SIZES_CACHE_SIZE
+    most recently used.  Don't use it in code that runs under command.run_in_subprocess,
+    where the copy can't be shared anyway.
+    '''
+    st = os.stat(filename)
+    key = (os.path.realpath(filename), st.st_size, st.st_mtime_ns)
+    with _shared_duplicate_cluster_sizes_lock:
+        duplicate_cluster_sizes = _shared_duplicate_cluster_sizes.get(key)
+        if duplicate_cluster_sizes is not None:
+            _use_shared_duplicate_cluster_sizes(key, duplicate_cluster_sizes)
+            return duplicate_cluster_sizes
+        loading_lock = _shared_duplicate_cluster_sizes_loading.setdefault(key, threading.Lock())
+    # Threads asking for the same file while it's being parsed wait for it instead of parsing it too
+    with loading_lock:
+        try:
+            with _shared_duplicate_cluster_sizes_lock:
+                duplicate_cluster_sizes = _shared_duplicate_cluster_sizes.get(key)
+            if duplicate_cluster_sizes is None:
+                duplicate_cluster_sizes = SharedDuplicateClusterSizes(_read_duplicate_cluster_sizes(filename))
+            with _shared_duplicate_cluster_sizes_lock:
+                _use_shared_duplicate_cluster_sizes(key, duplicate_cluster_sizes)
+        finally:
+            with _shared_duplicate_cluster_sizes_lock:
+                if _shared_duplicate_cluster_sizes_loading.get(key) is loading_lock:
+                    del _shared_duplicate_cluster_sizes_loading[key]
     return duplicate_cluster_sizes
 
 
@@ -246,3 +246,85 @@ class JsonFormatter(logging.Formatter):
             obj['data'] = record.obj_data
         obj.update({"thread": record.threadName, "pid": record.process, "level": record.levelname})
         return json.dumps(obj, default=default_json_serializer)
+
+
+def _trace_timestamp_us(record):
+    return datetime.datetime.strptime(record["time"], JsonFormatter.default_time_format + ".%f").timestamp() * 1e6
+
+
+def chrome_trace_events(log_lines):
+    '''
+    Convert log lines written by JsonFormatter to Chrome Trace Event format, which
+    chrome://tracing and ui.perfetto.dev display as a timeline.
+
+    Each process and thread gets its own track, where every log_context and
+    log_function_execution call is a span, nested as they were in the code. Waiting
+    for and holding a TraceLock are spans too, named "wait <lock_name>" and
+    "hold <lock_name>". Any other log_event is an instant event. Lines that aren't
+    JSON log records are skipped. Contexts that never ended, for example because
+    the log was cut short, are left open until the end of the trace.
+    '''
+    events = []
+    tids = {}
+    context_starts = {}
+    lock_starts = {}
+
+    def track(record):
+        key = (record["pid"], record["thread"])
+        if key not in tids:
+            tids[key] = len(tids) + 1
+            events.append({"ph": "M", "name": "thread_name", "pid": record["pid"], "tid": tids[key],
+                           "args": {"name": record["thread"]}})
+        return {"pid": record["pid"], "tid": tids[key]}
+
+    def span(record, name, category, ts_start, ts_end, args):
+        events.append({"ph": "X", "name": name, "cat": category, "ts": ts_start, "dur": max(ts_end - ts_start, 0),
+                       "args": args, **track(record)})
+
+    for line in log_lines:
+        try:
+            record = json.loads(line)
+            ts = _trace_timestamp_us(record)
+        except (ValueError, KeyError, TypeError):
+            continue
+        data = record.get("data")
+        if not isinstance(data, dict) or "event" not in data:
+            continue
+        event = data["event"]
+        values = data.get("values")
+        args = {k: v for k, v in data.items() if k not in ("event", "context_name", "uid", "duration_ms")}
+        if event == "ctx_start":
+            context_starts[data["uid"]] = (record, ts)
+        elif event in ("ctx_end", "ctx_error", "ctx_exec"):
+            _, ts_start = context_starts.pop(data["uid"], (None, ts - data.get("duration_ms", 0) * 1000))
+            span(record, data["context_name"], "error" if event == "ctx_error" else "context", ts_start, ts, args)
+        elif event in ("fn_end", "fn_error"):
+            span(record, values["name"], "error" if event == "fn_error" else "function",
+                 ts - data.get("duration_ms", 0) * 1000, ts, args)
+        elif event == "trace_lock":
+            lock_name, state = values["lock_name"], values["state"]
+            # An RLock can be acquired again by the thread holding it, so keep a stack per thread and lock
+            starts = lock_starts.setdefault((record["pid"], record["thread"], lock_name), [])
+            if state == "waiting":
+                starts.append(ts)
+            elif state == "acquired_after_wait":
+                span(record, f"wait {lock_name}", "lock", starts.pop() if starts else ts, ts, values)
+                starts.append(ts)
+            elif state == "acquired":
+                starts.append(ts)
+            elif state == "released" and starts:
+                span(record, f"hold {lock_name}", "lock", starts.pop(), ts, values)
+        else:
+            events.append({"ph": "i", "s": "t", "name": event, "ts": ts, "args": args, **track(record)})
+
+    for record, ts in context_starts.values():
+        data = record["data"]
+        events.append({"ph": "B", "name": data["context_name"], "cat": "context", "ts": ts,
+                       "args": {k: v for k, v in data.items() if k not in ("event", "context_name", "uid")},
+                       **track(record)})
+    return events
+
+
+def write_chrome_trace(log_lines, output_file):
+    ''' Write the chrome_trace_events of log_lines to output_file as a Chrome Trace Event JSON object '''
+    json.dump({"traceEvents": chrome_trace_events(log_lines), "displayTimeUnit": "ms"}, output_file)
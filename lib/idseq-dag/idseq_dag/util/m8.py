@@ -2,18 +2,21 @@ import json
 import math
 import os
 import random
+import zlib
 
-from collections import Counter
 from collections import defaultdict
+from contextlib import ExitStack
 from typing import Iterable
 
+import numpy as np
+
 import idseq_dag.util.command as command
 import idseq_dag.util.lineage as lineage
 import idseq_dag.util.log as log
 
 from idseq_dag.util.count import READ_COUNTING_MODE, ReadCountingMode, get_read_cluster_size, load_duplicate_cluster_sizes
 from idseq_dag.util.dict import open_file_db_by_extension
-from idseq_dag.util.parsing import BlastnOutput6NTRerankedReader, BlastnOutput6Reader, BlastnOutput6Writer, HitSummaryMergedReader, HitSummaryReader, HitSummaryWriter
+from idseq_dag.util.parsing import BlastnOutput6BatchReader, BlastnOutput6NTRerankedReader, BlastnOutput6Reader, BlastnOutput6Writer, HitSummaryMergedReader, HitSummaryReader, HitSummaryWriter, sidecar_path
 
 # NT alginments with shorter length are associated with a high rate of false positives.
 # NR doesn't have this problem because Rapsearch2 contains an equivalent filter.
@@ -24,6 +27,43 @@ NT_MIN_ALIGNMENT_LEN = 36
 # This constant is hardcoded in at least 4 places in idseq-web.  TODO: Make it a DAG parameter.
 MIN_CONTIG_SIZE = 4
 
+# Number of distinct lineages whose result is memoized by the filters of build_should_keep_filter.
+DEFAULT_SHOULD_KEEP_CACHE_SIZE = 100_000
+
+# Bounds on the size of the filter of read ids that streaming hit calling uses to detect an
+# m8 that isn't grouped by read id.  Between them, the filter has a bit per byte of m8.
+MIN_SEEN_READS_FILTER_BITS = 2**20
+MAX_SEEN_READS_FILTER_BITS = 2**30
+
+
+class _SeenReadsFilter(object):
+    '''
+    A Bloom filter of read ids, in a fixed number of bits rather than memory that grows
+    with every read.  Never misses a read id that was added, but may report one that was
+    not, more likely the more read ids it holds per bit.
+    '''
+    NUM_HASHES = 7
+
+    def __init__(self, num_bits):
+        self.num_bits = 1 << max(3, (num_bits - 1).bit_length())
+        self.bits = bytearray(self.num_bits // 8)
+
+    def add(self, read_id):
+        ''' Adds read_id, and returns whether it may have been added before '''
+        # The bit positions of read_id are h1, h1 + h2, h1 + 2 * h2, ...
+        h = hash(read_id)
+        h1, h2 = h & 0xFFFFFFFF, ((h >> 32) & 0xFFFFFFFF) | 1
+        bits, mask = self.bits, self.num_bits - 1
+        seen = True
+        for _ in range(self.NUM_HASHES):
+            position = h1 & mask
+            byte, bit = position >> 3, 1 << (position & 7)
+            if not bits[byte] & bit:
+                seen = False
+                bits[byte] |= bit
+            h1 += h2
+        return seen
+
 
 def summarize_hits(hit_summary_file_path: str, min_reads_per_genus=0):
     ''' Parse the hit summary file from alignment and get the relevant into'''
@@ -69,7 +109,8 @@ def read_file_into_set(file_name):
 @command.run_in_subprocess
 def call_hits_m8(input_m8, lineage_map_path, accession2taxid_dict_path,
                  output_m8, output_summary, min_alignment_length,
-                 deuterostome_path, taxon_whitelist_path, taxon_blacklist_path):
+                 deuterostome_path, taxon_whitelist_path, taxon_blacklist_path,
+                 num_workers=1):
     """
     Determine the optimal taxon assignment for each read from the alignment
     results. When a read aligns to multiple distinct references, we need to
@@ -128,7 +169,22 @@ def call_hits_m8(input_m8, lineage_map_path, accession2taxid_dict_path,
         See:
         * http://www.metagenomics.wiki/tools/blast/blastn-output-format-6
         * http://www.metagenomics.wiki/tools/blast/evalue
+
+    - With num_workers > 1 the reads are partitioned into num_workers shards
+    by a stable hash of the read id, and each shard is called in its own
+    subprocess. The shard outputs are merged back into input order, so the
+    outputs are identical for any num_workers.
+
+    - The hit summary also gets a columnar sidecar (see parsing.sidecar_path)
+    that HitSummaryReader loads instead of parsing the TSV. The sharded path
+    merges it from the sidecars of the shards.
     """
+    if num_workers > 1:
+        _call_hits_m8_sharded(input_m8, lineage_map_path, accession2taxid_dict_path,
+                              output_m8, output_summary, min_alignment_length,
+                              deuterostome_path, taxon_whitelist_path, taxon_blacklist_path,
+                              num_workers)
+        return
     with open_file_db_by_extension(lineage_map_path, "lll") as lineage_map, \
          open_file_db_by_extension(accession2taxid_dict_path, "L") as accession2taxid_dict:  # noqa
         _call_hits_m8_work(input_m8, lineage_map, accession2taxid_dict,
@@ -136,157 +192,339 @@ def call_hits_m8(input_m8, lineage_map_path, accession2taxid_dict_path,
                            deuterostome_path, taxon_whitelist_path, taxon_blacklist_path)
 
 
+def _read_id_shard(read_id, num_shards):
+    # crc32 rather than hash() because str hashes are salted per process
+    return zlib.crc32(read_id.encode()) % num_shards
+
+
+def _call_hits_m8_sharded(input_m8, lineage_map_path, accession2taxid_dict_path,
+                          output_m8, output_summary, min_alignment_length,
+                          deuterostome_path, taxon_whitelist_path, taxon_blacklist_path,
+                          num_shards):
+    shard_inputs = [f"{output_m8}.shard_{num_shards}_{shard}.input" for shard in range(num_shards)]
+    shard_m8s = [f"{output_m8}.shard_{num_shards}_{shard}" for shard in range(num_shards)]
+    shard_summaries = [f"{output_summary}.shard_{num_shards}_{shard}" for shard in range(num_shards)]
+
+    try:
+        # Every alignment of a read lands in the same shard, in input order, so a
+        # shard is grouped by read id whenever the input is.
+        with log.log_context("call_hits_m8", {"substep": "partition", "num_shards": num_shards}):
+            with open(input_m8) as input_f, ExitStack() as stack:
+                shard_fs = [stack.enter_context(open(shard_input, "w")) for shard_input in shard_inputs]
+                for line in input_f:
+                    if line.startswith("#"):
+                        continue
+                    shard_fs[_read_id_shard(line[:line.find("\t")], num_shards)].write(line)
+
+        # Each worker opens the lineage map and accession2taxid dict once, for all the shards it calls
+        with command.WorkerPool(num_shards, _open_hit_calling_dbs, (lineage_map_path, accession2taxid_dict_path)) as pool, \
+                command.LongRunningCodeSection("call_hits_m8.worker_pool"):  # noqa
+            pool.map(_call_hits_shard, [(shard_input, shard_m8, shard_summary, min_alignment_length,
+                                         deuterostome_path, taxon_whitelist_path, taxon_blacklist_path)
+                                        for shard_input, shard_m8, shard_summary in zip(shard_inputs, shard_m8s, shard_summaries)])
+
+        with log.log_context("call_hits_m8", {"substep": "merge", "num_shards": num_shards}):
+            _merge_hit_shards(input_m8, shard_m8s, shard_summaries, output_m8, output_summary, min_alignment_length)
+    finally:
+        # Including the partial scratch files of a failed run
+        for path in shard_inputs + shard_m8s + shard_summaries + [sidecar_path(path) for path in shard_summaries]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _open_hit_calling_dbs(lineage_map_path, accession2taxid_dict_path):
+    return {
+        "lineage_map": open_file_db_by_extension(lineage_map_path, "lll"),
+        "accession2taxid_dict": open_file_db_by_extension(accession2taxid_dict_path, "L"),
+    }
+
+
+def _call_hits_shard(shard_args):
+    shard_input, shard_m8, shard_summary, min_alignment_length, deuterostome_path, taxon_whitelist_path, taxon_blacklist_path = shard_args
+    _call_hits_m8_work(shard_input, command.worker_resource("lineage_map"), command.worker_resource("accession2taxid_dict"),
+                       shard_m8, shard_summary, min_alignment_length,
+                       deuterostome_path, taxon_whitelist_path, taxon_blacklist_path)
+
+
+def _merge_hit_shards(input_m8, shard_m8s, shard_summaries, output_m8, output_summary, min_alignment_length):
+    """Interleave the per-shard outputs of _call_hits_m8_work in the order an
+    unsharded run would have emitted them, i.e. by the input position of each
+    emitted alignment. Each shard emits at most one alignment per read, in input
+    order, so only the next pending row of each shard needs to be considered.
+    The first valid input row of a read with the emitted subject and bitscore
+    is the one that was emitted. The hit summary rows are read from the shards'
+    sidecars and written like an unsharded run writes them, sidecar included.
+    """
+    # newline="" copies the writers' line endings through unchanged
+    with open(input_m8) as input_f, open(output_m8, "w", newline="") as output_m8_f, \
+            open(output_summary, "w") as output_summary_f, ExitStack() as stack:  # noqa
+        shard_m8_fs = [stack.enter_context(open(path, newline="")) for path in shard_m8s]
+        shard_summary_readers = [HitSummaryReader(stack.enter_context(open(path))) for path in shard_summaries]
+        hit_summary_writer = stack.enter_context(HitSummaryWriter(output_summary_f, sidecar=True))
+
+        pending = {}  # read_id => (shard, m8 line, fields of m8 line)
+
+        def advance(shard):
+            m8_line = shard_m8_fs[shard].readline()
+            if m8_line:
+                fields = m8_line.rstrip("\r\n").split("\t")
+                pending[fields[0]] = (shard, m8_line, fields)
+
+        for shard in range(len(shard_m8s)):
+            advance(shard)
+
+        for line in input_f:
+            read_id = line[:line.find("\t")]
+            if read_id not in pending:
+                continue
+            shard, m8_line, fields = pending[read_id]
+            input_fields = line.rstrip("\r\n").split("\t")
+            if input_fields[1] != fields[1] or float(input_fields[11]) != float(fields[11]):
+                continue
+            if next(BlastnOutput6Reader([line], filter_invalid=True, min_alignment_length=min_alignment_length), None) is None:
+                continue
+            output_m8_f.write(m8_line)
+            hit_summary_writer.writerow(next(shard_summary_readers[shard]))
+            del pending[read_id]
+            advance(shard)
+
+        assert not pending, f"hits for reads {list(pending)[:10]} were not found in {input_m8}"
+
+
+class _LineageTable:
+    """Dense int32 table of accession => (species, genus, family) taxids.
+    Accessions are interned to consecutive row indices the first time they are
+    seen, so each distinct accession is resolved through the accession2taxid
+    and lineage dbs exactly once and the per-alignment work is integer
+    indexing. This resolves accessions lazily instead of in a separate prepass
+    over the m8, so streaming hit calling still reads its input only once.
+    """
+
+    def __init__(self, lineage_map, accession2taxid_dict, initial_capacity=1024):
+        self.lineage_map = lineage_map
+        self.accession2taxid_dict = accession2taxid_dict
+        self.index = {}  # accession id => row in table
+        self.accessions = []  # row in table => accession id
+        self.table = np.empty((initial_capacity, len(lineage.NULL_LINEAGE)), dtype=np.int32)
+
+    def intern(self, accession_id):
+        idx = self.index.get(accession_id)
+        if idx is None:
+            idx = len(self.accessions)
+            if idx == len(self.table):
+                self.table = np.concatenate([self.table, np.empty_like(self.table)])
+            accession_taxid = self.accession2taxid_dict.get(
+                accession_id.split(".")[0], "NA")
+            lineage_taxids = self.lineage_map.get(accession_taxid, lineage.NULL_LINEAGE)
+            self.table[idx] = [int(taxid) for taxid in lineage_taxids]
+            self.index[accession_id] = idx
+            self.accessions.append(accession_id)
+        return idx
+
+    def intern_all(self, accession_ids):
+        idxs = list(map(self.index.get, accession_ids))
+        if None in idxs:
+            idxs = [self.intern(accession_id) if idx is None else idx for idx, accession_id in zip(idxs, accession_ids)]
+        return np.array(idxs, dtype=np.int64)
+
+    def species_taxid(self, idx):
+        return int(self.table[idx, 0])
+
+    def lineage(self, accession_id):
+        return tuple(str(taxid) for taxid in self.table[self.index[accession_id]].tolist())
+
+
 def _call_hits_m8_work(input_blastn_6_path, lineage_map, accession2taxid_dict,
                        output_blastn_6_path, output_summary, min_alignment_length,
-                       deuterostome_path, taxon_whitelist_path, taxon_blacklist_path):
-    lineage_cache = {}
+                       deuterostome_path, taxon_whitelist_path, taxon_blacklist_path,
+                       streaming=True):
+    lineages = _LineageTable(lineage_map, accession2taxid_dict)
 
     should_keep = build_should_keep_filter(
         deuterostome_path, taxon_whitelist_path, taxon_blacklist_path)
 
     # Helper functions
-    def get_lineage(accession_id):
-        """Find the lineage of the accession ID and utilize a cache for
-        performance by reducing random IOPS, ameliorating a key performance
-        bottleneck
-        """
-        if accession_id in lineage_cache:
-            return lineage_cache[accession_id]
-        accession_taxid = accession2taxid_dict.get(
-            accession_id.split(".")[0], "NA")
-        result = lineage_map.get(accession_taxid, lineage.NULL_LINEAGE)
-        lineage_cache[accession_id] = result
-        return result
-
-    def accumulate(hits, accession_id):
-        """Accumulate hits for summarizing hit information and specificity at
-        each taxonomy level.
-        """
-        lineage_taxids = get_lineage(accession_id)
-        for level, taxid_at_level in enumerate(lineage_taxids):
-            if int(taxid_at_level) < 0:
+    def call_hit_level_v2(read_id, accession_idxs, species_taxids):
+        ''' Always call hit at the species level with the taxid with most matches.
+
+        accession_idxs are the interned accessions of the read's best-scoring
+        alignments, in input order, and species_taxids their species taxids.
+        '''
+        species_counts = {}  # species taxid => number of best hits, in order of first appearance
+        for species_taxid in species_taxids:
+            if species_taxid < 0:
                 # Skip if we have a negative taxid. When an accession doesn't
                 # provide species level info, it doesn't contradict any info
                 # provided by other accessions. This occurs a lot and
                 # handling it in this way seems to work well.
                 continue
-            accession_list = hits[level].get(
-                taxid_at_level, []) + [accession_id]
-            hits[level][taxid_at_level] = accession_list
-
-    def most_frequent_accession(accession_list):
-        counts = Counter(accession_list)
-        return counts.most_common(1)[0][0]
-
-    # FIXME: https://jira.czi.team/browse/IDSEQ-2738
-    #  We want to move towards a general randomness solution in which
-    #  all randomness is seeded based on the content of the original input.
-    #  This is currently introducing non-determinism and hard coding
-    #  an arbitrary seed here shouldn't impact correctness. This is only used
-    #  to break ties.
-    randgen = random.Random(x=4)  # chosen by fair dice role, guaranteed to be random
-
-    def call_hit_level_v2(hits):
-        ''' Always call hit at the species level with the taxid with most matches '''
-        species_level_hits = hits[0]
-        max_match = 0
-        taxid_candidates = []
-        for taxid, accession_list in species_level_hits.items():
-            accession_len = len(accession_list)
-            if accession_len > max_match:
-                taxid_candidates = [taxid]
-                max_match = accession_len
-            elif accession_len == max_match:
-                taxid_candidates.append(taxid)
-        if max_match > 0:
-            selected_taxid = taxid_candidates[0]
-            if len(taxid_candidates) > 1:
-                selected_taxid = randgen.sample(taxid_candidates, 1)[0]
-            accession_id = most_frequent_accession(
-                species_level_hits[selected_taxid])
-            return 1, selected_taxid, accession_id
-        return -1, "-1", None
+            species_counts[species_taxid] = species_counts.get(species_taxid, 0) + 1
+        if not species_counts:
+            return -1, "-1", None
+        max_match = max(species_counts.values())
+        taxid_candidates = [taxid for taxid, count in species_counts.items() if count == max_match]
+        selected_taxid = taxid_candidates[0]
+        if len(taxid_candidates) > 1:
+            # Ties are broken with a generator seeded by the read id, so the call for a
+            # read does not depend on which reads were called before it (or in which shard).
+            selected_taxid = random.Random(read_id).sample(taxid_candidates, 1)[0]
+        # The most frequent accession of the selected taxid, the first one seen wins ties
+        accession_counts = {}
+        for idx, species_taxid in zip(accession_idxs, species_taxids):
+            if species_taxid == selected_taxid:
+                accession_counts[idx] = accession_counts.get(idx, 0) + 1
+        accession_idx = max(accession_counts, key=accession_counts.__getitem__)
+        return 1, str(selected_taxid), lineages.accessions[accession_idx]
+
+    # Emit the hit with the best value that provides the most specific
+    # taxonomy information. If there are multiple hits (also called multiple
+    # accession IDs) for a given read that all have the same e-value, some
+    # may provide species information and some may only provide genus
+    # information. We want to emit the one that provides the species
+    # information because from that we can infer the rest of the lineage. If
+    # we accidentally emitted the one that provided only genus info,
+    # downstream steps may have difficulty recovering the species.
+
+    # TODO: Consider all hits within a fixed margin of the best e-value.
+    # This change may need to be accompanied by a change to
+    # GSNAP/RAPSearch2 parameters.
+    def is_best_row(row, best_bitscore, hit_call):
+        _, taxid, best_accession_id = hit_call
+        return row["bitscore"] == best_bitscore and best_accession_id in (None, row["sseqid"]) and should_keep([taxid])
+
+    def write_hit(blastn_6_writer, hit_summary_writer, row, hit_call):
+        hit_level, taxid, best_accession_id = hit_call
+        blastn_6_writer.writerow(row)
+        species_taxid = -1
+        genus_taxid = -1
+        family_taxid = -1
+        if best_accession_id != None:
+            (species_taxid, genus_taxid, family_taxid) = lineages.lineage(best_accession_id)
+
+        hit_summary_writer.writerow({
+            "read_id": row["qseqid"],
+            "level": hit_level,
+            "taxid": taxid,
+            "accession_id": best_accession_id,
+            "species_taxid": species_taxid,
+            "genus_taxid": genus_taxid,
+            "family_taxid": family_taxid,
+        })
+
+    LOG_INCREMENT = 50000
+
+    def call_hits_streaming():
+        """Single pass over an m8 whose rows are grouped by read id, which is how
+        our aligners emit them. Each read is called and written as soon as its
+        group closes, so the rows held in memory are the best-scoring rows of
+        one read, along with a fixed-size filter of the read ids seen so far.
+        Returns False as soon as the filter reports that a read id may have
+        shown up in an earlier group, leaving the outputs incomplete; the
+        caller must fall back to the two-pass path in that case. Rarely, for
+        very large inputs, that is a false alarm for grouped input.
+        """
+        seen_reads = _SeenReadsFilter(min(max(os.path.getsize(input_blastn_6_path), MIN_SEEN_READS_FILTER_BITS),
+                                          MAX_SEEN_READS_FILTER_BITS))
+        count = 0
+        log.write(f"Starting to call hits from {input_blastn_6_path} in a single pass.")
+        with open(output_blastn_6_path, "w") as blastn_6_out_f, open(output_summary, "w") as hit_summary_out_f, open(input_blastn_6_path) as input_blastn_6_f, \
+                HitSummaryWriter(hit_summary_out_f, sidecar=True) as hit_summary_writer:
+            blastn_6_writer = BlastnOutput6Writer(blastn_6_out_f)
+
+            def close_group(read_id, best_bitscore, best_rows):
+                hit_call = call_hit_level_v2(read_id, [idx for idx, _, _ in best_rows], [species for _, species, _ in best_rows])
+                for _, _, row in best_rows:
+                    if is_best_row(row, best_bitscore, hit_call):
+                        write_hit(blastn_6_writer, hit_summary_writer, row, hit_call)
+                        break
+
+            current_read_id = None
+            best_bitscore, best_rows = float("-inf"), []  # best_rows holds (accession idx, species taxid, row)
+            for batch in BlastnOutput6BatchReader(input_blastn_6_f, filter_invalid=True, min_alignment_length=min_alignment_length):
+                columns = {field: column if isinstance(column, list) else column.tolist() for field, column in batch.items()}
+                accession_idxs = lineages.intern_all(columns["sseqid"])
+                species_taxids = lineages.table[accession_idxs, 0].tolist()
+                accession_idxs = accession_idxs.tolist()
+                for i, (read_id, bitscore) in enumerate(zip(columns["qseqid"], columns["bitscore"])):
+                    if read_id != current_read_id:
+                        if current_read_id is not None:
+                            close_group(current_read_id, best_bitscore, best_rows)
+                        if seen_reads.add(read_id):
+                            log.write(f"{input_blastn_6_path} may not be grouped by read id, read {read_id} may appear in more than one group.")
+                            return False
+                        current_read_id = read_id
+                        best_bitscore, best_rows = float("-inf"), []
+                    # The Expect value (E) is a parameter that describes the number of
+                    # hits one can 'expect' to see by chance when searching a database of
+                    # a particular size. It decreases exponentially as the Score (S) of
+                    # the match increases. Essentially, the E value describes the random
+                    # background noise. https://blast.ncbi.nlm.nih.gov/Blast.cgi?CMD=Web
+                    # &PAGE_TYPE=BlastDocs&DOC_TYPE=FAQ
+                    # We have since moved to using the bitscore rather than the e-value
+                    if bitscore >= best_bitscore:
+                        row = {field: column[i] for field, column in columns.items()}
+                        if bitscore > best_bitscore:
+                            # If we find a new better bitscore we want to start accumulation over
+                            best_bitscore, best_rows = bitscore, []
+                        # If we find another accession with the same bitscore we want to accumulate it
+                        best_rows.append((accession_idxs[i], species_taxids[i], row))
+                count += len(columns["qseqid"])
+                if count // LOG_INCREMENT > (count - len(columns["qseqid"])) // LOG_INCREMENT:
+                    log.write(f"Called hits for {count} rows from {input_blastn_6_path}, and counting.")
+            if current_read_id is not None:
+                close_group(current_read_id, best_bitscore, best_rows)
+        log.write(f"Called hits for all {count} rows from {input_blastn_6_path}.")
+        return True
+
+    if streaming:
+        if call_hits_streaming():
+            return
+        log.write(f"Falling back to two-pass hit calling for {input_blastn_6_path}.")
 
     # Deduplicate m8 and summarize hits
-    summary = {}
+    summary = {}  # read_id => (best bitscore, accession idxs of best hits)
     count = 0
-    LOG_INCREMENT = 50000
     log.write(f"Starting to summarize hits from {input_blastn_6_path}.")
     with open(input_blastn_6_path) as input_blastn_6_f:
         for row in BlastnOutput6Reader(input_blastn_6_f, filter_invalid=True, min_alignment_length=min_alignment_length):
             read_id, accession_id, bitscore = row["qseqid"], row["sseqid"], row["bitscore"]
-            # The Expect value (E) is a parameter that describes the number of
-            # hits one can 'expect' to see by chance when searching a database of
-            # a particular size. It decreases exponentially as the Score (S) of
-            # the match increases. Essentially, the E value describes the random
-            # background noise. https://blast.ncbi.nlm.nih.gov/Blast.cgi?CMD=Web
-            # &PAGE_TYPE=BlastDocs&DOC_TYPE=FAQ
-            # We have since moved to using the bitscore rather than the e-value
-            my_best_bitscore, hits, _ = summary.get(read_id, (float("-inf"), [{}, {}, {}], None))
+            my_best_bitscore, accession_idxs = summary.get(read_id, (float("-inf"), []))
             if my_best_bitscore < bitscore:
                 # If we find a new better bitscore we want to start accumulation over
-                hits = [{}, {}, {}]
-                accumulate(hits, accession_id)
-                my_best_bitscore = bitscore
+                my_best_bitscore, accession_idxs = bitscore, [lineages.intern(accession_id)]
             elif my_best_bitscore == bitscore:
                 # If we find another accession with the same bitscore we want to accumulate it
-                accumulate(hits, accession_id)
-            summary[read_id] = my_best_bitscore, hits, call_hit_level_v2(hits)
+                accession_idxs.append(lineages.intern(accession_id))
+            summary[read_id] = my_best_bitscore, accession_idxs
             count += 1
             if count % LOG_INCREMENT == 0:
                 log.write(f"Summarized hits for {count} read ids from {input_blastn_6_path}, and counting.")
 
     log.write(f"Summarized hits for all {count} read ids from {input_blastn_6_path}.")
+    # Call each read once all of its alignments have been seen, in order of first appearance
+    for read_id, (best_bitscore, accession_idxs) in summary.items():
+        species_taxids = [lineages.species_taxid(idx) for idx in accession_idxs]
+        summary[read_id] = best_bitscore, call_hit_level_v2(read_id, accession_idxs, species_taxids)
 
     # Generate output files. outf is the main output_m8 file and outf_sum is
     # the summary level info.
     emitted = set()
-    with open(output_blastn_6_path, "w") as blastn_6_out_f, open(output_summary, "w") as hit_summary_out_f, open(input_blastn_6_path) as input_blastn_6_f:
+    with open(output_blastn_6_path, "w") as blastn_6_out_f, open(output_summary, "w") as hit_summary_out_f, open(input_blastn_6_path) as input_blastn_6_f, \
+            HitSummaryWriter(hit_summary_out_f, sidecar=True) as hit_summary_writer:
         blastn_6_writer = BlastnOutput6Writer(blastn_6_out_f)
-        hit_summary_writer = HitSummaryWriter(hit_summary_out_f)
-        # Iterator over the lines of the m8 file. Emit the hit with the
-        # best value that provides the most specific taxonomy
-        # information. If there are multiple hits (also called multiple
-        # accession IDs) for a given read that all have the same e-value,
-        # some may provide species information and some may only provide
-        # genus information. We want to emit the one that provides the
-        # species information because from that we can infer the rest of
-        # the lineage. If we accidentally emitted the one that provided
-        # only genus info, downstream steps may have difficulty
-        # recovering the species.
-
-        # TODO: Consider all hits within a fixed margin of the best e-value.
-        # This change may need to be accompanied by a change to
-        # GSNAP/RAPSearch2 parameters.
+        # Iterator over the lines of the m8 file.
         for row in BlastnOutput6Reader(input_blastn_6_f, filter_invalid=True, min_alignment_length=min_alignment_length):
-            read_id, accession_id, bitscore = row["qseqid"], row["sseqid"], row["bitscore"]
+            read_id = row["qseqid"]
             if read_id in emitted:
                 continue
 
             # Read the fields from the summary level info
-            best_bitscore, _, (hit_level, taxid,
-                               best_accession_id) = summary[read_id]
-            if best_bitscore == bitscore and best_accession_id in (None, accession_id) and should_keep([taxid]):
+            best_bitscore, hit_call = summary[read_id]
+            if is_best_row(row, best_bitscore, hit_call):
                 # Read out the hit with the best value that provides the
                 # most specific taxonomy information.
                 emitted.add(read_id)
-                blastn_6_writer.writerow(row)
-                species_taxid = -1
-                genus_taxid = -1
-                family_taxid = -1
-                if best_accession_id != None:
-                    (species_taxid, genus_taxid, family_taxid) = get_lineage(
-                        best_accession_id)
-
-                hit_summary_writer.writerow({
-                    "read_id": read_id,
-                    "level": hit_level,
-                    "taxid": taxid,
-                    "accession_id": best_accession_id,
-                    "species_taxid": species_taxid,
-                    "genus_taxid": genus_taxid,
-                    "family_taxid": family_taxid,
-                })
+                write_hit(blastn_6_writer, hit_summary_writer, row, hit_call)
 
 
 @command.run_in_subprocess
@@ -388,72 +626,87 @@ def generate_taxon_count_json_from_m8(
                         # Chomp off the lowest rank as we aggregate up the tree
                         agg_key = agg_key[1:]
 
-    # Produce the final output
-    taxon_counts_attributes = []
-    with log.log_context("generate_taxon_count_json_from_m8", {"substep": "loop_2"}):
-        for agg_key, agg_bucket in aggregation.items():
-            unique_count = agg_bucket['unique_count']
-            nonunique_count = agg_bucket['nonunique_count']
-            tax_level = num_ranks - len(agg_key) + 1
-            # TODO: Extend taxonomic ranks as indicated on the commented out lines.
-            taxon_counts_row = {
-                "tax_id":
-                agg_key[0],
-                "tax_level":
-                tax_level,
-                # 'species_taxid' : agg_key[tax_level - 1] if tax_level == 1 else "-100",
-                'genus_taxid':
-                agg_key[2 - tax_level] if tax_level <= 2 else "-200",
-                'family_taxid':
-                agg_key[3 - tax_level] if tax_level <= 3 else "-300",
-                # 'order_taxid' : agg_key[4 - tax_level] if tax_level <= 4 else "-400",
-                # 'class_taxid' : agg_key[5 - tax_level] if tax_level <= 5 else "-500",
-                # 'phyllum_taxid' : agg_key[6 - tax_level] if tax_level <= 6 else "-600",
-                # 'kingdom_taxid' : agg_key[7 - tax_level] if tax_level <= 7 else "-700",
-                # 'domain_taxid' : agg_key[8 - tax_level] if tax_level <= 8 else "-800",
-                "count":  # this field will be consumed by the webapp
-                nonunique_count if READ_COUNTING_MODE == ReadCountingMode.COUNT_ALL else unique_count,
-                "nonunique_count":
-                nonunique_count,
-                "unique_count":
-                unique_count,
-                "dcr":
-                nonunique_count / unique_count,
-                "percent_identity":
-                agg_bucket['sum_percent_identity'] / unique_count,
-                "alignment_length":
-                agg_bucket['sum_alignment_length'] / unique_count,
-                "e_value":
-                agg_bucket['sum_e_value'] / unique_count,
-                "count_type":
-                count_type,
-                "base_count":
-                agg_bucket["base_count"],
-            }
-            if agg_bucket.get('source_count_type'):
-                taxon_counts_row['source_count_type'] = sorted(list(agg_bucket['source_count_type']))
-
-            taxon_counts_attributes.append(taxon_counts_row)
-        output_dict = {
-            "pipeline_output": {
-                "taxon_counts_attributes": taxon_counts_attributes
-            }
-        }
-
+    # Produce the final output, one taxon at a time, without materializing the list of output rows
     with log.log_context(
         "generate_taxon_count_json_from_m8",
-        {"substep": "json_dump", "output_json_file": output_json_file}
+        {"substep": "loop_2", "output_json_file": output_json_file}
     ):
         with open(output_json_file, 'w') as outf:
-            json.dump(output_dict, outf)
+            _write_taxon_counts_json(outf, _taxon_counts_rows(aggregation, num_ranks, count_type))
             outf.flush()
 
 
+def _taxon_counts_rows(aggregation, num_ranks, count_type):
+    for agg_key, agg_bucket in aggregation.items():
+        unique_count = agg_bucket['unique_count']
+        nonunique_count = agg_bucket['nonunique_count']
+        tax_level = num_ranks - len(agg_key) + 1
+        # TODO: Extend taxonomic ranks as indicated on the commented out lines.
+        taxon_counts_row = {
+            "tax_id":
+            agg_key[0],
+            "tax_level":
+            tax_level,
+            # 'species_taxid' : agg_key[tax_level - 1] if tax_level == 1 else "-100",
+            'genus_taxid':
+            agg_key[2 - tax_level] if tax_level <= 2 else "-200",
+            'family_taxid':
+            agg_key[3 - tax_level] if tax_level <= 3 else "-300",
+            # 'order_taxid' : agg_key[4 - tax_level] if tax_level <= 4 else "-400",
+            # 'class_taxid' : agg_key[5 - tax_level] if tax_level <= 5 else "-500",
+            # 'phyllum_taxid' : agg_key[6 - tax_level] if tax_level <= 6 else "-600",
+            # 'kingdom_taxid' : agg_key[7 - tax_level] if tax_level <= 7 else "-700",
+            # 'domain_taxid' : agg_key[8 - tax_level] if tax_level <= 8 else "-800",
+            "count":  # this field will be consumed by the webapp
+            nonunique_count if READ_COUNTING_MODE == ReadCountingMode.COUNT_ALL else unique_count,
+            "nonunique_count":
+            nonunique_count,
+            "unique_count":
+            unique_count,
+            "dcr":
+            nonunique_count / unique_count,
+            "percent_identity":
+            agg_bucket['sum_percent_identity'] / unique_count,
+            "alignment_length":
+            agg_bucket['sum_alignment_length'] / unique_count,
+            "e_value":
+            agg_bucket['sum_e_value'] / unique_count,
+            "count_type":
+            count_type,
+            "base_count":
+            agg_bucket["base_count"],
+        }
+        if agg_bucket.get('source_count_type'):
+            taxon_counts_row['source_count_type'] = sorted(list(agg_bucket['source_count_type']))
+        yield taxon_counts_row
+
+
+def _write_taxon_counts_json(outf, taxon_counts_rows: Iterable[dict]):
+    '''
+    Write {"pipeline_output": {"taxon_counts_attributes": [...]}} to outf, serializing
+    one row at a time. The output is the same as json.dump of the whole structure.
+    '''
+    outf.write('{"pipeline_output": {"taxon_counts_attributes": [')
+    separator = ""
+    for taxon_counts_row in taxon_counts_rows:
+        outf.write(separator)
+        outf.write(json.dumps(taxon_counts_row))
+        separator = ", "
+    outf.write(']}}')
+
+
 def build_should_keep_filter(
     deuterostome_path,
     taxon_whitelist_path,
-    taxon_blacklist_path
+    taxon_blacklist_path,
+    cache_size=DEFAULT_SHOULD_KEEP_CACHE_SIZE
 ):
+    '''
+    Returns should_keep(hits), which is False if any taxid in hits is on the deny-lists
+    or, given an allow-list, if none of them is on it. Results are memoized per distinct
+    hits tuple, up to cache_size of them, since most reads repeat a lineage seen before.
+    The memo is cleared when full. cache_size=0 disables it.
+    '''
 
     # See also HOMO_SAPIENS_TAX_IDS in idseq-web
     taxids_to_remove = set(['9605', '9606'])
@@ -484,11 +737,26 @@ def build_should_keep_filter(
                 return True
         return False
 
-    def should_keep(hits: Iterable[str]):
+    def compute_should_keep(hits: Iterable[str]):
         # In some places in the code taxids are ints rather than strings, this would lead
         # to a silent failure here so it is worth the explicit check.
         non_strings = [h for h in hits if not isinstance(h, str)]
         assert not non_strings, f"should_keep recieved non-string inputs {non_strings}"
         return is_whitelisted(hits) and not is_blacklisted(hits)
 
+    if not cache_size:
+        return compute_should_keep
+
+    cache = {}  # hits tuple => should_keep result
+
+    def should_keep(hits: Iterable[str]):
+        key = tuple(hits)
+        result = cache.get(key)
+        if result is None:
+            result = compute_should_keep(key)
+            if len(cache) >= cache_size:
+                cache.clear()
+            cache[key] = result
+        return result
+
     return should_keep
@@ -1,10 +1,19 @@
+import os
+import zipfile
+
 from csv import DictReader, DictWriter
-from typing import Any, Dict, Iterable, Iterator, Sequence, Text, Tuple
+from itertools import islice, repeat
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Text, Tuple, Union
+
+import numpy as np
 
 # Alignments with e-values greater than 1 are low-quality alignments and associated with
 # a high rate of false-positives. These should be filtered at all alignment steps.
 MAX_EVALUE_THRESHOLD = 1
 
+# Number of rows per batch returned by the columnar blast6 readers
+DEFAULT_BATCH_SIZE = 65536
+
 
 class _TypedDictTSVReader(Iterator[Dict[str, Any]]):
     """
@@ -38,6 +47,205 @@ class _TypedDictTSVWriter(DictWriter):
         super().__init__(f, fieldnames, delimiter="\t")
 
 
+def sidecar_path(tsv_path: str) -> str:
+    """Path of the columnar sidecar that _SidecarTSVWriter writes next to tsv_path"""
+    return tsv_path + ".npz"
+
+
+def _file_path(f: Any):
+    """Path of f if it is a file object for a regular file, positioned at its start"""
+    name = getattr(f, "name", None)
+    try:
+        if isinstance(name, str) and f.tell() == 0 and os.path.isfile(name):
+            return name
+    except (AttributeError, OSError, ValueError):
+        pass
+    return None
+
+
+class _ColumnarSidecarWriter:
+    """
+    Writes rows to an .npz archive with one member per column and chunk of chunk_size
+    rows. A chunk of a column whose values are all ints is stored as an array of the
+    narrowest signed integer type that holds them and one whose values are all floats
+    as a float64 array. Any other chunk holds the text
+    DictWriter writes for its values, as utf-8 joined with tabs, so loading it takes a
+    single decode and split. The archive also records the field names, the number of
+    rows in each chunk and the size and mtime of the TSV it mirrors, which readers check
+    before using it. It is written under a temporary name and moved into place by close().
+    """
+    def __init__(self, path: str, fieldnames: Sequence[str], chunk_size: int = DEFAULT_BATCH_SIZE) -> None:
+        self._path = path
+        self._tmp_path = path + ".tmp"
+        self._fieldnames = list(fieldnames)
+        self._chunk_size = chunk_size
+        self._columns: List[List[Any]] = [[] for _ in self._fieldnames]
+        self._chunk_rows: List[int] = []
+        # Stored uncompressed, like np.savez
+        self._zip = zipfile.ZipFile(self._tmp_path, "w", allowZip64=True)
+
+    def append(self, rowdict: Dict[str, Any]) -> None:
+        for field, column in zip(self._fieldnames, self._columns):
+            column.append(rowdict.get(field))
+        if len(self._columns[0]) == self._chunk_size:
+            self._flush()
+
+    def _write_array(self, name: str, array: np.ndarray) -> None:
+        with self._zip.open(name + ".npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array(f, array, allow_pickle=False)
+
+    @staticmethod
+    def _column_array(column: List[Any]):
+        """column as an integer or float64 array, or None if it has values of other types"""
+        if all(isinstance(value, (int, np.integer)) and not isinstance(value, bool) for value in column):
+            try:
+                array = np.array(column, dtype=np.int64)
+            except OverflowError:
+                return None
+            low, high = array.min(), array.max()
+            dtype = next(dtype for dtype in (np.int8, np.int16, np.int32, np.int64)
+                         if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max)
+            return array.astype(dtype)
+        if all(isinstance(value, (float, np.floating)) for value in column):
+            return np.array(column, dtype=np.float64)
+        return None
+
+    def _flush(self) -> None:
+        chunk = len(self._chunk_rows)
+        for field, column in zip(self._fieldnames, self._columns):
+            array = self._column_array(column)
+            if array is None:
+                # The same text DictWriter writes to the TSV
+                text = "\t".join("" if value is None else str(value) for value in column)
+                assert text.count("\t") == len(column) - 1, f"a value of {field} in chunk {chunk} contains a tab"
+                array = np.frombuffer(text.encode(), dtype=np.uint8)
+            self._write_array(f"{field}.{chunk}", array)
+        self._chunk_rows.append(len(self._columns[0]))
+        for column in self._columns:
+            column.clear()
+
+    def close(self, tsv_size: int, tsv_mtime_ns: int) -> None:
+        if self._columns[0]:
+            self._flush()
+        self._write_array("fieldnames", np.array(self._fieldnames))
+        self._write_array("chunk_rows", np.array(self._chunk_rows, dtype=np.int64))
+        self._write_array("tsv_stat", np.array([tsv_size, tsv_mtime_ns], dtype=np.int64))
+        self._zip.close()
+        os.replace(self._tmp_path, self._path)
+
+    def discard(self) -> None:
+        self._zip.close()
+        os.remove(self._tmp_path)
+
+
+def _read_sidecar(tsv_path: str, fieldnames: Sequence[str], types: Sequence[type] = None):
+    """
+    Iterator over the rows of the sidecar of tsv_path as dicts, or None if there is no
+    sidecar that is current for the TSV and has a prefix of fieldnames as its fields.
+    With types, the values are converted to them the way _TypedDictTSVReader converts
+    the values of the TSV, otherwise they are the values _ColumnarSidecarWriter stored:
+    ints and floats for the columns it stored as numbers and str for the others.
+    """
+    path = sidecar_path(tsv_path)
+    if not os.path.isfile(path):
+        return None
+    npz = np.load(path, allow_pickle=False)
+    tsv_stat = os.stat(tsv_path)
+    sidecar_fieldnames = npz["fieldnames"].tolist()
+    if npz["tsv_stat"].tolist() != [tsv_stat.st_size, tsv_stat.st_mtime_ns] or \
+            list(fieldnames[:len(sidecar_fieldnames)]) != sidecar_fieldnames:
+        npz.close()
+        return None
+    return _sidecar_rows(npz, sidecar_fieldnames, fieldnames, types)
+
+
+def _sidecar_column(array: np.ndarray, _type: type = None) -> List[Any]:
+    if array.dtype == np.uint8:
+        values = array.tobytes().decode().split("\t")
+        if _type is None or _type is str:
+            return values
+        return [_type(value) if value else value for value in values]
+    values = array.tolist()
+    if _type is None or (_type, array.dtype.kind) in ((int, "i"), (float, "f")):
+        return values
+    if _type is str:
+        return list(map(str, values))
+    return [_type(str(value)) for value in values]
+
+
+def _sidecar_rows(npz, sidecar_fieldnames: Sequence[str], fieldnames: Sequence[str],
+                  types: Sequence[type] = None) -> Iterator[Dict[str, Any]]:
+    # Like DictReader, fields missing from a row are None
+    missing = (None,) * (len(fieldnames) - len(sidecar_fieldnames))
+    types = types or repeat(None)
+    with npz:
+        for chunk, num_rows in enumerate(npz["chunk_rows"].tolist()):
+            columns = [_sidecar_column(npz[f"{field}.{chunk}"], _type) for field, _type in zip(sidecar_fieldnames, types)]
+            assert all(len(column) == num_rows for column in columns), f"chunk {chunk} of {npz.fid.name} is corrupt"
+            for values in zip(*columns):
+                yield dict(zip(fieldnames, values + missing))
+
+
+class _SidecarTSVReader(_TypedDictTSVReader):
+    """
+    _TypedDictTSVReader that reads the rows from the columnar sidecar written by
+    _SidecarTSVWriter instead of the TSV, when f is a file with a current sidecar.
+    The rows are the same either way.
+    """
+    def __init__(self, f: Iterable[Text], schema: Sequence[Tuple[str, type]]) -> None:
+        super().__init__(f, schema)
+        path = _file_path(f)
+        self._sidecar_rows = path and _read_sidecar(path, [field for field, _ in schema], [_type for _, _type in schema])
+
+    def __next__(self):
+        if not self._sidecar_rows:
+            return super().__next__()
+        return next(self._sidecar_rows)
+
+
+class _SidecarTSVWriter(_TypedDictTSVWriter):
+    """
+    _TypedDictTSVWriter that with sidecar=True also writes the rows to a columnar
+    sidecar next to the TSV, at sidecar_path(f.name), for _SidecarTSVReader to load
+    instead of parsing the TSV. The sidecar is only complete once close() is called,
+    use the writer as a context manager inside the with block of f.
+    """
+    def __init__(self, f: Any, schema: Sequence[Tuple[str, type]], sidecar: bool = False) -> None:
+        super().__init__(f, schema)
+        self._f = f
+        self._sidecar = None
+        path = sidecar and _file_path(f)
+        if path:
+            self._sidecar = _ColumnarSidecarWriter(sidecar_path(path), [field for field, _ in schema])
+
+    def writerow(self, rowdict):
+        result = super().writerow(rowdict)
+        if self._sidecar:
+            self._sidecar.append(rowdict)
+        return result
+
+    def writerows(self, rowdicts):
+        for rowdict in rowdicts:
+            self.writerow(rowdict)
+
+    def close(self) -> None:
+        if self._sidecar:
+            self._f.flush()
+            tsv_stat = os.fstat(self._f.fileno())
+            self._sidecar.close(tsv_stat.st_size, tsv_stat.st_mtime_ns)
+            self._sidecar = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._sidecar:
+            self._sidecar.discard()
+            self._sidecar = None
+
+
 class _BlastnOutput6ReaderBase(_TypedDictTSVReader):
     """
     This class is a bit of an oddball due to some compatibility concerns. In addition
@@ -84,6 +292,101 @@ class _BlastnOutput6ReaderBase(_TypedDictTSVReader):
         ])
 
 
+class _BlastnOutput6BatchReaderBase(Iterator[Dict[str, Union[np.ndarray, List[str]]]]):
+    """
+    Columnar counterpart of _BlastnOutput6ReaderBase. Instead of one dict per row it
+    returns one dict per batch of up to batch_size rows, mapping each field name to a
+    numpy array (int and float fields) or a list (str fields). Every batch except the
+    last one contains exactly batch_size rows.
+
+    Comments and invalid rows are skipped with the same rules as
+    _BlastnOutput6ReaderBase. Empty float fields are read as NaN, so rows with
+    a missing evalue are dropped when filter_invalid is set.
+    """
+    def __init__(self, f: Iterable[Text], schema: Sequence[Tuple[str, type]], filter_invalid: bool = False,
+                 min_alignment_length: int = 0, batch_size: int = DEFAULT_BATCH_SIZE):
+        assert batch_size > 0, f"batch_size must be positive, got {batch_size}"
+        self._schema = schema
+        self._filter_invalid = filter_invalid
+        self._min_alignment_length = min_alignment_length
+        self._batch_size = batch_size
+        self._lines = iter(f)
+        self._pending: List[Dict[str, Union[np.ndarray, List[str]]]] = []
+        self._pending_rows = 0
+        self._exhausted = False
+
+    def __next__(self):
+        while not self._exhausted and self._pending_rows < self._batch_size:
+            lines = list(islice(self._lines, self._batch_size))
+            if not lines:
+                self._exhausted = True
+                break
+            batch = self._parse(lines)
+            if self._filter_invalid:
+                batch = self._take(batch, self._valid_mask(batch))
+            rows = len(batch[self._schema[0][0]])
+            if rows:
+                self._pending.append(batch)
+                self._pending_rows += rows
+        if self._pending_rows == 0:
+            raise StopIteration
+        batch = self._concatenate(self._pending)
+        if self._pending_rows > self._batch_size:
+            rest = {field: column[self._batch_size:] for field, column in batch.items()}
+            batch = {field: column[:self._batch_size] for field, column in batch.items()}
+            self._pending, self._pending_rows = [rest], self._pending_rows - self._batch_size
+        else:
+            self._pending, self._pending_rows = [], 0
+        return batch
+
+    def _parse(self, lines: List[str]) -> Dict[str, Union[np.ndarray, List[str]]]:
+        # Split the whole chunk at once and slice out each column, this keeps the per-row work in C
+        records = list(filter(None, "\n".join(lines).splitlines()))
+        # The output of rapsearch2 contains comments that start with '#', these should be skipped
+        if any(record[0] == "#" for record in records):
+            records = [record for record in records if record[0] != "#"]
+        num_fields = len(self._schema)
+        bad_rows = [record for record, tabs in zip(records, map(str.count, records, repeat("\t"))) if tabs != num_fields - 1]
+        assert not bad_rows, f"row {bad_rows[0]} does not match schema {self._schema}"
+        fields = "\t".join(records).split("\t") if records else []
+        batch = {}
+        for i, (field, _type) in enumerate(self._schema):
+            column = fields[i::num_fields]
+            if _type is str:
+                batch[field] = column
+            elif _type is float:
+                batch[field] = np.array([value or "nan" for value in column] if "" in column else column, dtype=np.float64)
+            else:
+                batch[field] = np.array(column, dtype=np.int64)
+        return batch
+
+    def _valid_mask(self, batch) -> np.ndarray:
+        # Vectorized version of _BlastnOutput6ReaderBase._row_is_valid, see the comments there
+        evalue = batch["evalue"]
+        return (
+            (batch["length"] >= self._min_alignment_length)
+            & (-0.25 < batch["pident"]) & (batch["pident"] < 100.25)
+            & (evalue == evalue)
+            & (evalue <= MAX_EVALUE_THRESHOLD)
+        )
+
+    @staticmethod
+    def _take(batch, mask: np.ndarray):
+        return {
+            field: column[mask] if isinstance(column, np.ndarray) else [v for v, keep in zip(column, mask) if keep]
+            for field, column in batch.items()
+        }
+
+    @staticmethod
+    def _concatenate(batches):
+        if len(batches) == 1:
+            return batches[0]
+        return {
+            field: np.concatenate([b[field] for b in batches]) if isinstance(column, np.ndarray) else [v for b in batches for v in b[field]]
+            for field, column in batches[0].items()
+        }
+
+
 class _BlastnOutput6Schema:
     """
     blastn output format 6 as documented in
@@ -110,6 +413,12 @@ class BlastnOutput6Reader(_BlastnOutput6Schema, _BlastnOutput6ReaderBase):
         super().__init__(f, self.SCHEMA, filter_invalid, min_alignment_length)
 
 
+class BlastnOutput6BatchReader(_BlastnOutput6Schema, _BlastnOutput6BatchReaderBase):
+    def __init__(self, f: Iterable[Text], filter_invalid: bool = False, min_alignment_length: int = 0,
+                 batch_size: int = DEFAULT_BATCH_SIZE):
+        super().__init__(f, self.SCHEMA, filter_invalid, min_alignment_length, batch_size)
+
+
 class BlastnOutput6Writer(_BlastnOutput6Schema, _TypedDictTSVWriter):
     def __init__(self, f: Any) -> None:
         super().__init__(f, self.SCHEMA)
@@ -128,6 +437,11 @@ class BlastnOutput6NTReader(_BlastnOutput6NTSchema, _BlastnOutput6ReaderBase):
     def __init__(self, f: Iterable[Text], filter_invalid: bool = False, min_alignment_length: int = 0):
         super().__init__(f, self.SCHEMA, filter_invalid, min_alignment_length)
 
+class BlastnOutput6NTBatchReader(_BlastnOutput6NTSchema, _BlastnOutput6BatchReaderBase):
+    def __init__(self, f: Iterable[Text], filter_invalid: bool = False, min_alignment_length: int = 0,
+                 batch_size: int = DEFAULT_BATCH_SIZE):
+        super().__init__(f, self.SCHEMA, filter_invalid, min_alignment_length, batch_size)
+
 class BlastnOutput6NTWriter(_BlastnOutput6NTSchema, _TypedDictTSVWriter):
     def __init__(self, f: Any) -> None:
         super().__init__(f, self.SCHEMA)
@@ -146,6 +460,11 @@ class BlastnOutput6NTRerankedReader(_BlastnOutput6NTRerankedSchema, _BlastnOutpu
     def __init__(self, f: Iterable[Text], filter_invalid: bool = False, min_alignment_length: int = 0):
         super().__init__(f, self.SCHEMA, filter_invalid, min_alignment_length)
 
+class BlastnOutput6NTRerankedBatchReader(_BlastnOutput6NTRerankedSchema, _BlastnOutput6BatchReaderBase):
+    def __init__(self, f: Iterable[Text], filter_invalid: bool = False, min_alignment_length: int = 0,
+                 batch_size: int = DEFAULT_BATCH_SIZE):
+        super().__init__(f, self.SCHEMA, filter_invalid, min_alignment_length, batch_size)
+
 class BlastnOutput6NTRerankedWriter(_BlastnOutput6NTRerankedSchema, _TypedDictTSVWriter):
     def __init__(self, f: Any) -> None:
         super().__init__(f, self.SCHEMA)
@@ -165,13 +484,13 @@ class _HitSummarySchema:
         ("family_taxid", str),
     ]
 
-class HitSummaryReader(_HitSummarySchema, _TypedDictTSVReader):
+class HitSummaryReader(_HitSummarySchema, _SidecarTSVReader):
     def __init__(self, f: Iterable[Text]) -> None:
         super().__init__(f, self.SCHEMA)
 
-class HitSummaryWriter(_HitSummarySchema, _TypedDictTSVWriter):
-    def __init__(self, f: Any) -> None:
-        super().__init__(f, self.SCHEMA)
+class HitSummaryWriter(_HitSummarySchema, _SidecarTSVWriter):
+    def __init__(self, f: Any, sidecar: bool = False) -> None:
+        super().__init__(f, self.SCHEMA, sidecar)
 
 
 class _HitSummaryMergedSchema:
@@ -185,11 +504,11 @@ class _HitSummaryMergedSchema:
         ("source_count_type", str),
     ]
 
-class HitSummaryMergedReader(_HitSummaryMergedSchema, _TypedDictTSVReader):
+class HitSummaryMergedReader(_HitSummaryMergedSchema, _SidecarTSVReader):
     def __init__(self, f: Iterable[Text]) -> None:
         super().__init__(f, self.SCHEMA)
 
 
-class HitSummaryMergedWriter(_HitSummaryMergedSchema, _TypedDictTSVWriter):
-    def __init__(self, f: Any) -> None:
-        super().__init__(f, self.SCHEMA)
+class HitSummaryMergedWriter(_HitSummaryMergedSchema, _SidecarTSVWriter):
+    def __init__(self, f: Any, sidecar: bool = False) -> None:
+        super().__init__(f, self.SCHEMA, sidecar)
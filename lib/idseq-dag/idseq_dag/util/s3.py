@@ -5,9 +5,18 @@ import multiprocessing
 import errno
 import re
 import json
+import threading
+import collections
+import contextlib
+import fcntl
+import glob
+import itertools
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 import traceback
 import boto3
+import botocore.config
 import botocore.exceptions
 import botocore.session
 from idseq_dag.util.trace_lock import TraceLock
@@ -31,28 +40,45 @@ IOSTREAM_UPLOADS = multiprocessing.Semaphore(MAX_CONCURRENT_UPLOAD_OPERATIONS)
 config = {
     # Configured in idseq_dag.engine.pipeline_flow.PipelineFlow
     "REF_DIR": None,
-    "PURGE_SENTINEL": None
+    "PURGE_SENTINEL": None,
+    # Bytes of references to keep at most, on top of the limit on disk use
+    "REF_DIR_QUOTA": None,
 }
 
 def split_identifiers(s3_path):
     return s3_path[5:].split("/", 1)
 
 
-# Boto's default session is global and shared across threads.   As long as this is the
-# only place that we use boto and we never call functions here from multiple processes
-# (threads okay) and all accesses here are protected by this lock, we should be fine.
-# But still easy to defeat this safety by just importing boto into another file.
-# TODO:  Create our own private boto session protected by this lock.
-botolock = multiprocessing.RLock()  # Please don't trace me, I am very lightweight.
+# Boto calls in flight at once, across all threads, without waiting for a connection
+MAX_CONCURRENT_BOTO_OPERATIONS = 32
 
+BOTO_CONFIG = botocore.config.Config(
+    # Retry throttled and failed calls with backoff, and slow down the client as a whole
+    # while S3 keeps throttling it.
+    retries={"mode": "adaptive", "max_attempts": 10},
+    max_pool_connections=MAX_CONCURRENT_BOTO_OPERATIONS,
+)
 
-def rate_limit_boto(average_delay=0.33, last_call={}):  # pylint: disable=dangerous-default-value
-    '''Sleep to ensure at least average_delay has elapsed since the last call.'''
-    with botolock:
-        t_since_last_call = time.time() - last_call.get("time", 0)
-        if t_since_last_call < average_delay:
-            time.sleep(average_delay - t_since_last_call)
-        last_call["time"] = time.time()
+
+def s3_client(client_mutex=threading.Lock(), client_cache={}):  # pylint: disable=dangerous-default-value
+    '''
+    The S3 client for every boto call in the pipeline.  Boto's default session is global and not
+    thread safe, but a client is, so we create one from a private session and share it across
+    threads.  Sharing one client, rather than one per thread, means one connection pool, and one
+    adaptive rate limiter that backs off all threads when S3 throttles any of them.
+    A forked subprocess gets its own client, rather than the parent's connections.
+    '''
+    pid = os.getpid()
+    client = client_cache.get(pid)
+    if client is None:
+        # Created outside the mutex, so that a subprocess forked meanwhile can't inherit it locked
+        client = boto3.session.Session().client("s3", config=BOTO_CONFIG)
+        with client_mutex:
+            if pid not in client_cache:
+                client_cache.clear()
+                client_cache[pid] = client
+            client = client_cache[pid]
+    return client
 
 
 def _check_s3_presence(s3_path, allow_zero_byte_files):
@@ -62,11 +88,7 @@ def _check_s3_presence(s3_path, allow_zero_byte_files):
         bucket = parsed_url.netloc
         key = parsed_url.path.lstrip('/')
         try:
-            o = boto3.resource('s3').Object(
-                bucket,
-                key
-            )
-            size = o.content_length
+            size = s3_client().head_object(Bucket=bucket, Key=key)['ContentLength']
             lc.values['size'] = size
             exists = (allow_zero_byte_files and size >= 0) or (not allow_zero_byte_files and size > 0)
         except botocore.exceptions.ClientError as e:
@@ -80,9 +102,7 @@ def _check_s3_presence(s3_path, allow_zero_byte_files):
 
 
 def check_s3_presence(s3_path, allow_zero_byte_files=True):
-    with botolock:
-        rate_limit_boto()
-        return _check_s3_presence(s3_path, allow_zero_byte_files)
+    return _check_s3_presence(s3_path, allow_zero_byte_files)
 
 
 def get_s3_object_by_path(s3_path):
@@ -90,11 +110,7 @@ def get_s3_object_by_path(s3_path):
     bucket = parsed_url.netloc
     key = parsed_url.path.lstrip('/')
     try:
-        o = boto3.resource('s3').Object(
-            bucket,
-            key
-        )
-        return o.get()['Body'].read()
+        return s3_client().get_object(Bucket=bucket, Key=key)['Body'].read()
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404" or e.response['Error']['Code'] == 'NoSuchKey':
             return None
@@ -103,12 +119,64 @@ def get_s3_object_by_path(s3_path):
             raise
 
 
+def _list_sizes(bucket, keys):
+    '''
+    Sizes of whichever of keys exist, from a ListObjectsV2 of their common prefix, which
+    stops at the page holding the last of them.
+    '''
+    sizes = {}
+    last_key = max(keys)
+    pages = s3_client().get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=os.path.commonprefix(list(keys)))
+    for page in pages:
+        for o in page.get("Contents", []):
+            if o["Key"] in keys:
+                sizes[o["Key"]] = o["Size"]
+        if page.get("Contents") and page["Contents"][-1]["Key"] >= last_key:
+            break
+    return sizes
+
+
 def check_s3_presence_for_file_list(s3_dir, file_list, allow_zero_byte_files=True):
-    with botolock:
-        for f in file_list:
-            rate_limit_boto()
-            if not _check_s3_presence(os.path.join(s3_dir, f), allow_zero_byte_files):
-                return False
+    '''
+    True if all of file_list exist in s3_dir.  The files under s3_dir are looked up with a single
+    listing of their common prefix, instead of a HEAD request per file, and the others with HEAD.
+    '''
+    parsed_dir = urlparse(s3_dir, allow_fragments=False)
+    bucket = parsed_dir.netloc
+    dir_prefix = parsed_dir.path.strip('/') + '/' if parsed_dir.path.strip('/') else ''
+    listed_keys = set()
+    other_paths = []
+    for f in file_list:
+        s3_path = os.path.join(s3_dir, f)
+        parsed_url = urlparse(s3_path, allow_fragments=False)
+        key = parsed_url.path.lstrip('/')
+        if parsed_url.netloc == bucket and key.startswith(dir_prefix) and os.path.normpath(key) == key:
+            listed_keys.add(key)
+        else:
+            other_paths.append(s3_path)
+    if len(listed_keys) == 1:
+        other_paths.append(f"s3://{bucket}/{listed_keys.pop()}")
+    if listed_keys:
+        with log.log_context(context_name="s3.check_s3_presence_for_file_list",
+                             values={'s3_dir': s3_dir, 'num_files': len(listed_keys)},
+                             log_context_mode=log.LogContextMode.EXEC_LOG_EVENT) as lc:
+            try:
+                sizes = _list_sizes(bucket, listed_keys)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] != "AccessDenied":
+                    raise
+                # Without s3:ListBucket permission, check each file on its own
+                lc.values['access_denied'] = True
+                sizes = None
+                other_paths += [f"s3://{bucket}/{key}" for key in listed_keys]
+            if sizes is not None:
+                exists = all(key in sizes and (allow_zero_byte_files or sizes[key] > 0) for key in listed_keys)
+                lc.values['exists'] = exists
+                if not exists:
+                    return False
+    for s3_path in other_paths:
+        if not _check_s3_presence(s3_path, allow_zero_byte_files):
+            return False
     return True
 
 
@@ -138,41 +206,151 @@ def refreshed_credentials(credentials_mutex=multiprocessing.RLock(), credentials
     return credentials_cache["vars"]
 
 
-def find_oldest_reference(refdir):
+# Where fetch_from_s3 records the references it downloads, in the reference directory
+REFERENCE_MANIFEST = "reference_manifest.json"
+# make_space evicts references until the disk is at most this full
+MAX_DISK_USED_FRACTION = 0.6
+
+
+@contextlib.contextmanager
+def _reference_manifest(refdir):
+    '''
+    The manifest of the references under refdir, {path relative to refdir: entry}, to read and
+    update while other threads and processes wait for it.  Saved when the block exits.
+    Each entry holds the reference's source, ETag, size in bytes, last access time, and pins
+    by process id.
+    '''
+    manifest_path = os.path.join(refdir, REFERENCE_MANIFEST)
+    with open(manifest_path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+        yield manifest
+        tmp_manifest_path = f"{manifest_path}.tmp.{os.getpid()}"
+        with open(tmp_manifest_path, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_manifest_path, manifest_path)
+
+
+def _reference_size(path):
+    '''The bytes to download again if path is evicted'''
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(dirpath, f)) for dirpath, _dirnames, filenames in os.walk(path) for f in filenames)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _pinned(entry):
+    return any(count > 0 and _process_alive(int(pid)) for pid, count in entry["pins"].items())
+
+
+_pinning = threading.local()
+
+
+@contextlib.contextmanager
+def pinned_references():
+    '''
+    Pins the references that fetch_from_s3 fetches, or finds already downloaded, in this
+    thread until the block exits, so that make_space doesn't evict them while they're in use,
+    even from another process sharing the reference directory.
+    '''
+    outer_pins = getattr(_pinning, "pins", None)
+    _pinning.pins = []
     try:
-        # To understand this ls command, please see the path forming explained in fetch_from_s3 when is_reference=True.
-        ls = subprocess.run(f"ls -td {refdir}/*/* | tail -1", shell=True, executable="/bin/bash", check=True, capture_output=True)
-    except:
-        # This happens when there are no reference files to delete.
-        return None
-    result = ls.stdout.decode('utf-8').strip()
-    assert config["PURGE_SENTINEL"] != None
-    if result == config["PURGE_SENTINEL"]:
-        log.write("WARNING:  Encountered purge sentinel before freeing sufficient space.  Job may run out of space.")
-        return None
-    return result
-
-
-def need_more_space(refdir):
+        yield
+    finally:
+        pins, _pinning.pins = _pinning.pins, outer_pins
+        pid = str(os.getpid())
+        for refdir in set(refdir for refdir, _path in pins):
+            with _reference_manifest(refdir) as manifest:
+                for path in (path for pin_refdir, path in pins if pin_refdir == refdir and path in manifest):
+                    pins_left = manifest[path]["pins"].pop(pid, 0) - 1
+                    if pins_left > 0:
+                        manifest[path]["pins"][pid] = pins_left
+
+
+def _record_reference_access(refdir, dst, src=None, etag=None, downloaded=False):
+    '''Records an access to reference dst, and pins it for the enclosing pinned_references()'''
+    path = os.path.relpath(dst, refdir)
+    pins = getattr(_pinning, "pins", None)
+    with _reference_manifest(refdir) as manifest:
+        entry = manifest.get(path)
+        if downloaded or entry is None:
+            # Downloaded before the manifest existed, when not just downloaded
+            entry = manifest[path] = {"src": src if downloaded else None, "etag": etag, "size": _reference_size(dst), "pins": {}}
+        entry["last_access"] = time.time()
+        if pins is not None:
+            pid = str(os.getpid())
+            entry["pins"][pid] = entry["pins"].get(pid, 0) + 1
+            pins.append((refdir, path))
+
+
+def _choose_evictions(entries, space_needed):
+    '''
+    The paths of entries to evict to free space_needed bytes, re-fetching as few bytes as
+    possible if they are needed again: the smallest entry that frees the space still needed
+    on its own, or else the least recently used entry, until enough space is freed.
+    '''
+    candidates = sorted(entries.items(), key=lambda item: item[1]["last_access"])
+    evictions = []
+    while space_needed > 0 and candidates:
+        big_enough = [item for item in candidates if item[1]["size"] >= space_needed]
+        victim = min(big_enough, key=lambda item: item[1]["size"]) if big_enough else candidates[0]
+        candidates.remove(victim)
+        evictions.append(victim[0])
+        space_needed -= victim[1]["size"]
+    return evictions
+
+
+def _space_to_free(refdir, manifest):
     try:
-        df = subprocess.run(f"df -m {refdir}" + " | awk '{print $5}' | tail -1 | sed 's=%=='", shell=True, executable="/bin/bash", check=True, capture_output=True)
-        percent_used = int(df.stdout.decode('utf-8').strip())
-        log.write(f"Disk used space: {percent_used} percent.")
-        return percent_used > 60
-    except:
+        disk = shutil.disk_usage(refdir)
+        log.write(f"Disk used space: {100 * disk.used / disk.total:.0f} percent.")
+        space_needed = disk.used - MAX_DISK_USED_FRACTION * disk.total
+    except OSError:
         log.write("Error:  Failed to determine available space on instance.  Will assume too little space is available, and will try to delete least recently used reference downloads.")
-        traceback.format_exc()
-        return True  # Better safe than sorry.
+        log.write(traceback.format_exc())
+        return float("inf")  # Better safe than sorry.
+    if config["REF_DIR_QUOTA"] is not None:
+        space_needed = max(space_needed, sum(entry["size"] for entry in manifest.values()) - config["REF_DIR_QUOTA"])
+    return space_needed
 
 
 def really_make_space():
     refdir = config['REF_DIR']
-    while need_more_space(refdir):
-        lru = find_oldest_reference(refdir)
-        if not lru:
-            log.write("WARNING:  Too little available space on instance, and could not find any reference downloads to delete.")
-            break
-        command.remove_rf(lru)
+    # References used since the purge sentinel are needed by this stage
+    sentinel = config["PURGE_SENTINEL"]
+    used_since = os.path.getmtime(sentinel) if sentinel and os.path.exists(sentinel) else float("inf")
+    with _reference_manifest(refdir) as manifest:
+        for path in list(manifest):
+            if not os.path.exists(os.path.join(refdir, path)):
+                del manifest[path]
+        # To understand this glob, please see the path forming explained in fetch_from_s3 when is_reference=True.
+        for dst in glob.glob(os.path.join(refdir, "*", "*")):
+            path = os.path.relpath(dst, refdir)
+            if path not in manifest and os.path.basename(dst) != "tmp_downloads" and dst != sentinel:
+                # Downloaded before the manifest existed
+                manifest[path] = {"src": None, "etag": None, "size": _reference_size(dst), "last_access": os.path.getmtime(dst), "pins": {}}
+        space_needed = _space_to_free(refdir, manifest)
+        evictable = {path: entry for path, entry in manifest.items() if entry["last_access"] < used_since and not _pinned(entry)}
+        for path in _choose_evictions(evictable, space_needed):
+            log.write(f"Evicting reference {path} ({manifest[path]['size']} bytes) to make space.")
+            command.remove_rf(os.path.join(refdir, path))
+            space_needed -= manifest.pop(path)["size"]
+        if space_needed > 0:
+            log.write("WARNING:  Too little available space on instance, and could not find any more reference downloads to delete.  Job may run out of space.")
 
 
 def make_space(done={}, mutex=TraceLock("make_space", multiprocessing.RLock())):  # pylint: disable=dangerous-default-value
@@ -189,6 +367,7 @@ def make_space(done={}, mutex=TraceLock("make_space", multiprocessing.RLock())):
 DEFAULT_AUTO_UNZIP = False
 DEFAULT_AUTO_UNTAR = False
 DEFAULT_ALLOW_S3MI = False
+DEFAULT_ALLOW_NATIVE_DOWNLOAD = True
 ZIP_EXTENSIONS = {
     ".lz4": "lz4 -dc",
     ".bz2": "lbzip2 -dc",
@@ -203,6 +382,90 @@ REFERENCE_AUTOGUESS_ZIP_EXTENSIONS = {
 }
 
 
+# A native download fetches NATIVE_DOWNLOAD_CONCURRENCY ranges of NATIVE_DOWNLOAD_PART_SIZE
+# bytes at a time, and holds at most NATIVE_DOWNLOAD_WINDOW parts in memory while they wait
+# their turn to be decompressed.
+NATIVE_DOWNLOAD_CONCURRENCY = 8
+NATIVE_DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+NATIVE_DOWNLOAD_WINDOW = NATIVE_DOWNLOAD_CONCURRENCY + 4
+
+
+def _ranged_parts(bucket, key, size, etag, part_size, concurrency, window):
+    '''
+    Yields the content of s3://bucket/key in order, one part at a time, while concurrent
+    ranged GETs fetch up to window parts after it.  With an etag, the download fails rather
+    than mix parts of two versions of an object that is overwritten meanwhile.
+    '''
+    client = s3_client()
+    precondition = {"IfMatch": etag} if etag else {}
+
+    def get_part(start):
+        end = min(start + part_size, size)
+        data = client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}", **precondition)["Body"].read()
+        if len(data) != end - start:
+            raise IOError(f"Short read of s3://{bucket}/{key} bytes {start}-{end - 1}: got {len(data)} bytes")
+        return data
+
+    starts = iter(range(0, size, part_size))
+    with ThreadPoolExecutor(concurrency) as executor:
+        parts = collections.deque(executor.submit(get_part, start) for start in itertools.islice(starts, window))
+        try:
+            while parts:
+                data = parts.popleft().result()
+                parts.extend(executor.submit(get_part, start) for start in itertools.islice(starts, 1))
+                yield data
+        finally:
+            for part in parts:
+                part.cancel()
+
+
+def _native_download(src, script, named_args):
+    '''
+    Runs script with the content of S3 object src on its stdin, from concurrent ranged GETs
+    through the shared boto client, so that decompressing and untarring overlap the download
+    and only their output is written to disk.  Returns the ETag of the object.
+    '''
+    bucket, key = split_identifiers(src)
+    head = s3_client().head_object(Bucket=bucket, Key=key)
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def feed_script():
+        try:
+            with open(write_fd, "wb") as script_stdin:
+                for part in _ranged_parts(bucket, key, head["ContentLength"], head.get("ETag"),
+                                          NATIVE_DOWNLOAD_PART_SIZE, NATIVE_DOWNLOAD_CONCURRENCY, NATIVE_DOWNLOAD_WINDOW):
+                    script_stdin.write(part)
+        except BrokenPipeError:
+            # The script exited without reading all its input, and its exit code tells why
+            pass
+        except BaseException as e:  # pylint: disable=broad-except
+            errors.append(e)
+
+    feeder = threading.Thread(target=feed_script, name=f"native_download: {src}")
+    feeder.start()
+    try:
+        command.execute(
+            command_patterns.ShellScriptCommand(
+                script=script,
+                named_args=named_args
+            ),
+            stdin=read_fd
+        )
+    finally:
+        # Unblocks the feeder if the script exited early
+        os.close(read_fd)
+        feeder.join()
+    if errors:
+        # A download that fails midway leaves the script a truncated input, which it may not detect
+        raise errors[0]
+    return head.get("ETag")
+
+
+def _not_found(e):
+    return isinstance(e, botocore.exceptions.ClientError) and e.response['Error']['Code'] in ("404", "NoSuchKey")
+
+
 # WARNING: This will bypass download if src is a local path, see comment below for details
 def fetch_from_s3(src,  # pylint: disable=dangerous-default-value
                   dst,
@@ -212,9 +475,14 @@ def fetch_from_s3(src,  # pylint: disable=dangerous-default-value
                   okay_if_missing=False,
                   is_reference=False,
                   touch_only=False,
+                  allow_native=DEFAULT_ALLOW_NATIVE_DOWNLOAD,
                   mutex=TraceLock("fetch_from_s3", multiprocessing.RLock()),
                   locks={}):
-    """Fetch a file from S3 if needed, using either s3mi or aws cp.
+    """Fetch a file from S3 if needed, using s3mi, a native download, or aws cp.
+
+    Without s3mi, or if s3mi fails, and when allow_native=True, concurrent ranged GETs
+    stream the file into its decompression and untarring, and only if that fails is the
+    file fetched with aws s3 cp.
 
     IT IS NOT SAFE TO CALL THIS FUNCTION FROM MULTIPLE PROCESSES.
     It is totally fine to call it from multiple threads (it is designed for that).
@@ -224,7 +492,8 @@ def fetch_from_s3(src,  # pylint: disable=dangerous-default-value
     If src does not exist or there is a failure fetching it, the function returns None,
     without raising an exception.  If the download is successful, it returns the path
     to the downloaded file or folder.  If the download already exists, it is touched
-    to update its timestamp.
+    to update its timestamp.  References also have their size and last access recorded
+    in the manifest that make_space evicts them by, and are pinned by pinned_references().
 
     When touch_only=True, if the destination does not already exist, the function
     simply returns None (as if the download failed).  If the destination does exist,
@@ -274,6 +543,8 @@ def fetch_from_s3(src,  # pylint: disable=dangerous-default-value
     if is_reference:
         assert config["REF_DIR"], "The is_reference code path becomes available only after initializing gloabal config['REF_DIR']"
 
+    # References are recorded in the manifest of the directory they are fetched to
+    refdir = None
     if os.path.exists(dst) and os.path.isdir(dst):
         dirname, basename = os.path.split(src)
         if is_reference or os.path.abspath(dst).startswith(config["REF_DIR"]):
@@ -287,6 +558,7 @@ def fetch_from_s3(src,  # pylint: disable=dangerous-default-value
             # some tools incorporate the base name of their database input into the output filenames, so any approach
             # that changes the basename causes problems downstream.  An example such tool is srst2.
             is_reference = True
+            refdir = dst
             if dirname.startswith("s3://"):
                 dirname = dirname.replace("s3://", "s3__", 1)
             # If dirname contains slashes, it has to be flattened to single level.
@@ -298,10 +570,12 @@ def fetch_from_s3(src,  # pylint: disable=dangerous-default-value
         assert not is_reference, f"When fetching references, dst must be an existing directory: {dst}"
 
     unzip = ""
+    decompress = "cat"
     if auto_unzip:
         file_without_ext, ext = os.path.splitext(dst)
         if ext in ZIP_EXTENSIONS:
-            unzip = " | " + ZIP_EXTENSIONS[ext]  # this command will be used to decompress stdin to stdout
+            decompress = ZIP_EXTENSIONS[ext]  # this command will be used to decompress stdin to stdout
+            unzip = " | " + decompress
             dst = file_without_ext  # remove file extension from dst
     untar = auto_untar and dst.lower().endswith(".tar")
     if untar:
@@ -326,6 +600,8 @@ def fetch_from_s3(src,  # pylint: disable=dangerous-default-value
         # all contents of file foo.tar are under directory foo/... (which we do follow in IDseq)
         if os.path.exists(dst):
             command.touch(dst)
+            if refdir:
+                _record_reference_access(refdir, dst)
             return dst
 
         if touch_only:
@@ -364,6 +640,7 @@ def fetch_from_s3(src,  # pylint: disable=dangerous-default-value
                 named_args.update({'src': src})
 
                 try_cli = not allow_s3mi
+                etag = None
                 if allow_s3mi:
                     if os.path.exists(tmp_dst):
                         command.remove_rf(tmp_dst)
@@ -380,10 +657,21 @@ def fetch_from_s3(src,  # pylint: disable=dangerous-default-value
                         S3MI_SEM.release()
                         if try_cli:
                             log.write(
-                                "Failed to download with s3mi. Trying with aws s3 cp..."
+                                "Failed to download with s3mi. Trying without s3mi..."
                             )
                         else:
                             raise
+                if try_cli and allow_native:
+                    if os.path.exists(tmp_dst):
+                        command.remove_rf(tmp_dst)
+                    try:
+                        etag = _native_download(src, f"set -o pipefail; {decompress} {write_dst}", named_args)
+                        try_cli = False
+                    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, OSError, subprocess.CalledProcessError) as e:
+                        if _not_found(e):
+                            log.write("File most likely does not exist in S3." if okay_if_missing else "Failed to fetch file from S3.")
+                            return None
+                        log.write(f"Failed to download natively: {e!r}. Trying with aws s3 cp...")
                 if try_cli:
                     if os.path.exists(tmp_dst):
                         command.remove_rf(tmp_dst)
@@ -401,6 +689,8 @@ def fetch_from_s3(src,  # pylint: disable=dangerous-default-value
                 # Move staged download into final location.  Leave this last, so it only happens if no exception has occurred.
                 # By this point we have already asserted that tmp_dst != dst.
                 command.rename(tmp_dst, dst)
+                if refdir:
+                    _record_reference_access(refdir, dst, src, etag, downloaded=True)
                 return dst
             except BaseException as e:  # Deliberately super broad to make doubly certain that dst will be removed if there has been any exception
                 if os.path.exists(dst):
@@ -430,7 +720,8 @@ def fetch_reference(src,  # pylint: disable=dangerous-default-value
                     auto_unzip=True,
                     auto_untar=True,
                     allow_s3mi=DEFAULT_ALLOW_S3MI,
-                    touch_only=False):
+                    touch_only=False,
+                    allow_native=DEFAULT_ALLOW_NATIVE_DOWNLOAD):
     '''
         This function behaves like fetch_from_s3 in most cases, with one excetpion:
 
@@ -466,7 +757,8 @@ def fetch_reference(src,  # pylint: disable=dangerous-default-value
                                    allow_s3mi=allow_s3mi,
                                    okay_if_missing=True,  # It's okay if missing a compressed version.
                                    is_reference=True,
-                                   touch_only=touch_only)
+                                   touch_only=touch_only,
+                                   allow_native=allow_native)
             if result:
                 return result
 
@@ -477,7 +769,8 @@ def fetch_reference(src,  # pylint: disable=dangerous-default-value
                          allow_s3mi=allow_s3mi,
                          okay_if_missing=False,  # It's NOT okay if missing on the last attempt.
                          is_reference=True,
-                         touch_only=touch_only)
+                         touch_only=touch_only,
+                         allow_native=allow_native)
 
 
 @command.retry
@@ -4,7 +4,7 @@ from collections import defaultdict
 
 from idseq_dag.util.parsing import HitSummaryMergedReader
 from idseq_dag.util.m8 import MIN_CONTIG_SIZE, build_should_keep_filter, generate_taxon_count_json_from_m8
-from idseq_dag.util.count import READ_COUNTING_MODE, ReadCountingMode, get_read_cluster_size, load_duplicate_cluster_sizes
+from idseq_dag.util.count import READ_COUNTING_MODE, ReadCountingMode, get_read_cluster_size, shared_duplicate_cluster_sizes
 
 def generate_taxon_summary(
     read2contig,
@@ -20,7 +20,7 @@ def generate_taxon_summary(
     # { taxid: , tax_level:, contig_counts: { 'contig_name': <count>, .... } }
     duplicate_cluster_sizes = None
     if duplicate_cluster_sizes_path:
-        duplicate_cluster_sizes = load_duplicate_cluster_sizes(duplicate_cluster_sizes_path)
+        duplicate_cluster_sizes = shared_duplicate_cluster_sizes(duplicate_cluster_sizes_path)
 
     def new_summary():
         return defaultdict(lambda: defaultdict(lambda: [0, 0]))
@@ -1,6 +1,8 @@
-from collections import defaultdict
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
 
 import idseq_dag.util.lineage as lineage
+import idseq_dag.util.log as log
 
 from idseq_dag.util.dict import open_file_db_by_extension
 from idseq_dag.util.m8 import NT_MIN_ALIGNMENT_LEN
@@ -27,6 +29,10 @@ _NT_MIN_OVERLAP_FRACTION = 0.1
 #
 _NT_MIN_PIDENT = 80
 
+# Default number of accessions whose lineage is memoized by get_top_m8_nr and get_top_m8_nt.
+# Each entry holds an accession id and a lineage tuple, roughly 300 bytes.
+DEFAULT_LINEAGE_CACHE_SIZE = 1_000_000
+
 
 def _intervals_overlap(p, q):
     '''Return True iff the intersection of p and q covers more than NT_MIN_OVERLAP_FRACTION of either p or q.'''
@@ -59,13 +65,95 @@ def _intersects(needle, haystack):
     ''' Return True iff needle intersects haystack.  Ignore overlap < NT_MIN_OVERLAP_FRACTION. '''
     return any(_hsp_overlap(needle, hay) for hay in haystack)
 
-def _get_lineage(accession_id, lineage_map, accession2taxid_dict, lineage_cache={}):
-    if accession_id in lineage_cache:
-        return lineage_cache[accession_id]
+
+class _IntervalCover:
+    '''
+    Query intervals of the HSPs kept in a cover, sorted by start.
+
+    No two kept intervals overlap in the sense of _intervals_overlap, so none
+    contains another, and sorting by start sorts by end too.  The kept intervals
+    that intersect a new interval at all are then a contiguous run found by
+    bisection, and only those need the _intervals_overlap test.  Zero-length
+    intervals never overlap anything and are not stored.
+    '''
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def intersects(self, interval):
+        ''' Same as _intersects, for an HSP with the given query interval. '''
+        start, end = interval
+        if start == end:
+            return False
+        first = bisect_right(self.ends, start)
+        last = bisect_left(self.starts, end)
+        return any(_intervals_overlap(interval, (self.starts[i], self.ends[i])) for i in range(first, last))
+
+    def add(self, interval):
+        start, end = interval
+        if start == end:
+            return
+        i = bisect_left(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+
+class LineageCache:
+    '''
+    LRU memo of accession id => lineage with a bound on the number of entries.
+    Counts hits, misses and evictions so worker memory can be sized from the hit rate.
+    '''
+
+    def __init__(self, max_size=DEFAULT_LINEAGE_CACHE_SIZE):
+        assert max_size > 0, f"max_size must be positive, got {max_size}"
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, accession_id):
+        result = self._entries.get(accession_id)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(accession_id)
+        return result
+
+    def put(self, accession_id, lineage_taxids):
+        self._entries[accession_id] = lineage_taxids
+        self._entries.move_to_end(accession_id)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "max_size": self.max_size,
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def log_stats(self, context_name):
+        log.log_event("lineage_cache_stats", values={"context_name": context_name, **self.stats()})
+
+
+def _get_lineage(accession_id, lineage_map, accession2taxid_dict, lineage_cache):
+    result = lineage_cache.get(accession_id)
+    if result is not None:
+        return result
     accession_taxid = accession2taxid_dict.get(
         accession_id.split(".")[0], "NA")
     result = lineage_map.get(accession_taxid, lineage.NULL_LINEAGE)
-    lineage_cache[accession_id] = result
+    lineage_cache.put(accession_id, result)
     return result
 
 class BlastCandidate:
@@ -89,10 +177,13 @@ class BlastCandidate:
         # Find a subset of disjoint HSPs with maximum sum of bitscores.
         # Initial implementation:  Super greedy.  Takes advantage of the fact
         # that blast results are sorted by bitscore, highest first.
-        self.optimal_cover = [self.hsps[0]]
-        for next_hsp in self.hsps[1:]:
-            if not _intersects(next_hsp, self.optimal_cover):
+        self.optimal_cover = []
+        cover = _IntervalCover()
+        for next_hsp in self.hsps:
+            interval = _query_interval(next_hsp)
+            if not cover.intersects(interval):
                 self.optimal_cover.append(next_hsp)
+                cover.add(interval)
         # total_score
         self.total_score = sum(hsp["bitscore"] for hsp in self.optimal_cover)
 
@@ -117,7 +208,7 @@ class BlastCandidate:
         return r
 
 
-def _optimal_hit_for_each_query_nr(blast_output_path, lineage_map, accession2taxid_dict, max_evalue):
+def _optimal_hit_for_each_query_nr(blast_output_path, lineage_map, accession2taxid_dict, max_evalue, lineage_cache):
     contigs_to_best_alignments = defaultdict(list)
     accession_counts = defaultdict(lambda: 0)
 
@@ -130,7 +221,7 @@ def _optimal_hit_for_each_query_nr(blast_output_path, lineage_map, accession2tax
                 continue
             query = alignment["qseqid"]
 
-            lineage_taxids = _get_lineage(alignment["sseqid"], lineage_map, accession2taxid_dict)
+            lineage_taxids = _get_lineage(alignment["sseqid"], lineage_map, accession2taxid_dict, lineage_cache)
             specificity = next((level for level, taxid_at_level in enumerate(lineage_taxids) if int(taxid_at_level) > 0), float("inf"))
 
             best_alignments = specificity_to_best_alignments[query]
@@ -194,7 +285,7 @@ def _filter_and_group_hits_by_query(blast_output_path, min_alignment_length, min
 
 # An iterator that, for contig, yields to optimal hit for the contig in the nt blast_output.
 def _optimal_hit_for_each_query_nt(blast_output, lineage_map, accession2taxid_dict,
-                                   min_alignment_length, min_pident, max_evalue, summary=True):
+                                   min_alignment_length, min_pident, max_evalue, lineage_cache, summary=True):
     contigs_to_blast_candidates = {}
     accession_counts = defaultdict(lambda: 0)
 
@@ -209,7 +300,7 @@ def _optimal_hit_for_each_query_nt(blast_output, lineage_map, accession2taxid_di
 
             # We prioritize the specificity of the hit; hits with species taxids are taken before hits without
             # Specificity is just the index of the tuple returned by _get_lineage(); 0 for species, 1 for genus, etc.
-            lineage_taxids = _get_lineage(hit.sseqid, lineage_map, accession2taxid_dict)
+            lineage_taxids = _get_lineage(hit.sseqid, lineage_map, accession2taxid_dict, lineage_cache)
             specificity = next((level for level, taxid_at_level in enumerate(lineage_taxids) if int(taxid_at_level) > 0), float("inf"))
 
             if (specificity not in best_hits) or best_hits[specificity][0].total_score < hit.total_score:
@@ -247,14 +338,17 @@ def get_top_m8_nr(
     accession2taxid_dict_path,
     blast_top_blastn_6_path,
     max_evalue=MAX_EVALUE_THRESHOLD,
+    lineage_cache_size=DEFAULT_LINEAGE_CACHE_SIZE,
 ):
     ''' Get top m8 file entry for each contig from blast_output and output to blast_top_m8 '''
+    lineage_cache = LineageCache(lineage_cache_size)
     with open(blast_top_blastn_6_path, "w") as blast_top_blastn_6_f, \
         open_file_db_by_extension(lineage_map_path, "lll") as lineage_map, \
         open_file_db_by_extension(accession2taxid_dict_path, "L") as accession2taxid_dict:  # noqa
         BlastnOutput6Writer(blast_top_blastn_6_f).writerows(
-            _optimal_hit_for_each_query_nr(blast_output, lineage_map, accession2taxid_dict, max_evalue)
+            _optimal_hit_for_each_query_nr(blast_output, lineage_map, accession2taxid_dict, max_evalue, lineage_cache)
         )
+    lineage_cache.log_stats("get_top_m8_nr")
 
 
 def get_top_m8_nt(
@@ -265,6 +359,7 @@ def get_top_m8_nt(
     min_alignment_length=NT_MIN_ALIGNMENT_LEN,
     min_pident=_NT_MIN_PIDENT,
     max_evalue=MAX_EVALUE_THRESHOLD,
+    lineage_cache_size=DEFAULT_LINEAGE_CACHE_SIZE,
 ):
     '''
     For each contig Q (query) and reference S (subject), extend the highest-scoring
@@ -287,9 +382,11 @@ def get_top_m8_nt(
 
     # Output the optimal hit for each query.
 
+    lineage_cache = LineageCache(lineage_cache_size)
     with open(blast_top_blastn_6_path, "w") as blast_top_blastn_6_f, \
         open_file_db_by_extension(lineage_map_path, "lll") as lineage_map, \
         open_file_db_by_extension(accession2taxid_dict_path, "L") as accession2taxid_dict:  # noqa
         BlastnOutput6NTRerankedWriter(blast_top_blastn_6_f).writerows(
-            _optimal_hit_for_each_query_nt(blast_output, lineage_map, accession2taxid_dict, min_alignment_length, min_pident, max_evalue, False)
+            _optimal_hit_for_each_query_nt(blast_output, lineage_map, accession2taxid_dict, min_alignment_length, min_pident, max_evalue, lineage_cache, False)
         )
+    lineage_cache.log_stats("get_top_m8_nt")
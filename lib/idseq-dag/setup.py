@@ -95,13 +95,14 @@ setup(name='idseq_dag',
       license='MIT',
       packages=find_packages(exclude=["tests.*", "tests"]),
       package_data={'idseq_dag': ['scripts/fastq-fasta-line-validation.awk']},
-      install_requires=["pytz", "biopython"],
+      install_requires=["pytz", "biopython", "numpy"],
       extras_require={"test": ["coverage", "flake8", "wheel"]},
       dependency_links=[],
       entry_points={
           'console_scripts': [
               'idseq_dag = idseq_dag.__main__:main',
               'idseq-dag-run-step = idseq_dag.__main__:run_step',
+              'idseq-dag-chrome-trace = idseq_dag.__main__:chrome_trace',
           ]
       },
       zip_safe=False)
@@ -0,0 +1,11 @@
+"""
+Standalone, offline benchmarks for idseq_dag hot paths.
+
+These are not collected by pytest (modules are named bench_*.py). Run them from
+lib/idseq-dag, for example:
+
+    python -m tests.benchmarks.bench_parsing --rows 10000000
+
+bench_suite runs all of the m8 and top hits hot paths on synthetic inputs from
+synthetic.py and can compare the results against a saved baseline.
+"""
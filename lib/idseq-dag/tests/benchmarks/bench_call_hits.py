@@ -0,0 +1,45 @@
+"""
+Time call_hits_m8 hit calling on a synthetic m8, with accessions interned into the
+dense lineage table, comparing the single-pass streaming path with the two-pass path.
+
+    python -m tests.benchmarks.bench_call_hits --rows 20000000 --accessions 100000
+"""
+import argparse
+import os
+import tempfile
+
+from idseq_dag.util.dict import open_file_db_by_extension
+from idseq_dag.util.m8 import _call_hits_m8_work
+
+from tests.benchmarks.harness import report, run_measured
+from tests.benchmarks.synthetic import write_m8, write_taxonomy_tries
+
+
+def call_hits(input_m8, lineage_map_path, accession2taxid_dict_path, output_dir, streaming):
+    with open_file_db_by_extension(lineage_map_path, "lll") as lineage_map, \
+         open_file_db_by_extension(accession2taxid_dict_path, "L") as accession2taxid_dict:  # noqa
+        _call_hits_m8_work(input_m8, lineage_map, accession2taxid_dict,
+                           os.path.join(output_dir, "out.m8"), os.path.join(output_dir, "out.hitsummary.tab"), 36,
+                           deuterostome_path=None, taxon_whitelist_path=None, taxon_blacklist_path=None,
+                           streaming=streaming)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20_000_000)
+    parser.add_argument("--hits-per-read", type=int, default=5)
+    parser.add_argument("--accessions", type=int, default=100_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        m8_path = os.path.join(tmp, "bench.m8")
+        total = write_m8(m8_path, args.rows // args.hits_per_read, args.hits_per_read, args.accessions)
+        tries = write_taxonomy_tries(tmp, args.accessions, num_species=max(10, args.accessions // 20))
+        print(f"{total:,} rows, {args.accessions:,} accessions")
+        for name, streaming in [("call_hits_m8 streaming", True), ("call_hits_m8 two-pass", False)]:
+            elapsed, peak_rss_mb, _ = run_measured(call_hits, m8_path, *tries, tmp, streaming)
+            report(name, total, elapsed, peak_rss_mb)
+
+
+if __name__ == "__main__":
+    main()
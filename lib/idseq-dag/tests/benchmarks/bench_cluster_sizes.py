@@ -0,0 +1,54 @@
+"""
+Load a synthetic duplicate_cluster_sizes.tsv from several step threads at once, each
+parsing its own copy with load_duplicate_cluster_sizes, or all sharing one through
+shared_duplicate_cluster_sizes.
+
+    python -m tests.benchmarks.bench_cluster_sizes --reads 50000000 --steps 4
+"""
+import argparse
+import os
+import tempfile
+import threading
+
+from idseq_dag.util.count import load_duplicate_cluster_sizes, shared_duplicate_cluster_sizes
+
+from tests.benchmarks.harness import report, run_measured
+from tests.benchmarks.synthetic import write_duplicate_cluster_sizes
+
+
+def load_concurrently(load, path, num_steps):
+    ''' Each thread holds on to its cluster sizes until all threads have loaded them, like overlapping steps '''
+    barrier = threading.Barrier(num_steps)
+    sizes = []
+
+    def step():
+        duplicate_cluster_sizes = load(path)
+        sizes.append(len(duplicate_cluster_sizes))
+        barrier.wait()
+
+    threads = [threading.Thread(target=step) for _ in range(num_steps)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reads", type=int, default=5_000_000)
+    parser.add_argument("--steps", type=int, default=4, help="threads loading the file at the same time")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "duplicate_cluster_sizes.tsv")
+        write_duplicate_cluster_sizes(path, args.reads)
+        for name, load in [("shared_duplicate_cluster_sizes", shared_duplicate_cluster_sizes),
+                           ("load_duplicate_cluster_sizes", load_duplicate_cluster_sizes)]:
+            elapsed, peak_rss_mb, sizes = run_measured(load_concurrently, load, path, args.steps)
+            assert sizes == [args.reads] * args.steps
+            report(f"{name}, {args.steps} steps", args.reads, elapsed, peak_rss_mb)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Time count.count_reads on synthetic FASTQ and FASTA, plain and gzipped, against the
+gunzip/grep/wc pipelines it replaced, and when the count is already cached.
+
+    python -m tests.benchmarks.bench_count_reads --mb 1024
+"""
+import argparse
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import idseq_dag.util.count as count
+from idseq_dag.util.count import GZIP_MAGIC_HEADER, count_reads
+
+from tests.benchmarks.harness import report
+from tests.benchmarks.synthetic import write_reads
+
+
+def count_reads_subprocess(filename):
+    ''' The previous implementation of count_reads '''
+    with open(filename, "rb") as gz_fh:
+        is_gzipped = gz_fh.read(2).startswith(GZIP_MAGIC_HEADER)
+    with gzip.open(filename) if is_gzipped else open(filename, mode="rb") as fmt_fh:
+        first_char = fmt_fh.read(1).decode()
+    with open(filename, "rb") as fh:
+        cmd = "grep -c '^>'" if first_char == ">" else "wc -l"
+        if is_gzipped:
+            cmd = "gunzip | " + cmd
+        num = int(subprocess.run(cmd, stdin=fh, stdout=subprocess.PIPE, check=True, shell=True).stdout)
+    return num if first_char == ">" else num // 4
+
+
+def timed(fn, path):
+    t_start = time.perf_counter()
+    result = fn(path)
+    return result, time.perf_counter() - t_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mb", type=int, default=256, help="size of each uncompressed input")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt in ("fastq", "fasta"):
+            path = os.path.join(tmp, f"reads.{fmt}")
+            num_reads = write_reads(path, args.mb * 2**20, fastq=(fmt == "fastq"))
+            with open(path, "rb") as f_in, gzip.open(path + ".gz", "wb", compresslevel=1) as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            for input_path in (path, path + ".gz"):
+                name = os.path.basename(input_path)
+                for label, fn in [("subprocess", count_reads_subprocess), ("count_reads", count_reads),
+                                  ("count_reads, cached", count_reads)]:
+                    if label == "count_reads":
+                        count._read_counts.clear()
+                    result, elapsed = timed(fn, input_path)
+                    assert result == num_reads, (label, input_path, result, num_reads)
+                    report(f"{name}, {label}", num_reads, elapsed)
+
+
+if __name__ == "__main__":
+    main()
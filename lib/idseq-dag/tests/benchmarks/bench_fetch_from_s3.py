@@ -0,0 +1,90 @@
+"""
+Fetch an lz4-compressed tarball of a synthetic reference index, 2 GB when extracted, from a
+local S3 stand-in, the way fetch_reference does.  Compares the native download of
+fetch_from_s3, whose concurrent ranged GETs stream into lz4 and tar, with downloading the
+whole object to disk and only then extracting it.  Bytes written to disk are those counted
+in /proc/self/io, which includes the lz4 and tar subprocesses.
+
+    python -m tests.benchmarks.bench_fetch_from_s3 --gb 2 --latency 0.02
+"""
+import argparse
+import os
+import shutil
+import tempfile
+
+import idseq_dag.util.command as command
+import idseq_dag.util.command_patterns as command_patterns
+import idseq_dag.util.s3 as s3
+
+from tests.benchmarks.harness import report, run_measured
+from tests.benchmarks.local_s3 import local_s3
+from tests.benchmarks.synthetic import write_reference_files
+
+SRC = "s3://bucket/ref.tar.lz4"
+
+
+def write_bytes():
+    with open("/proc/self/io") as f:
+        return int(dict(line.split(": ") for line in f.read().splitlines())["write_bytes"])
+
+
+def fetch_native(out_dir):
+    s3.fetch_from_s3(SRC, os.path.join(out_dir, "ref.tar.lz4"), auto_unzip=True, auto_untar=True)
+
+
+def fetch_then_extract(out_dir):
+    ''' Download the whole object to disk, then decompress and untar it in a separate pass '''
+    staged = os.path.join(out_dir, "ref.tar.lz4")
+    s3.s3_client().download_file(*s3.split_identifiers(SRC), staged)
+    command.execute(
+        command_patterns.ShellScriptCommand(
+            script=r'set -o pipefail; lz4 -dc "${staged}" | tar xf - -C "${out_dir}"',
+            named_args={"staged": staged, "out_dir": out_dir}
+        )
+    )
+    os.remove(staged)
+
+
+def measured(fetch, out_dir):
+    ''' Returns the bytes written to disk by fetch '''
+    written = write_bytes()
+    fetch(out_dir)
+    return write_bytes() - written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gb", type=float, default=2, help="size of the reference when extracted")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds before the server answers a request")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ref_dir = os.path.join(tmp, "ref")
+        os.makedirs(ref_dir)
+        os.makedirs(os.path.join(tmp, "bucket"))
+        names = write_reference_files(ref_dir, int(args.gb * 2**30))
+        command.execute(
+            command_patterns.ShellScriptCommand(
+                script=r'set -o pipefail; tar cf - -C "${tmp}" ref | lz4 -q > "${tarball}"',
+                named_args={"tmp": tmp, "tarball": os.path.join(tmp, "bucket", "ref.tar.lz4")}
+            )
+        )
+        sizes = {name: os.path.getsize(os.path.join(ref_dir, name)) for name in names}
+        shutil.rmtree(ref_dir)
+        compressed_mb = os.path.getsize(os.path.join(tmp, "bucket", "ref.tar.lz4")) / 2**20
+        print(f"{sum(sizes.values()) / 2**20:,.0f} MB reference, {compressed_mb:,.0f} MB compressed")
+
+        with local_s3(tmp, args.latency) as server:
+            for name, fetch in [("native download", fetch_native), ("download, then extract", fetch_then_extract)]:
+                out_dir = os.path.join(tmp, "out")
+                os.makedirs(out_dir)
+                server.reset_counters()
+                elapsed, peak_rss_mb, written = run_measured(measured, fetch, out_dir)
+                report(f"fetch_from_s3, {name}", len(names), elapsed, peak_rss_mb)
+                print(f"    {server.num_requests:,} requests, {written / 2**20:,.0f} MB written to disk")
+                assert {name: os.path.getsize(os.path.join(out_dir, "ref", name)) for name in names} == sizes
+                shutil.rmtree(out_dir)
+
+
+if __name__ == "__main__":
+    main()
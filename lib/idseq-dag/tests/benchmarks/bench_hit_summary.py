@@ -0,0 +1,39 @@
+"""
+Time loading a synthetic merged hit summary with HitSummaryMergedReader, from its
+columnar sidecar and from the TSV.
+
+    python -m tests.benchmarks.bench_hit_summary --reads 30000000
+"""
+import argparse
+import os
+import tempfile
+
+from idseq_dag.util.parsing import HitSummaryMergedReader, sidecar_path
+
+from tests.benchmarks.harness import report, run_measured
+from tests.benchmarks.synthetic import write_hit_summary
+
+
+def load(path):
+    with open(path) as f:
+        return sum(1 for _ in HitSummaryMergedReader(f))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reads", type=int, default=30_000_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.hitsummary2.tab")
+        write_hit_summary(path, args.reads)
+        print(f"TSV {os.path.getsize(path) / 2**20:,.0f} MB, sidecar {os.path.getsize(sidecar_path(path)) / 2**20:,.0f} MB")
+        elapsed, peak_rss_mb, rows = run_measured(load, path)
+        report("HitSummaryMergedReader, sidecar", rows, elapsed, peak_rss_mb)
+        os.remove(sidecar_path(path))
+        elapsed, peak_rss_mb, rows = run_measured(load, path)
+        report("HitSummaryMergedReader, TSV", rows, elapsed, peak_rss_mb)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Compare rows/sec of the dict based blast6 reader with the columnar batch reader.
+
+    python -m tests.benchmarks.bench_parsing --rows 10000000
+"""
+import argparse
+import os
+import tempfile
+
+from idseq_dag.util.parsing import BlastnOutput6BatchReader, BlastnOutput6Reader
+
+from tests.benchmarks.harness import report, run_measured
+from tests.benchmarks.synthetic import write_m8
+
+
+def read_dicts(path):
+    rows = 0
+    with open(path) as f:
+        for _row in BlastnOutput6Reader(f, filter_invalid=True, min_alignment_length=36):
+            rows += 1
+    return rows
+
+
+def read_batches(path):
+    rows = 0
+    with open(path) as f:
+        for batch in BlastnOutput6BatchReader(f, filter_invalid=True, min_alignment_length=36):
+            rows += len(batch["qseqid"])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--hits-per-read", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        m8_path = os.path.join(tmp, "bench.m8")
+        total = write_m8(m8_path, args.rows // args.hits_per_read, args.hits_per_read)
+        print(f"{total:,} rows, {os.path.getsize(m8_path) / 2**20:,.0f} MB")
+
+        results = {}
+        for name, fn in [("BlastnOutput6Reader", read_dicts), ("BlastnOutput6BatchReader", read_batches)]:
+            elapsed, peak_rss_mb, kept = run_measured(fn, m8_path)
+            results[name] = (elapsed, kept)
+            report(name, total, elapsed, peak_rss_mb)
+        assert results["BlastnOutput6Reader"][1] == results["BlastnOutput6BatchReader"][1]
+        speedup = results["BlastnOutput6Reader"][0] / results["BlastnOutput6BatchReader"][0]
+        print(f"batch reader speedup: {speedup:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Check the presence of many S3 files, as a lazy run of the DAG does for every step's
+outputs, against a local S3 stand-in with a fixed latency per request.  Compares the
+shared boto client of util/s3.py, called from one thread and from several steps'
+threads at once, with the previous global botolock and 0.33 s rate_limit_boto sleep.
+
+    python -m tests.benchmarks.bench_s3_presence --files 60 --threads 8 --latency 0.02
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import boto3
+import botocore.exceptions
+
+import idseq_dag.util.s3 as s3
+from idseq_dag.util.thread_with_result import mt_map
+
+from tests.benchmarks.harness import report
+from tests.benchmarks.local_s3 import local_s3
+
+BUCKET_DIR = "s3://bucket/results"
+
+
+def rate_limit_boto(average_delay=0.33, last_call={}, botolock=threading.RLock()):  # pylint: disable=dangerous-default-value
+    ''' The previous rate limiter, sleeping to keep calls at least average_delay apart '''
+    with botolock:
+        t_since_last_call = time.time() - last_call.get("time", 0)
+        if t_since_last_call < average_delay:
+            time.sleep(average_delay - t_since_last_call)
+        last_call["time"] = time.time()
+
+
+def check_s3_presence_rate_limited(s3_path, botolock=threading.RLock()):
+    ''' The previous check_s3_presence, one call at a time through boto's default session '''
+    with botolock:
+        rate_limit_boto()
+        bucket, key = s3.split_identifiers(s3_path)
+        try:
+            return boto3.resource('s3').Object(bucket, key).content_length >= 0
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == "404":
+                return False
+            raise
+
+
+def check_all(check, files, num_threads):
+    ''' Check files split between num_threads threads, like concurrent steps checking their outputs '''
+    def check_share(i):
+        return sum(check(os.path.join(BUCKET_DIR, f)) for f in files[i::num_threads])
+    return sum(mt_map(check_share, range(num_threads)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=60)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds before the server answers a request")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, "bucket", "results"))
+        # Every other file is missing
+        files = [f"output_{i}.txt" for i in range(args.files)]
+        for f in files[::2]:
+            with open(os.path.join(tmp, "bucket", "results", f), "w") as out_f:
+                out_f.write(f)
+        with local_s3(tmp, args.latency) as server:
+            for name, check, num_threads in [("check_s3_presence", s3.check_s3_presence, 1),
+                                             ("check_s3_presence", s3.check_s3_presence, args.threads),
+                                             ("botolock and rate_limit_boto", check_s3_presence_rate_limited, 1),
+                                             ("botolock and rate_limit_boto", check_s3_presence_rate_limited, args.threads)]:
+                server.reset_counters()
+                t_start = time.perf_counter()
+                found = check_all(check, files, num_threads)
+                report(f"{name}, {num_threads} threads", args.files, time.perf_counter() - t_start)
+                assert found == len(files[::2])
+                assert server.num_requests == args.files
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Fetch reference sequences the way generate_alignment_viz does, 500 accessions per
+download_chunks call, from a synthetic NT served by a local HTTP server that answers
+S3 ranged GETs after a fixed latency.  The hit accessions come in runs of neighbours,
+as the accessions of related species tend to be in NT, so their ranges are a header
+apart.  Compares coalescing nearby ranges into one request with a request per range.
+
+    python -m tests.benchmarks.bench_s3quilt --accessions 100000 --hits 5000 --latency 0.02
+"""
+import argparse
+import functools
+import os
+import random
+import tempfile
+import time
+from unittest.mock import patch
+
+import boto3
+
+import idseq_dag.steps.generate_alignment_viz as generate_alignment_viz
+from idseq_dag.s3quilt import s3quilt_pure
+
+from tests.benchmarks.harness import report
+from tests.benchmarks.local_s3 import local_s3
+from tests.benchmarks.synthetic import accession_name, write_nt_fasta
+
+
+def hit_accessions(num_accessions, num_hits, run_length, seed=0):
+    ''' num_hits accessions, in runs of run_length consecutive ones, in hash order like accession2seq '''
+    randgen = random.Random(seed)
+    hits = set()
+    while len(hits) < num_hits:
+        first = randgen.randrange(num_accessions - run_length)
+        hits.update(accession_name(i) for i in range(first, first + run_length))
+    return list(hits)[:num_hits]
+
+
+def fetch_sequences(nt_loc_dict, accessions, max_gap):
+    accession2seq = {accession: {} for accession in accessions}
+    # Skip S3ChunkDownloader's region and credentials detection
+    client = boto3.client("s3")
+    with patch.object(s3quilt_pure.S3ChunkDownloader, "_create_s3_client", return_value=client), \
+            patch.object(generate_alignment_viz, "download_chunks",
+                         functools.partial(generate_alignment_viz.download_chunks, max_gap=max_gap)):
+        generate_alignment_viz.PipelineStepGenerateAlignmentViz.get_sequences_by_accession_list_from_file(
+            accession2seq, nt_loc_dict, "s3://bucket/nt")
+    return accession2seq
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--accessions", type=int, default=100_000, help="accessions in the synthetic NT")
+    parser.add_argument("--hits", type=int, default=5000, help="accessions to fetch")
+    parser.add_argument("--run-length", type=int, default=10, help="consecutive accessions per run of hits")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds before the server answers a request")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, "bucket"))
+        nt_loc_dict = write_nt_fasta(os.path.join(tmp, "bucket", "nt"), args.accessions)
+        accessions = hit_accessions(args.accessions, args.hits, args.run_length)
+        sequence_mb = sum(nt_loc_dict[accession][2] for accession in accessions) / 2**20
+        results = []
+        with local_s3(tmp, args.latency) as server:
+            for name, max_gap in [("coalesced", s3quilt_pure.DEFAULT_MAX_GAP), ("request per range", -1)]:
+                server.reset_counters()
+                t_start = time.perf_counter()
+                results.append(fetch_sequences(nt_loc_dict, accessions, max_gap))
+                elapsed = time.perf_counter() - t_start
+                report(f"download_chunks, {name}", args.hits, elapsed)
+                print(f"    {server.num_requests:,} requests, {server.bytes_sent / 2**20:.1f} MB transferred, "
+                      f"{sequence_mb / elapsed:.1f} MB/s of sequence")
+        assert results[0] == results[1]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Time the taxid filter of build_should_keep_filter on synthetic read lineages, with and
+without memoizing its result per lineage.
+
+    python -m tests.benchmarks.bench_should_keep --reads 10000000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from idseq_dag.util.m8 import DEFAULT_SHOULD_KEEP_CACHE_SIZE, build_should_keep_filter
+
+from tests.benchmarks.harness import report
+from tests.benchmarks.synthetic import sample_lineages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reads", type=int, default=10_000_000)
+    parser.add_argument("--species", type=int, default=20_000)
+    args = parser.parse_args()
+
+    lineages = sample_lineages(args.reads, args.species)
+    print(f"{args.reads:,} reads, {len(set(lineages)):,} distinct lineages")
+    with tempfile.TemporaryDirectory() as tmp:
+        deny_list_path = os.path.join(tmp, "deuterostomes.txt")
+        with open(deny_list_path, "w") as f:
+            f.write("".join(f"{taxid}\n" for taxid in range(100000, 100000 + args.species, 7)))
+        for name, cache_size in [("should_keep, memoized", DEFAULT_SHOULD_KEEP_CACHE_SIZE), ("should_keep, uncached", 0)]:
+            should_keep = build_should_keep_filter(deny_list_path, None, None, cache_size=cache_size)
+            t_start = time.perf_counter()
+            kept = sum(1 for lineage in lineages if should_keep(lineage))
+            report(f"{name} ({kept:,} kept)", args.reads, time.perf_counter() - t_start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Offline benchmark suite for the hot paths of util/m8.py and util/top_hits.py, on
+synthetic inputs with matching marisa taxonomy tries. Records rows/s and peak RSS per
+function. Results can be saved with --output and compared against a saved baseline
+with --baseline, which exits non-zero if any function got slower than --tolerance.
+
+    python -m tests.benchmarks.bench_suite --reads 1000000 --output before.json
+    python -m tests.benchmarks.bench_suite --reads 1000000 --baseline before.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from idseq_dag.util.m8 import call_hits_m8, generate_taxon_count_json_from_m8, summarize_hits
+from idseq_dag.util.top_hits import get_top_m8_nr, get_top_m8_nt
+
+from tests.benchmarks.harness import report, run_measured
+from tests.benchmarks.synthetic import write_blast_nt, write_duplicate_cluster_sizes, write_m8, write_taxonomy_tries
+
+
+def _summarize_hits(hit_summary_path):
+    read_dict, accession_dict, selected_genera = summarize_hits(hit_summary_path)
+    return len(read_dict)
+
+
+def _num_lines(path):
+    with open(path) as f:
+        return sum(1 for _ in f)
+
+
+def run_suite(tmp, args):
+    lineage_map_path, accession2taxid_path = write_taxonomy_tries(tmp, args.accessions, num_species=max(10, args.accessions // 20))
+    m8_path = os.path.join(tmp, "gsnap.m8")
+    m8_rows = write_m8(m8_path, args.reads, args.hits_per_read, args.accessions)
+    nt_path = os.path.join(tmp, "blast_nt.m8")
+    nt_rows = write_blast_nt(nt_path, args.contigs, num_accessions=args.accessions)
+    duplicate_cluster_sizes_path = os.path.join(tmp, "duplicate_cluster_sizes.tsv")
+    write_duplicate_cluster_sizes(duplicate_cluster_sizes_path, args.reads)
+    deduped_m8_path = os.path.join(tmp, "gsnap.deduped.m8")
+    hit_summary_path = os.path.join(tmp, "gsnap.hitsummary.tab")
+
+    benchmarks = [
+        ("call_hits_m8", m8_rows, call_hits_m8,
+         (m8_path, lineage_map_path, accession2taxid_path, deduped_m8_path, hit_summary_path, 36, None, None, None)),
+        ("summarize_hits", args.reads, _summarize_hits, (hit_summary_path,)),
+        ("generate_taxon_count_json_from_m8", None, generate_taxon_count_json_from_m8,
+         (deduped_m8_path, hit_summary_path, "NT", lineage_map_path, None, None, None,
+          duplicate_cluster_sizes_path, os.path.join(tmp, "taxon_counts.json"))),
+        ("get_top_m8_nr", m8_rows, get_top_m8_nr,
+         (m8_path, lineage_map_path, accession2taxid_path, os.path.join(tmp, "top_nr.m8"))),
+        ("get_top_m8_nt", nt_rows, get_top_m8_nt,
+         (nt_path, lineage_map_path, accession2taxid_path, os.path.join(tmp, "top_nt.m8"))),
+    ]
+    results = {}
+    for name, rows, fn, fn_args in benchmarks:
+        elapsed, peak_rss_mb, _ = run_measured(fn, *fn_args)
+        if rows is None:
+            # One row per called read in the outputs of call_hits_m8
+            rows = _num_lines(hit_summary_path)
+        report(name, rows, elapsed, peak_rss_mb)
+        results[name] = {"rows": rows, "seconds": elapsed, "rows_per_second": rows / elapsed, "peak_rss_mb": peak_rss_mb}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        speed = result["rows_per_second"] / baseline[name]["rows_per_second"]
+        rss = result["peak_rss_mb"] / baseline[name]["peak_rss_mb"]
+        print(f"{name:<48} {speed:>6.2f}x rows/s {rss:>6.2f}x peak RSS vs baseline")
+        if speed < 1 - tolerance or rss > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reads", type=int, default=1_000_000)
+    parser.add_argument("--hits-per-read", type=int, default=5)
+    parser.add_argument("--accessions", type=int, default=100_000)
+    parser.add_argument("--contigs", type=int, default=5_000)
+    parser.add_argument("--output", help="save the results to this json file")
+    parser.add_argument("--baseline", help="compare against results saved with --output")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fraction by which rows/s may drop or peak RSS may grow before it counts as a regression")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run_suite(tmp, args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Regressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
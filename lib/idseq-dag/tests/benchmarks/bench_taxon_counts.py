@@ -0,0 +1,51 @@
+"""
+Time generate_taxon_count_json_from_m8 on synthetic inputs with many distinct taxa, and
+compare its peak RSS with serializing the whole taxon_counts_attributes list at once.
+
+    python -m tests.benchmarks.bench_taxon_counts --species 200000
+"""
+import argparse
+import json
+import os
+import tempfile
+
+import idseq_dag.util.m8 as m8
+
+from tests.benchmarks.harness import report, run_measured
+from tests.benchmarks.synthetic import write_taxon_count_inputs, write_taxonomy_tries
+
+
+def _write_taxon_counts_json_all_at_once(outf, taxon_counts_rows):
+    json.dump({"pipeline_output": {"taxon_counts_attributes": list(taxon_counts_rows)}}, outf)
+
+
+def taxon_counts(m8_path, hit_summary_path, lineage_map_path, output_json, all_at_once):
+    if all_at_once:
+        m8._write_taxon_counts_json = _write_taxon_counts_json_all_at_once
+    m8.generate_taxon_count_json_from_m8(m8_path, hit_summary_path, "NT", lineage_map_path,
+                                         None, None, None, None, output_json)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--species", type=int, default=200_000)
+    parser.add_argument("--reads", type=int, default=400_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        m8_path = os.path.join(tmp, "bench.m8")
+        hit_summary_path = os.path.join(tmp, "bench.hitsummary2.tab")
+        write_taxon_count_inputs(m8_path, hit_summary_path, args.reads, args.species)
+        lineage_map_path, _ = write_taxonomy_tries(tmp, num_accessions=1, num_species=args.species)
+        for name, all_at_once in [("taxon counts json, streaming", False), ("taxon counts json, json.dump", True)]:
+            output_json = os.path.join(tmp, "taxon_counts.json")
+            elapsed, peak_rss_mb, _ = run_measured(taxon_counts, m8_path, hit_summary_path, lineage_map_path,
+                                                   output_json, all_at_once)
+            # Counted outside run_measured, loading the output would dominate its peak RSS
+            with open(output_json) as f:
+                num_taxa = len(json.load(f)["pipeline_output"]["taxon_counts_attributes"])
+            report(f"{name} ({num_taxa:,} taxa)", args.reads, elapsed, peak_rss_mb)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Time PipelineStep.uploading_results for a step with many output files against a
+local, filesystem-backed stand-in for s3parcp that adds a fixed latency to every
+request.  The real upload_with_retries runs, including its retries and the s3
+upload semaphores.
+
+    python -m tests.benchmarks.bench_uploads --files 200 --latency 0.1
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from unittest.mock import patch
+from urllib.parse import urlparse
+
+import idseq_dag.util.s3 as s3
+from idseq_dag.engine.pipeline_step import PipelineStep
+
+from tests.benchmarks.harness import report
+
+
+class ManyOutputsStep(PipelineStep):
+    def run(self):
+        for f in self.output_files_local():
+            with open(f, "w") as out_f:
+                out_f.write(self.name)
+
+    def count_reads(self):
+        pass
+
+
+def local_s3parcp(bucket_dir, latency):
+    ''' Stand-in for command.execute that copies s3parcp uploads into bucket_dir '''
+    def execute(command, *args, **kwargs):
+        time.sleep(latency)
+        from_f, to_f = command.args[-2:]
+        dst = os.path.join(bucket_dir, urlparse(to_f).netloc, urlparse(to_f).path.lstrip("/"))
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copy(from_f, dst)
+    return execute
+
+
+def upload_sequentially(step):
+    ''' The previous implementation of uploading_results, one file after another '''
+    for f in step.output_files_local():
+        s3.upload_with_retries(f, step.s3_path(f), checksum=step.upload_results_with_checksum)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds added to every upload")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results_dir = os.path.join(tmp, "results")
+        bucket_dir = os.path.join(tmp, "s3")
+        step = ManyOutputsStep("many_outputs", [], [f"out_{i}.txt" for i in range(args.files)], results_dir,
+                               "s3://bucket/results", tmp, {}, {})
+        step.run()
+        with patch.object(s3, "refreshed_credentials", return_value={}), \
+                patch.object(s3.command, "execute", local_s3parcp(bucket_dir, args.latency)):
+            for name, upload in [("uploading_results", PipelineStep.uploading_results),
+                                 ("uploading_results, sequential", upload_sequentially)]:
+                shutil.rmtree(bucket_dir, ignore_errors=True)
+                step._files_seen = set()
+                t_start = time.perf_counter()
+                upload(step)
+                report(name, args.files, time.perf_counter() - t_start)
+                assert len(os.listdir(os.path.join(bucket_dir, "bucket", "results"))) == args.files
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Run many small hit-calling-like tasks, each looking up the lineages of a few accessions
+in the marisa taxonomy tries, either forking a process per task with run_in_subprocess,
+which also reopens the tries every time, or on a WorkerPool whose workers open the tries
+once.  The pipeline process holds --parent-mb of memory, since forking a large process
+is slower than forking a small one.
+
+    python -m tests.benchmarks.bench_worker_pool --tasks 1000 --workers 4
+"""
+import argparse
+import random
+import tempfile
+
+import idseq_dag.util.command as command
+from idseq_dag.util.dict import open_file_db_by_extension
+from idseq_dag.util.thread_with_result import mt_map
+
+from tests.benchmarks.harness import report, run_measured
+from tests.benchmarks.synthetic import accession_name, write_taxonomy_tries
+
+ACCESSIONS_PER_TASK = 100
+
+
+def _task_accessions(task, num_accessions):
+    randgen = random.Random(task)
+    return [accession_name(randgen.randrange(num_accessions)).split(".")[0] for _ in range(ACCESSIONS_PER_TASK)]
+
+
+def _lookup(lineage_map, accession2taxid_dict, accessions):
+    return sum(1 for accession in accessions
+               if accession in accession2taxid_dict and lineage_map.get(accession2taxid_dict[accession]))
+
+
+def _open_tries(lineage_map_path, accession2taxid_dict_path):
+    return {
+        "lineage_map": open_file_db_by_extension(lineage_map_path, "lll"),
+        "accession2taxid_dict": open_file_db_by_extension(accession2taxid_dict_path, "L"),
+    }
+
+
+def _pooled_task(args):
+    task, num_accessions = args
+    return _lookup(command.worker_resource("lineage_map"), command.worker_resource("accession2taxid_dict"),
+                   _task_accessions(task, num_accessions))
+
+
+def run_pooled(tries, num_tasks, num_accessions, num_workers, parent_mb):
+    ballast = bytearray(parent_mb * 2**20)  # noqa: F841
+    with command.WorkerPool(num_workers, _open_tries, tries) as pool:
+        return sum(pool.map(_pooled_task, [(task, num_accessions) for task in range(num_tasks)]))
+
+
+def run_forked(tries, num_tasks, num_accessions, num_workers, parent_mb):
+    ballast = bytearray(parent_mb * 2**20)  # noqa: F841
+
+    @command.run_in_subprocess
+    def forked_task(task):
+        # The caller can't see a return value, as in the pipeline's run_in_subprocess functions
+        with open_file_db_by_extension(tries[0], "lll") as lineage_map, \
+                open_file_db_by_extension(tries[1], "L") as accession2taxid_dict:  # noqa
+            _lookup(lineage_map, accession2taxid_dict, _task_accessions(task, num_accessions))
+
+    def worker(first_task):
+        for task in range(first_task, num_tasks, num_workers):
+            forked_task(task)
+
+    # Plain threads, as in mt_map: a run_in_subprocess child forked from a ThreadPoolExecutor
+    # thread fails at exit, joining the executor's threads
+    mt_map(worker, range(num_workers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--accessions", type=int, default=1_000_000)
+    parser.add_argument("--parent-mb", type=int, default=500, help="memory held by the pipeline process")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tries = write_taxonomy_tries(tmp, args.accessions, num_species=args.accessions // 20)
+        for name, run in [("WorkerPool", run_pooled), ("run_in_subprocess per task", run_forked)]:
+            elapsed, _peak_rss_mb, found = run_measured(run, tries, args.tasks, args.accessions, args.workers, args.parent_mb)
+            report(f"{name}, {args.workers} workers", args.tasks, elapsed)
+            if found is not None:
+                with open_file_db_by_extension(tries[0], "lll") as lineage_map, \
+                        open_file_db_by_extension(tries[1], "L") as accession2taxid_dict:  # noqa
+                    assert found == sum(_lookup(lineage_map, accession2taxid_dict, _task_accessions(task, args.accessions))
+                                        for task in range(args.tasks))
+
+
+if __name__ == "__main__":
+    main()
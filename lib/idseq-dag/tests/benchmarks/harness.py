@@ -0,0 +1,38 @@
+import multiprocessing
+import resource
+import time
+
+
+def _measured_target(conn, fn, args, kwargs):
+    t_start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    elapsed = time.perf_counter() - t_start
+    # ru_maxrss is reported in kilobytes on linux.  Include children for code that
+    # runs under command.run_in_subprocess.
+    peak_rss_mb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    conn.send((elapsed, peak_rss_mb, result))
+    conn.close()
+
+
+def run_measured(fn, *args, **kwargs):
+    '''
+    Run fn(*args, **kwargs) in a fresh child process so peak RSS is attributable to fn alone.
+    Returns (elapsed_seconds, peak_rss_mb, result). The result must be picklable.
+    '''
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=_measured_target, args=(child_conn, fn, args, kwargs))
+    p.start()
+    child_conn.close()
+    elapsed, peak_rss_mb, result = parent_conn.recv()
+    p.join()
+    assert p.exitcode == 0, f"benchmark of {fn.__qualname__} failed with code {p.exitcode}"
+    return elapsed, peak_rss_mb, result
+
+
+def report(name, rows, elapsed, peak_rss_mb=None):
+    line = f"{name:<48} {rows:>12,} rows {elapsed:>9.2f} s {rows / elapsed:>14,.0f} rows/s"
+    if peak_rss_mb is not None:
+        line += f" {peak_rss_mb:>10.1f} MB peak RSS"
+    print(line)
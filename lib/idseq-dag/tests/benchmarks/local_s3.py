@@ -0,0 +1,150 @@
+"""
+A local stand-in for S3, serving the files under a directory as s3://<bucket>/<key> at
+<root>/<bucket>/<key> over HTTP, after a fixed latency per request, for benchmarking
+the boto-based code in util/s3.py and s3quilt offline.  It answers HeadObject,
+GetObject, with or without a Range, and ListObjectsV2, and counts requests and bytes sent.
+"""
+import contextlib
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from urllib.parse import parse_qs, quote, unquote, urlparse
+from xml.sax.saxutils import escape
+
+
+class LocalS3Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, root, latency=0.0, max_keys=1000):
+        super().__init__(("127.0.0.1", 0), LocalS3RequestHandler)
+        self.root = root
+        self.latency = latency
+        self.max_keys = max_keys
+        self.num_requests = 0
+        self.bytes_sent = 0
+        self.counter_lock = threading.Lock()
+
+    @property
+    def endpoint_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def reset_counters(self):
+        with self.counter_lock:
+            self.num_requests = 0
+            self.bytes_sent = 0
+
+    def count(self, num_bytes):
+        with self.counter_lock:
+            self.num_requests += 1
+            self.bytes_sent += num_bytes
+
+
+class LocalS3RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _path(self):
+        return os.path.join(self.server.root, unquote(urlparse(self.path).path).lstrip("/"))
+
+    def _send(self, status, headers, body=b""):
+        # Counted before the client can see the response, so that its counters are current once it has
+        self.server.count(len(body))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _not_found(self):
+        body = b"<?xml version='1.0' encoding='UTF-8'?><Error><Code>NoSuchKey</Code></Error>"
+        if self.command == "HEAD":
+            body = b""
+        self._send(404, {"Content-Type": "application/xml", "Content-Length": str(len(body))}, body)
+
+    def do_HEAD(self):
+        time.sleep(self.server.latency)
+        path = self._path()
+        if not os.path.isfile(path):
+            self._not_found()
+            return
+        st = os.stat(path)
+        self._send(200, {"Content-Length": str(st.st_size), "ETag": f'"{st.st_size:x}-{st.st_mtime_ns:x}"'})
+
+    def _list_objects_v2(self, bucket, query):
+        prefix = query.get("prefix", [""])[0]
+        after = query.get("continuation-token", query.get("start-after", [""]))[0]
+        max_keys = min(int(query.get("max-keys", [self.server.max_keys])[0]), self.server.max_keys)
+        bucket_dir = os.path.join(self.server.root, bucket)
+        keys = []
+        for dirpath, _dirnames, filenames in os.walk(bucket_dir):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), bucket_dir).replace(os.sep, "/")
+                if key.startswith(prefix) and key > after:
+                    keys.append(key)
+        keys.sort()
+        page = keys[:max_keys]
+        url_encoded = query.get("encoding-type") == ["url"]
+
+        def encode(key):
+            return quote(key) if url_encoded else escape(key)
+
+        contents = "".join(f"<Contents><Key>{encode(key)}</Key>"
+                           f"<Size>{os.path.getsize(os.path.join(bucket_dir, key))}</Size>"
+                           f"<LastModified>2020-01-01T00:00:00.000Z</LastModified><StorageClass>STANDARD</StorageClass>"
+                           f"</Contents>" for key in page)
+        truncated = len(keys) > max_keys
+        body = ("<?xml version='1.0' encoding='UTF-8'?>"
+                "<ListBucketResult xmlns='http://s3.amazonaws.com/doc/2006-03-01/'>"
+                f"<Name>{bucket}</Name><Prefix>{encode(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount>"
+                f"<MaxKeys>{max_keys}</MaxKeys><IsTruncated>{str(truncated).lower()}</IsTruncated>"
+                + (f"<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>" if truncated else "")
+                + ("<EncodingType>url</EncodingType>" if url_encoded else "")
+                + f"{contents}</ListBucketResult>").encode()
+        self._send(200, {"Content-Type": "application/xml", "Content-Length": str(len(body))}, body)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if query.get("list-type") == ["2"]:
+            self._list_objects_v2(unquote(url.path).strip("/"), query)
+            return
+        path = self._path()
+        if not os.path.isfile(path):
+            self._not_found()
+            return
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            if self.headers["Range"]:
+                start, end = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers["Range"]).groups()
+                start, end = int(start), int(end or size - 1)
+                f.seek(start)
+                body = f.read(end + 1 - start)
+                self._send(206, {"Content-Length": str(len(body)),
+                                 "Content-Range": f"bytes {start}-{start + len(body) - 1}/{size}"}, body)
+            else:
+                body = f.read()
+                self._send(200, {"Content-Length": str(len(body))}, body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def local_s3(root, latency=0.0, max_keys=1000):
+    ''' Serve root as S3, with boto clients created meanwhile pointed at it '''
+    server = LocalS3Server(root, latency, max_keys)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    env = {"AWS_ENDPOINT_URL_S3": server.endpoint_url, "AWS_ACCESS_KEY_ID": "local", "AWS_SECRET_ACCESS_KEY": "local",
+           "AWS_DEFAULT_REGION": "us-west-2", "AWS_EC2_METADATA_DISABLED": "true"}
+    try:
+        with patch.dict(os.environ, env):
+            yield server
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,243 @@
+"""
+Deterministic synthetic inputs for the benchmarks in this package.
+"""
+import os
+import random
+
+import marisa_trie
+
+from idseq_dag.util.parsing import HitSummaryMergedWriter, HitSummaryWriter
+
+
+def accession_name(i):
+    return f"ACC{i:09d}.1"
+
+
+def read_name(i):
+    return f"read_{i:010d}/1"
+
+
+def write_m8(path, num_reads, hits_per_read=5, num_accessions=10000, seed=0):
+    '''
+    Write a blast6 file with num_reads read groups of hits_per_read rows each, in the
+    (qseqid grouped, bitscore descending) order produced by our aligners.
+    Returns the number of rows written.
+    '''
+    randgen = random.Random(seed)
+    rows = 0
+    with open(path, "w") as f:
+        for read in range(num_reads):
+            read_id = read_name(read)
+            bitscore = randgen.uniform(50, 300)
+            for _ in range(hits_per_read):
+                accession = accession_name(randgen.randrange(num_accessions))
+                length = randgen.randint(30, 150)
+                pident = round(randgen.uniform(80, 100), 1)
+                qstart = randgen.randint(1, 20)
+                sstart = randgen.randint(1, 100000)
+                evalue = 10 ** -randgen.uniform(5, 80)
+                f.write(f"{read_id}\t{accession}\t{pident}\t{length}\t{randgen.randint(0, 5)}\t0\t"
+                        f"{qstart}\t{qstart + length - 1}\t{sstart}\t{sstart + length - 1}\t{evalue:.2g}\t{bitscore:.1f}\n")
+                rows += 1
+                # ties are common in real data, only sometimes lower the score
+                if randgen.random() < 0.5:
+                    bitscore -= randgen.uniform(0, 10)
+    return rows
+
+
+def write_taxonomy_tries(output_dir, num_accessions=10000, num_species=2000, seed=0):
+    '''
+    Build matching accession2taxid ("L") and taxid lineage ("lll") marisa tries for the
+    accessions produced by accession_name(0 .. num_accessions - 1). About 5% of the
+    accessions are left unmapped and some species have no genus, as in NCBI.
+    Returns (lineage_map_path, accession2taxid_dict_path).
+    '''
+    randgen = random.Random(seed)
+    num_genera = max(1, num_species // 5)
+    num_families = max(1, num_genera // 5)
+    lineages = {}
+    for species in range(num_species):
+        species_taxid = 100000 + species
+        genus_taxid = 10000 + randgen.randrange(num_genera) if randgen.random() > 0.02 else -200
+        family_taxid = 1000 + randgen.randrange(num_families)
+        lineages[str(species_taxid)] = (species_taxid, genus_taxid, family_taxid)
+    accession2taxid = {}
+    for i in range(num_accessions):
+        if randgen.random() > 0.05:
+            accession2taxid[accession_name(i).split(".")[0]] = (100000 + randgen.randrange(num_species),)
+
+    lineage_map_path = os.path.join(output_dir, "taxid-lineages.marisa")
+    accession2taxid_dict_path = os.path.join(output_dir, "accession2taxid.marisa")
+    marisa_trie.RecordTrie("lll", lineages.items()).save(lineage_map_path)
+    marisa_trie.RecordTrie("L", accession2taxid.items()).save(accession2taxid_dict_path)
+    return lineage_map_path, accession2taxid_dict_path
+
+
+def write_taxon_count_inputs(m8_path, hit_summary_path, num_reads, num_species=2000, seed=0):
+    '''
+    Write a reranked blast6 file and the matching merged hit summary, one row per read,
+    with reads called at the species level and spread over every species taxid of
+    write_taxonomy_tries(..., num_species=num_species).
+    '''
+    randgen = random.Random(seed)
+    with open(m8_path, "w") as m8_f, open(hit_summary_path, "w") as hit_summary_f:
+        for read in range(num_reads):
+            read_id = read_name(read)
+            taxid = 100000 + read % num_species
+            accession = accession_name(randgen.randrange(1000000))
+            length = randgen.randint(30, 150)
+            pident = round(randgen.uniform(80, 100), 1)
+            evalue = 10 ** -randgen.uniform(5, 80)
+            m8_f.write(f"{read_id}\t{accession}\t{pident}\t{length}\t0\t0\t1\t{length}\t1\t{length}\t{evalue:.2g}\t"
+                       f"{randgen.uniform(50, 300):.1f}\t150\t10000\t{length / 150:.3f}\t1\n")
+            hit_summary_f.write(f"{read_id}\t1\t{taxid}\t{accession}\t{taxid}\t-200\t-300\t\t\t\t\t\t\tNT\n")
+
+
+def write_hit_summary(path, num_reads, num_species=2000, seed=0, merged=True):
+    '''
+    Write a hit summary, merged or not, with one row per read. It is written through
+    HitSummaryMergedWriter or HitSummaryWriter so that it gets its columnar sidecar too.
+    '''
+    randgen = random.Random(seed)
+    writer_cls = HitSummaryMergedWriter if merged else HitSummaryWriter
+    with open(path, "w") as f, writer_cls(f, sidecar=True) as writer:
+        for read in range(num_reads):
+            species_taxid = 100000 + randgen.randrange(num_species)
+            accession = accession_name(randgen.randrange(1000000))
+            row = {
+                "read_id": read_name(read), "level": 1, "taxid": species_taxid, "accession_id": accession,
+                "species_taxid": species_taxid, "genus_taxid": 10000 + species_taxid % 400, "family_taxid": 1000 + species_taxid % 80,
+            }
+            if merged:
+                row["source_count_type"] = "NT"
+            writer.writerow(row)
+
+
+def write_duplicate_cluster_sizes(path, num_reads, seed=0):
+    '''
+    Write the duplicate cluster sizes of reads read_name(0 .. num_reads - 1), in the format
+    of count.save_duplicate_cluster_sizes. Most clusters are singletons.
+    '''
+    randgen = random.Random(seed)
+    with open(path, "w") as f:
+        for read in range(num_reads):
+            cluster_size = 1 if randgen.random() < 0.8 else int(randgen.paretovariate(1.5)) + 1
+            f.write(f"{cluster_size}\t{read_name(read)[:-2]}\n")
+
+
+def write_blast_nt(path, num_contigs, subjects_per_contig=20, hsps_per_subject=5, num_accessions=10000, seed=0):
+    '''
+    Write blastn output for contigs against NT, with the qlen and slen columns read by
+    BlastnOutput6NTReader. Each contig is aligned to subjects_per_contig accessions with
+    hsps_per_subject fragments each, in decreasing bitscore order per subject.
+    Returns the number of rows written.
+    '''
+    randgen = random.Random(seed)
+    rows = 0
+    with open(path, "w") as f:
+        for contig in range(num_contigs):
+            qlen = randgen.randint(300, 5000)
+            contig_id = f"NODE_{contig}_length_{qlen}_cov_{randgen.uniform(1, 50):.6f}"
+            for _ in range(subjects_per_contig):
+                accession = accession_name(randgen.randrange(num_accessions))
+                slen = randgen.randint(qlen, 50000)
+                bitscore = randgen.uniform(50, 2000)
+                for _ in range(hsps_per_subject):
+                    length = randgen.randint(36, min(qlen, 1000))
+                    qstart = randgen.randint(1, qlen - length + 1)
+                    sstart = randgen.randint(1, slen - length + 1)
+                    pident = round(randgen.uniform(78, 100), 3)
+                    evalue = 10 ** -randgen.uniform(0, 150)
+                    f.write(f"{contig_id}\t{accession}\t{pident}\t{length}\t{randgen.randint(0, 20)}\t{randgen.randint(0, 3)}\t"
+                            f"{qstart}\t{qstart + length - 1}\t{sstart}\t{sstart + length - 1}\t{evalue:.2g}\t{bitscore:.1f}\t{qlen}\t{slen}\n")
+                    rows += 1
+                    bitscore -= randgen.uniform(0, bitscore / 4)
+    return rows
+
+
+def sample_lineages(num_reads, num_species=20000, seed=0):
+    '''
+    Cleaned (species, genus, family) taxid tuples for num_reads reads. Species abundance
+    follows a Zipf distribution, as in real samples, where a few taxa take most reads,
+    and about 10% of the reads are only called at the genus level.
+    '''
+    randgen = random.Random(seed)
+    lineages = []
+    for species in range(num_species):
+        genus = 10000 + species // 5
+        family = 1000 + species // 25
+        lineages.append((str(100000 + species), str(genus), str(family)))
+        lineages.append((str(-100 * genus), str(genus), str(family)))
+    weights = [1 / (rank // 2 + 1) ** 1.1 * (0.9 if rank % 2 == 0 else 0.1) for rank in range(len(lineages))]
+    return randgen.choices(lineages, weights, k=num_reads)
+
+
+def write_reads(path, num_bytes, fastq=True, read_length=150, seed=0):
+    '''
+    Write FASTA or FASTQ reads read_name(0 ..) until the file holds about num_bytes.
+    Returns the number of reads written.
+    '''
+    randgen = random.Random(seed)
+    # Reuse a pool of sequences, generating every base is far slower than counting them
+    sequences = ["".join(randgen.choice("ACGT") for _ in range(read_length)) for _ in range(1000)]
+    quality = "I" * read_length
+    num_reads = 0
+    written = 0
+    with open(path, "w") as f:
+        while written < num_bytes:
+            lines = []
+            for read in range(num_reads, num_reads + 10000):
+                if fastq:
+                    lines.append(f"@{read_name(read)}\n{sequences[read % 1000]}\n+\n{quality}\n")
+                else:
+                    lines.append(f">{read_name(read)}\n{sequences[read % 1000]}\n")
+            text = "".join(lines)
+            f.write(text)
+            written += len(text)
+            num_reads += len(lines)
+    return num_reads
+
+
+def write_nt_fasta(path, num_accessions, min_length=500, max_length=5000, line_length=80, seed=0):
+    '''
+    Write an NT-like FASTA of accessions accession_name(0 .. num_accessions - 1), wrapped
+    at line_length, and return its loc dict, accession => (range_start, header_len, seq_len),
+    as used by generate_alignment_viz and download_accessions.
+    '''
+    randgen = random.Random(seed)
+    # Reuse a pool of sequences, generating every base is far slower than writing them
+    bases = "".join(randgen.choice("ACGT") for _ in range(max_length + 1000))
+    loc_dict = {}
+    offset = 0
+    with open(path, "wb") as f:
+        for i in range(num_accessions):
+            header = f">{accession_name(i)} Synthetic organism {i}, complete genome\n".encode()
+            length = randgen.randint(min_length, max_length)
+            seq_start = randgen.randrange(1000)
+            sequence = bases[seq_start:seq_start + length]
+            wrapped = "".join(sequence[j:j + line_length] + "\n" for j in range(0, length, line_length)).encode()
+            f.write(header)
+            f.write(wrapped)
+            loc_dict[accession_name(i)] = (offset, len(header), len(wrapped))
+            offset += len(header) + len(wrapped)
+    return loc_dict
+
+
+def write_reference_files(output_dir, num_bytes, num_files=8, seed=0):
+    '''
+    Write num_files files of random bases into output_dir, about num_bytes in all, like the
+    files of a STAR or bowtie2 index.  Returns the file names.
+    '''
+    randgen = random.Random(seed)
+    # Slices of a pool of random bases, longer than any compressor's window
+    pool = randgen.randbytes(2**22).translate(bytes(b"ACGT"[i % 4] for i in range(256)))
+    names = [f"index_{i}.dat" for i in range(num_files)]
+    for name in names:
+        with open(os.path.join(output_dir, name), "wb") as f:
+            remaining = num_bytes // num_files
+            while remaining > 0:
+                start = randgen.randrange(len(pool) // 2)
+                chunk = pool[start:start + min(remaining, len(pool) // 2)]
+                f.write(chunk)
+                remaining -= len(chunk)
+    return names
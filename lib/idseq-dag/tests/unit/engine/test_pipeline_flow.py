@@ -0,0 +1,113 @@
+import json
+import os
+import random
+import unittest
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from idseq_dag.engine.pipeline_flow import PipelineFlow
+
+
+def _step(out, inputs, additional_files=None):
+    return {"in": inputs, "out": out, "class": "NoOpStep", "module": "tests.unit.engine.test_pipeline_step",
+            "additional_files": additional_files or {}, "additional_attributes": {}}
+
+
+def _random_dag(num_steps, seed=0):
+    ''' Steps reading from up to 3 earlier targets, listed in shuffled order '''
+    rng = random.Random(seed)
+    targets = {"fastqs": ["reads.fq"]}
+    steps = []
+    for i in range(num_steps):
+        out = f"target_{i}"
+        targets[out] = [f"{out}.txt"]
+        inputs = rng.sample(list(targets)[:-1], min(i + 1, rng.randint(1, 3)))
+        steps.append(_step(out, inputs, {"ref": f"s3://bucket/ref_{i}"}))
+    rng.shuffle(steps)
+    return targets, steps
+
+
+class _CountingStep(dict):
+    ''' Step that counts reads of its fields, summed over all the steps '''
+    reads = 0
+
+    def __getitem__(self, key):
+        _CountingStep.reads += 1
+        return super().__getitem__(key)
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _flow(self, targets, steps, step_costs=None, lazy_run=False):
+        dag_json = os.path.join(self.tmp.name, "dag.json")
+        with open(dag_json, "w") as f:
+            json.dump({"name": "test", "output_dir_s3": "s3://bucket/results", "targets": targets, "steps": steps,
+                       "given_targets": {"fastqs": {"s3_dir": "s3://bucket/samples"}},
+                       "output_dir_local": os.path.join(self.tmp.name, "results"),
+                       "ref_dir_local": os.path.join(self.tmp.name, "ref")}, f)
+        step_costs_json = None
+        if step_costs:
+            step_costs_json = os.path.join(self.tmp.name, "step_costs.json")
+            with open(step_costs_json, "w") as f:
+                json.dump(step_costs, f)
+        with patch("idseq_dag.util.s3.check_s3_presence", return_value=True):
+            return PipelineFlow(lazy_run, dag_json, versioned_output=False, step_costs_json=step_costs_json)
+
+    @patch("idseq_dag.util.s3.check_s3_presence_for_file_list", return_value=False)
+    def test_large_dag(self, _mock_check):
+        targets, steps = _random_dag(1000)
+        flow = self._flow(targets, steps)
+        flow.steps = [_CountingStep(step) for step in flow.steps]
+        _CountingStep.reads = 0
+        step_list, large_file_list, covered_targets = flow.plan()
+        # Planning reads each step a bounded number of times, about 15, so it takes linear time
+        self.assertLessEqual(_CountingStep.reads, 20 * len(steps))
+
+        self.assertCountEqual([step["out"] for step in step_list], [step["out"] for step in steps])
+        planned = {"fastqs"}
+        for step in step_list:
+            self.assertTrue(planned.issuperset(step["in"]), f"{step['out']} planned before its inputs")
+            planned.add(step["out"])
+            depth = 1 + max(covered_targets[target]["depth"] for target in step["in"])
+            self.assertEqual(covered_targets[step["out"]]["depth"], depth)
+        self.assertEqual(large_file_list, [step["additional_files"]["ref"] for step in step_list])
+
+    def test_lazy_run(self):
+        # target_1 is already in s3, but target_2 isn't, so target_3 has to be regenerated
+        targets = {"fastqs": ["reads.fq"], **{f"target_{i}": [f"target_{i}.txt"] for i in range(4)}}
+        steps = [_step("target_3", ["target_2"]), _step("target_2", ["target_0"]),
+                 _step("target_1", ["fastqs"]), _step("target_0", ["fastqs"])]
+        flow = self._flow(targets, steps, lazy_run=True)
+        with patch("idseq_dag.util.s3.check_s3_presence_for_file_list",
+                   side_effect=lambda _dir, file_list: file_list != ["target_2.txt"]):
+            step_list, _large_file_list, covered_targets = flow.plan()
+        self.assertEqual([step["out"] for step in step_list], ["target_2", "target_3"])
+        self.assertTrue(covered_targets["target_0"]["s3_downloadable"])
+        self.assertTrue(covered_targets["target_1"]["s3_downloadable"])
+        self.assertFalse(covered_targets["target_3"]["lazy_run"])
+
+    @patch("idseq_dag.util.s3.check_s3_presence_for_file_list", return_value=False)
+    def test_critical_path_first(self, _mock_check):
+        targets = {"fastqs": ["reads.fq"], "quick": ["quick.txt"], "slow": ["slow.txt"], "after_slow": ["after_slow.txt"]}
+        steps = [_step("quick", ["fastqs"], {"ref": "quick_ref"}), _step("slow", ["fastqs"], {"ref": "slow_ref"}),
+                 _step("after_slow", ["slow"], {"ref": "after_slow_ref"})]
+        step_list, large_file_list, _covered_targets = self._flow(targets, steps).plan()
+        # Without historical costs, the longest chain of steps goes first
+        self.assertEqual([step["out"] for step in step_list], ["slow", "quick", "after_slow"])
+        self.assertEqual(large_file_list, ["slow_ref", "quick_ref", "after_slow_ref"])
+
+        step_list, _large_file_list, _covered_targets = self._flow(
+            targets, steps, step_costs={"quick": 100, "slow": 1, "after_slow": 1}).plan()
+        self.assertEqual([step["out"] for step in step_list], ["quick", "slow", "after_slow"])
+
+    @patch("idseq_dag.util.s3.check_s3_presence_for_file_list", return_value=False)
+    def test_cycle(self, _mock_check):
+        targets = {"fastqs": ["reads.fq"], "a": ["a.txt"], "b": ["b.txt"]}
+        steps = [_step("a", ["fastqs", "b"]), _step("b", ["a"])]
+        with self.assertRaisesRegex(ValueError, "depend on each other"):
+            self._flow(targets, steps).plan()
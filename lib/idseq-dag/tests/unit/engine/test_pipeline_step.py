@@ -0,0 +1,231 @@
+import os
+import random
+import threading
+import time
+import unittest
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+import idseq_dag.engine.pipeline_step as pipeline_step
+import idseq_dag.util.s3 as s3
+from idseq_dag.engine.pipeline_step import CompletionRegistry, PipelineStep, ResourceBudget
+
+
+class NoOpStep(PipelineStep):
+    def run(self):
+        for f in self.output_files_local():
+            with open(f, "w") as out_f:
+                out_f.write(self.name)
+
+    def count_reads(self):
+        pass
+
+
+def _no_op_dag(output_dir_local, completion_registry, num_steps):
+    ''' A chain of num_steps steps, and a step joining the outputs of all of them '''
+    steps = []
+    for i in range(num_steps):
+        steps.append(NoOpStep(f"step_{i}", [[f"out_{i - 1}.txt"]], [f"out_{i}.txt"], output_dir_local, "s3://bucket/results",
+                              output_dir_local, {}, {}, completion_registry=completion_registry))
+    steps.append(NoOpStep("join", [[f"out_{i}.txt"] for i in range(num_steps)], ["joined.txt"], output_dir_local,
+                          "s3://bucket/results", output_dir_local, {}, {}, completion_registry=completion_registry))
+    return steps
+
+
+@patch("idseq_dag.util.s3.upload_with_retries")
+class TestCompletionRegistry(unittest.TestCase):
+    NUM_STEPS = 25
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.given_input = os.path.join(self.tmp.name, "out_-1.txt")
+        self.steps = []
+
+    def tearDown(self):
+        # Don't leave steps waiting forever if a test failed
+        for step in self.steps:
+            step.stop_waiting()
+        self.tmp.cleanup()
+
+    def _write_given_input(self):
+        with open(self.given_input, "w") as f:
+            f.write("input")
+        with open(PipelineStep.done_file(self.given_input), "w") as f:
+            f.write("done")
+
+    def test_scheduling_overhead(self, _mock_upload):
+        self._write_given_input()
+        steps = self.steps = _no_op_dag(self.tmp.name, CompletionRegistry(), self.NUM_STEPS)
+        t_start = time.perf_counter()
+        for step in steps:
+            step.start()
+        for step in steps:
+            step.wait_until_all_done()
+        elapsed = time.perf_counter() - t_start
+        # Polling for .done files would add up to INPUT_FILES_POLL_INTERVAL per edge of the chain
+        overhead_per_edge = elapsed / self.NUM_STEPS
+        self.assertLess(overhead_per_edge, 0.1, f"{elapsed:.3f}s for {self.NUM_STEPS} steps")
+        self.assertEqual(steps[-1].input_files_local[-1], [os.path.join(self.tmp.name, f"out_{self.NUM_STEPS - 1}.txt")])
+
+    def test_done_file_fallback(self, _mock_upload):
+        # An input written by another process is only announced by its .done file
+        with patch.object(pipeline_step, "INPUT_FILES_POLL_INTERVAL", 0.05):
+            steps = self.steps = _no_op_dag(self.tmp.name, CompletionRegistry(), 2)
+            for step in steps:
+                step.start()
+            threading.Timer(0.2, self._write_given_input).start()
+            for step in steps:
+                step.wait_until_all_done()
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, "joined.txt")))
+
+    def test_stop_waiting(self, _mock_upload):
+        steps = self.steps = _no_op_dag(self.tmp.name, CompletionRegistry(), 1)
+        for step in steps:
+            step.start()
+        t_start = time.perf_counter()
+        for step in steps:
+            step.stop_waiting()
+        for step in steps:
+            with self.assertRaises(RuntimeError):
+                step.wait_until_finished()
+        self.assertLess(time.perf_counter() - t_start, 1)
+
+
+class TestUploadingResults(unittest.TestCase):
+    NUM_FILES = 20
+    UPLOAD_SECONDS = 0.05
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.step = NoOpStep("many_outputs", [], [f"out_{i}.txt" for i in range(self.NUM_FILES)], self.tmp.name,
+                             "s3://bucket/results", self.tmp.name, {}, {})
+        self.step.run()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.uploaded = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _upload(self, from_f, to_f, checksum=False, fail=False):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.UPLOAD_SECONDS)
+        with self.lock:
+            self.in_flight -= 1
+            self.uploaded.append(to_f)
+        if fail:
+            raise RuntimeError("upload of %s failed" % from_f)
+
+    def test_concurrent_uploads(self):
+        with patch("idseq_dag.util.s3.upload_with_retries", side_effect=self._upload):
+            t_start = time.perf_counter()
+            self.step.uploading_results()
+            elapsed = time.perf_counter() - t_start
+        self.assertEqual(self.step.status, pipeline_step.StepStatus.UPLOADED)
+        self.assertEqual(sorted(self.uploaded), sorted(f"s3://bucket/results/out_{i}.txt" for i in range(self.NUM_FILES)))
+        self.assertLessEqual(self.max_in_flight, s3.MAX_CONCURRENT_UPLOAD_OPERATIONS)
+        self.assertGreater(self.max_in_flight, 1)
+        self.assertLess(elapsed, self.NUM_FILES * self.UPLOAD_SECONDS / 2)
+
+    def test_failed_upload(self):
+        def upload(from_f, to_f, checksum=False):
+            self._upload(from_f, to_f, checksum, fail=from_f.endswith("out_3.txt"))
+
+        with patch("idseq_dag.util.s3.upload_with_retries", side_effect=upload):
+            with self.assertRaisesRegex(RuntimeError, "out_3.txt"):
+                self.step.uploading_results()
+        # The remaining uploads still finish, but the step is not marked uploaded
+        self.assertEqual(len(self.uploaded), self.NUM_FILES)
+        self.assertNotEqual(self.step.status, pipeline_step.StepStatus.UPLOADED)
+
+
+class ReservationTracker(object):
+    ''' Records the peak total reservation of the ReservingSteps running at the same time '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_use = {"cpus": 0, "memory_gb": 0}
+        self.peak = dict(self.in_use)
+        self.num_running = 0
+        self.peak_running = 0
+
+    def update(self, reservation, sign):
+        with self.lock:
+            for k, v in reservation.items():
+                self.in_use[k] += sign * v
+                self.peak[k] = max(self.peak[k], self.in_use[k])
+            self.num_running += sign
+            self.peak_running = max(self.peak_running, self.num_running)
+
+
+class ReservingStep(NoOpStep):
+    tracker = None
+
+    def run(self):
+        self.tracker.update(self.resource_reservation(), 1)
+        time.sleep(0.02)
+        self.tracker.update(self.resource_reservation(), -1)
+        super().run()
+
+
+@patch("idseq_dag.util.s3.upload_with_retries")
+class TestResourceBudget(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        with open(os.path.join(self.tmp.name, "input.txt"), "w") as f:
+            f.write("input")
+        self.budget = ResourceBudget(cpus=4, memory_gb=10)
+        self.tracker = ReservingStep.tracker = ReservationTracker()
+        self.steps = []
+
+    def tearDown(self):
+        for step in self.steps:
+            step.stop_waiting()
+        self.tmp.cleanup()
+
+    def _steps(self, reservations):
+        registry = CompletionRegistry()
+        registry.mark_done([os.path.join(self.tmp.name, "input.txt")])
+        self.steps = [
+            ReservingStep(f"step_{i}", [["input.txt"]], [f"out_{i}.txt"], self.tmp.name, "s3://bucket/results",
+                          self.tmp.name, {}, {"reserved_cpus": cpus, "reserved_memory_gb": memory_gb},
+                          completion_registry=registry, resource_budget=self.budget)
+            for i, (cpus, memory_gb) in enumerate(reservations)
+        ]
+        return self.steps
+
+    def test_peak_reservation_within_budget(self, _mock_upload):
+        rng = random.Random(0)
+        steps = self._steps([(rng.randint(1, 4), rng.randint(0, 10)) for _ in range(30)])
+        for step in steps:
+            step.start()
+        for step in steps:
+            step.wait_until_all_done()
+        self.assertLessEqual(self.tracker.peak["cpus"], 4)
+        self.assertLessEqual(self.tracker.peak["memory_gb"], 10)
+        self.assertGreater(self.tracker.peak_running, 1)
+        self.assertEqual(self.budget.available, self.budget.capacity)
+
+    def test_oversized_reservation_runs_alone(self, _mock_upload):
+        steps = self._steps([(1, 1), (64, 500), (1, 1), (1, 1)])
+        for step in steps:
+            step.start()
+        for step in steps:
+            step.wait_until_all_done()
+        self.assertEqual(self.budget.available, self.budget.capacity)
+
+    def test_stop_waiting_for_resources(self, _mock_upload):
+        held = {"cpus": 4, "memory_gb": 10}
+        self.assertTrue(self.budget.acquire(held, lambda: False))
+        steps = self._steps([(1, 0)])
+        steps[0].start()
+        time.sleep(0.05)
+        self.assertEqual(self.tracker.peak_running, 0)
+        steps[0].stop_waiting()
+        with self.assertRaises(RuntimeError):
+            steps[0].wait_until_finished()
+        self.budget.release(held)
+        self.assertEqual(self.budget.available, self.budget.capacity)
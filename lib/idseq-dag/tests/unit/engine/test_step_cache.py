@@ -0,0 +1,99 @@
+import os
+import unittest
+from tempfile import TemporaryDirectory, mkdtemp
+from unittest.mock import patch
+
+from idseq_dag.engine.pipeline_step import CompletionRegistry, PipelineStep
+from idseq_dag.engine.step_cache import StepResultCache
+
+
+class UppercaseStep(PipelineStep):
+    ''' Uppercases its input, and writes its length to a hidden output and a folder '''
+    num_runs = 0
+
+    def run(self):
+        UppercaseStep.num_runs += 1
+        with open(self.input_files_local[0][0]) as in_f:
+            text = in_f.read()
+        with open(self.output_files_local()[0], "w") as out_f:
+            out_f.write(text.upper())
+        length_file = os.path.join(self.output_dir_local, "length.txt")
+        with open(length_file, "w") as out_f:
+            out_f.write(str(len(text)))
+        self.additional_output_files_hidden.append(length_file)
+        folder = os.path.join(self.output_dir_local, "chars")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "first.txt"), "w") as out_f:
+            out_f.write(text[:1])
+        self.additional_output_folders_hidden.append(folder)
+
+    def count_reads(self):
+        pass
+
+
+@patch("idseq_dag.util.s3.upload_folder_with_retries")
+@patch("idseq_dag.util.s3.upload_with_retries")
+class TestStepResultCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.cache = StepResultCache(os.path.join(self.tmp.name, "cache"))
+        UppercaseStep.num_runs = 0
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _run_step(self, text, attributes=None, results_dir=None):
+        ''' Run the step, by default in a fresh results dir, as a rerun of the DAG would '''
+        results_dir = results_dir or mkdtemp(dir=self.tmp.name)
+        input_file = os.path.join(results_dir, "input.txt")
+        with open(input_file, "w") as f:
+            f.write(text)
+        registry = CompletionRegistry()
+        registry.mark_done([input_file])
+        step = UppercaseStep("uppercase", [["input.txt"]], ["upper.txt"], results_dir, "s3://bucket/results",
+                             results_dir, {}, attributes or {}, completion_registry=registry, step_cache=self.cache)
+        step.start()
+        step.wait_until_all_done()
+        with open(step.output_files_local()[0]) as f:
+            self.assertEqual(f.read(), text.upper())
+        with open(os.path.join(results_dir, "chars", "first.txt")) as f:
+            self.assertEqual(f.read(), text[:1])
+        return step
+
+    def test_restore(self, mock_upload, mock_upload_folder):
+        first = self._run_step("acgt")
+        second = self._run_step("acgt")
+        self.assertEqual(UppercaseStep.num_runs, 1)
+        # Restored as copies, and uploaded like the outputs of run()
+        self.assertNotEqual(os.stat(first.output_files_local()[0]).st_ino, os.stat(second.output_files_local()[0]).st_ino)
+        self.assertEqual(second.additional_output_files_hidden, [os.path.join(second.output_dir_local, "length.txt")])
+        self.assertEqual(mock_upload.call_count, 4)
+        self.assertEqual(mock_upload_folder.call_count, 2)
+        self.assertTrue(os.path.exists(PipelineStep.done_file(second.output_files_local()[0])))
+
+    def test_changed_inputs(self, _mock_upload, _mock_upload_folder):
+        self._run_step("acgt")
+        self._run_step("acgtn")
+        self.assertEqual(UppercaseStep.num_runs, 2)
+
+    def test_changed_attributes(self, _mock_upload, _mock_upload_folder):
+        self._run_step("acgt", {"min_length": 1})
+        self._run_step("acgt", {"min_length": 2})
+        self._run_step("acgt", {"min_length": 1})
+        self.assertEqual(UppercaseStep.num_runs, 2)
+
+    def test_rerun_in_same_results_dir(self, _mock_upload, _mock_upload_folder):
+        # A miss that rewrites the outputs of an earlier run in the same results dir must
+        # not change what is cached for the earlier inputs
+        results_dir = mkdtemp(dir=self.tmp.name)
+        self._run_step("aaaa", results_dir=results_dir)
+        self._run_step("bb", results_dir=results_dir)
+        self.assertEqual(UppercaseStep.num_runs, 2)
+        self._run_step("aaaa")
+        self.assertEqual(UppercaseStep.num_runs, 2)
+
+    def test_changed_code(self, _mock_upload, _mock_upload_folder):
+        self._run_step("acgt")
+        with patch.object(self.cache, "_code_digest", "edited util module"):
+            self._run_step("acgt")
+        self.assertEqual(UppercaseStep.num_runs, 2)
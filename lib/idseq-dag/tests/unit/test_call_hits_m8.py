@@ -4,13 +4,129 @@ import os
 import shelve
 import random
 import dbm
+from unittest.mock import patch
 
-from idseq_dag.util.m8 import call_hits_m8
+import idseq_dag.util.m8 as m8
+from idseq_dag.util.dict import open_file_db_by_extension
+from idseq_dag.util.m8 import call_hits_m8, _call_hits_m8_work
+from idseq_dag.util.parsing import HitSummaryWriter, _read_sidecar, sidecar_path
 
 from .unittest_helpers import file_contents, relative_file_path
 
 import marisa_trie
 
+LINEAGES_DB = {}
+ACCESSION2TAXID_DB = {}
+
+# Generated by running test_call_hits_m8 with the full versions of these dicts and printing which items were needed
+ACCESSION2TAXID_DB["MK468611"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MK468612"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MK468613"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MK468615"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MK468617"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MH124576"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MH124577"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MH124578"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MH124579"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MH124580"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MK286896"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MK370031"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MK370032"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MK370033"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MK468608"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["CP015500"] = (573,)
+LINEAGES_DB["573"] = (573, 570, 543)
+ACCESSION2TAXID_DB["CP015822"] = (573,)
+LINEAGES_DB["573"] = (573, 570, 543)
+ACCESSION2TAXID_DB["CP015990"] = (573,)
+LINEAGES_DB["573"] = (573, 570, 543)
+ACCESSION2TAXID_DB["CP016813"] = (573,)
+LINEAGES_DB["573"] = (573, 570, 543)
+ACCESSION2TAXID_DB["CP016814"] = (573,)
+LINEAGES_DB["573"] = (573, 570, 543)
+ACCESSION2TAXID_DB["CP018140"] = (573,)
+LINEAGES_DB["573"] = (573, 570, 543)
+ACCESSION2TAXID_DB["CP018337"] = (573,)
+LINEAGES_DB["573"] = (573, 570, 543)
+ACCESSION2TAXID_DB["CP018352"] = (573,)
+LINEAGES_DB["573"] = (573, 570, 543)
+ACCESSION2TAXID_DB["CP018356"] = (573,)
+LINEAGES_DB["573"] = (573, 570, 543)
+ACCESSION2TAXID_DB["CP018364"] = (573,)
+LINEAGES_DB["573"] = (573, 570, 543)
+ACCESSION2TAXID_DB["MK468618"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MK468619"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MK468620"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MK468621"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MK468622"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MF740874"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MF773566"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MF774614"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MF774615"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["MF774616"] = (37124,)
+LINEAGES_DB["37124"] = (37124, 11019, 11018)
+ACCESSION2TAXID_DB["CP010295"] = (1280,)
+LINEAGES_DB["1280"] = (1280, 1279, 90964)
+ACCESSION2TAXID_DB["CP010296"] = (1280,)
+LINEAGES_DB["1280"] = (1280, 1279, 90964)
+ACCESSION2TAXID_DB["CP010297"] = (1280,)
+LINEAGES_DB["1280"] = (1280, 1279, 90964)
+ACCESSION2TAXID_DB["CP010298"] = (1280,)
+LINEAGES_DB["1280"] = (1280, 1279, 90964)
+ACCESSION2TAXID_DB["CP010299"] = (1280,)
+LINEAGES_DB["1280"] = (1280, 1279, 90964)
+ACCESSION2TAXID_DB["NC_038358"] = (2065052,)
+LINEAGES_DB["2065052"] = (2065052, 687333, 687329)
+ACCESSION2TAXID_DB["CP017682"] = (1280,)
+LINEAGES_DB["1280"] = (1280, 1279, 90964)
+ACCESSION2TAXID_DB["CP017804"] = (1280,)
+LINEAGES_DB["1280"] = (1280, 1279, 90964)
+ACCESSION2TAXID_DB["AF325855"] = (1280,)
+LINEAGES_DB["1280"] = (1280, 1279, 90964)
+ACCESSION2TAXID_DB["AM990992"] = (523796,)
+LINEAGES_DB["523796"] = (1280, 1279, 90964)
+ACCESSION2TAXID_DB["AP014652"] = (46170,)
+LINEAGES_DB["46170"] = (1280, 1279, 90964)
+
+
+def _write_tied_m8(path, num_reads=300):
+    # Reads with several tied best hits across species, so the tie-breaking is exercised
+    randgen = random.Random(0)
+    accessions = sorted(ACCESSION2TAXID_DB)
+    with open(path, 'w') as f:
+        for read in range(num_reads):
+            bitscore = 200.0
+            for _ in range(randgen.randint(1, 8)):
+                length = randgen.choice([20, 100, 120])
+                f.write(f"read_{read}/1\t{randgen.choice(accessions)}.1\t99.0\t{length}\t0\t0\t1\t{length}\t1\t{length}\t1e-40\t{bitscore}\n")
+                if randgen.random() < 0.3:
+                    bitscore -= 10
+
+
 class TestLog(unittest.TestCase):
     def test_call_hits_m8(self):
         # This tests the logic based on a small sample. For development and performance benchmarking you can use real m8 outputs
@@ -24,105 +140,8 @@ class TestLog(unittest.TestCase):
         lineages = relative_file_path(__file__, 'util/m8-test/taxid-lineages.marisa')
         accession2taxid = relative_file_path(__file__, 'util/m8-test/accession2taxid.marisa')
 
-        lineages_db = {}
-        accession2taxid_db = {}
-
-        # Generated by running this test the full versions of these dicts and printing which items were needed
-        accession2taxid_db["MK468611"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MK468612"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MK468613"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MK468615"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MK468617"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MH124576"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MH124577"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MH124578"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MH124579"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MH124580"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MK286896"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MK370031"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MK370032"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MK370033"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MK468608"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["CP015500"] = (573,)
-        lineages_db["573"] = (573, 570, 543)
-        accession2taxid_db["CP015822"] = (573,)
-        lineages_db["573"] = (573, 570, 543)
-        accession2taxid_db["CP015990"] = (573,)
-        lineages_db["573"] = (573, 570, 543)
-        accession2taxid_db["CP016813"] = (573,)
-        lineages_db["573"] = (573, 570, 543)
-        accession2taxid_db["CP016814"] = (573,)
-        lineages_db["573"] = (573, 570, 543)
-        accession2taxid_db["CP018140"] = (573,)
-        lineages_db["573"] = (573, 570, 543)
-        accession2taxid_db["CP018337"] = (573,)
-        lineages_db["573"] = (573, 570, 543)
-        accession2taxid_db["CP018352"] = (573,)
-        lineages_db["573"] = (573, 570, 543)
-        accession2taxid_db["CP018356"] = (573,)
-        lineages_db["573"] = (573, 570, 543)
-        accession2taxid_db["CP018364"] = (573,)
-        lineages_db["573"] = (573, 570, 543)
-        accession2taxid_db["MK468618"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MK468619"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MK468620"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MK468621"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MK468622"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MF740874"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MF773566"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MF774614"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MF774615"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["MF774616"] = (37124,)
-        lineages_db["37124"] = (37124, 11019, 11018)
-        accession2taxid_db["CP010295"] = (1280,)
-        lineages_db["1280"] = (1280, 1279, 90964)
-        accession2taxid_db["CP010296"] = (1280,)
-        lineages_db["1280"] = (1280, 1279, 90964)
-        accession2taxid_db["CP010297"] = (1280,)
-        lineages_db["1280"] = (1280, 1279, 90964)
-        accession2taxid_db["CP010298"] = (1280,)
-        lineages_db["1280"] = (1280, 1279, 90964)
-        accession2taxid_db["CP010299"] = (1280,)
-        lineages_db["1280"] = (1280, 1279, 90964)
-        accession2taxid_db["NC_038358"] = (2065052,)
-        lineages_db["2065052"] = (2065052, 687333, 687329)
-        accession2taxid_db["CP017682"] = (1280,)
-        lineages_db["1280"] = (1280, 1279, 90964)
-        accession2taxid_db["CP017804"] = (1280,)
-        lineages_db["1280"] = (1280, 1279, 90964)
-        accession2taxid_db["AF325855"] = (1280,)
-        lineages_db["1280"] = (1280, 1279, 90964)
-        accession2taxid_db["AM990992"] = (523796,)
-        lineages_db["523796"] = (1280, 1279, 90964)
-        accession2taxid_db["AP014652"] = (46170,)
-        lineages_db["46170"] = (1280, 1279, 90964)
-
-        marisa_trie.RecordTrie("lll", lineages_db.items()).save(lineages)
-        marisa_trie.RecordTrie("l", accession2taxid_db.items()).save(accession2taxid)
+        marisa_trie.RecordTrie("lll", LINEAGES_DB.items()).save(lineages)
+        marisa_trie.RecordTrie("l", ACCESSION2TAXID_DB.items()).save(accession2taxid)
 
         output_m8 = relative_file_path(__file__, 'util/m8-test/test.m8')
         output_summary = relative_file_path(__file__, 'util/m8-test/test.hitsummary.tab')
@@ -154,5 +173,123 @@ class TestLog(unittest.TestCase):
 
         os.remove(output_m8)
         os.remove(output_summary)
+        os.remove(sidecar_path(output_summary))
         os.remove(lineages)
         os.remove(accession2taxid)
+
+
+class TestCallHitsM8Streaming(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.lineages = os.path.join(self.tmp.name, 'taxid-lineages.marisa')
+        self.accession2taxid = os.path.join(self.tmp.name, 'accession2taxid.marisa')
+        marisa_trie.RecordTrie("lll", LINEAGES_DB.items()).save(self.lineages)
+        marisa_trie.RecordTrie("l", ACCESSION2TAXID_DB.items()).save(self.accession2taxid)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _call_hits(self, input_m8, name, streaming):
+        output_m8 = os.path.join(self.tmp.name, f'{name}.m8')
+        output_summary = os.path.join(self.tmp.name, f'{name}.hitsummary.tab')
+        with open_file_db_by_extension(self.lineages, "lll") as lineage_map, \
+             open_file_db_by_extension(self.accession2taxid, "L") as accession2taxid_dict:  # noqa
+            _call_hits_m8_work(input_m8, lineage_map, accession2taxid_dict, output_m8, output_summary, 36,
+                               deuterostome_path="", taxon_whitelist_path="", taxon_blacklist_path="",
+                               streaming=streaming)
+        return file_contents(output_m8), file_contents(output_summary)
+
+    def test_streaming_matches_two_pass(self):
+        input_m8 = relative_file_path(__file__, 'util/m8-test/sample.m8')
+        streamed = self._call_hits(input_m8, 'streamed', streaming=True)
+        two_pass = self._call_hits(input_m8, 'two_pass', streaming=False)
+        self.assertEqual(streamed, two_pass)
+        self.assertEqual(streamed[0], file_contents(relative_file_path(__file__, 'util/m8-test/sample.deduped.m8')))
+        self.assertEqual(streamed[1], file_contents(relative_file_path(__file__, 'util/m8-test/sample.hitsummary.tab')))
+
+    def test_streaming_matches_two_pass_with_ties(self):
+        input_m8 = os.path.join(self.tmp.name, 'tied.m8')
+        _write_tied_m8(input_m8)
+        streamed = self._call_hits(input_m8, 'streamed', streaming=True)
+        self.assertGreater(len(streamed[1].splitlines()), 200)
+        self.assertEqual(streamed, self._call_hits(input_m8, 'two_pass', streaming=False))
+
+    def test_ungrouped_input_falls_back_to_two_pass(self):
+        with open(relative_file_path(__file__, 'util/m8-test/sample.m8')) as f:
+            lines = f.readlines()
+        # Move the first alignment of the first read to the end so its group is split
+        ungrouped_m8 = os.path.join(self.tmp.name, 'ungrouped.m8')
+        with open(ungrouped_m8, 'w') as f:
+            f.writelines(lines[1:] + lines[:1])
+        self.assertEqual(
+            self._call_hits(ungrouped_m8, 'streamed', streaming=True),
+            self._call_hits(ungrouped_m8, 'two_pass', streaming=False),
+        )
+
+    def test_grouped_input_streams_in_one_pass(self):
+        input_m8 = os.path.join(self.tmp.name, 'tied.m8')
+        _write_tied_m8(input_m8)
+        with patch.object(m8.log, "write") as mock_write:
+            self._call_hits(input_m8, 'streamed', streaming=True)
+        self.assertFalse(any("two-pass" in str(call) for call in mock_write.call_args_list))
+
+
+class TestSeenReadsFilter(unittest.TestCase):
+    def test_seen_reads_filter(self):
+        seen_reads = m8._SeenReadsFilter(2**16)
+        read_ids = [f"read_{i}" for i in range(1000)]
+        self.assertFalse(any(seen_reads.add(read_id) for read_id in read_ids))
+        self.assertTrue(all(seen_reads.add(read_id) for read_id in read_ids))
+        self.assertEqual(len(seen_reads.bits), 2**13)
+
+    def test_full_filter_reports_repeats(self):
+        # A filter too small for its reads is a false alarm, which falls back to the two-pass path
+        seen_reads = m8._SeenReadsFilter(8)
+        self.assertTrue(any(seen_reads.add(f"read_{i}") for i in range(100)))
+
+
+class TestCallHitsM8Sharded(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.lineages = os.path.join(self.tmp.name, 'taxid-lineages.marisa')
+        self.accession2taxid = os.path.join(self.tmp.name, 'accession2taxid.marisa')
+        marisa_trie.RecordTrie("lll", LINEAGES_DB.items()).save(self.lineages)
+        marisa_trie.RecordTrie("l", ACCESSION2TAXID_DB.items()).save(self.accession2taxid)
+
+        self.input_m8 = os.path.join(self.tmp.name, 'input.m8')
+        _write_tied_m8(self.input_m8)
+        self.fieldnames = [field for field, _ in HitSummaryWriter.SCHEMA]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _call_hits(self, num_workers):
+        output_m8 = os.path.join(self.tmp.name, f'{num_workers}.m8')
+        output_summary = os.path.join(self.tmp.name, f'{num_workers}.hitsummary.tab')
+        call_hits_m8(self.input_m8, self.lineages, self.accession2taxid, output_m8, output_summary, 36,
+                     deuterostome_path="", taxon_whitelist_path="", taxon_blacklist_path="",
+                     num_workers=num_workers)
+        with open(output_m8, 'rb') as m8_f, open(output_summary, 'rb') as summary_f:
+            return m8_f.read(), summary_f.read(), _read_sidecar(output_summary, self.fieldnames)
+
+    def test_output_is_identical_for_any_worker_count(self):
+        expected_m8, expected_summary, expected_sidecar = self._call_hits(1)
+        self.assertGreater(len(expected_summary.splitlines()), 200)
+        expected_sidecar = list(expected_sidecar)
+        for num_workers in [4, 16]:
+            output_m8, output_summary, sidecar = self._call_hits(num_workers)
+            self.assertEqual((output_m8, output_summary), (expected_m8, expected_summary), f"num_workers={num_workers}")
+            self.assertIsNotNone(sidecar, f"num_workers={num_workers}")
+            self.assertEqual(list(sidecar), expected_sidecar, f"num_workers={num_workers}")
+        # Shard scratch files are cleaned up
+        self.assertEqual(
+            sorted(os.listdir(self.tmp.name)),
+            sorted(['taxid-lineages.marisa', 'accession2taxid.marisa', 'input.m8'] +
+                   [f'{n}.{ext}' for n in [1, 4, 16] for ext in ['m8', 'hitsummary.tab', 'hitsummary.tab.npz']]),
+        )
+
+    def test_scratch_files_are_removed_on_failure(self):
+        with patch.object(m8, "_merge_hit_shards", side_effect=RuntimeError("merge failed")):
+            with self.assertRaises(RuntimeError):
+                self._call_hits(4)
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ['accession2taxid.marisa', 'input.m8', 'taxid-lineages.marisa'])
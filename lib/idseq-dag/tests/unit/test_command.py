@@ -2,6 +2,7 @@ import unittest
 from unittest.mock import patch, ANY
 import os
 import subprocess
+import sys
 import idseq_dag.util.command as command
 import idseq_dag.util.command_patterns as command_patterns
 from tests.unit.unittest_helpers import file_contents, relative_file_path, MATCH_RE
@@ -340,3 +341,115 @@ class CommandModuleMethodsFileOperationsTestCase(unittest.TestCase):
         result = command.get_resource_filename("scripts/fastq-fasta-line-validation.awk")
 
         self.assertRegex(result, r"^.+/scripts/fastq-fasta-line-validation.awk")
+
+
+class CommandTrackerResourceUsageTestCase(unittest.TestCase):
+    '''Tests for CommandTracker sampling the resource usage of commands from /proc'''
+    ALLOCATE_200MB = "import os, time; data = os.urandom(200 * 2**20); time.sleep(1)"
+    ALLOCATE_200MB_AND_EXIT = "import os; data = os.urandom(200 * 2**20)"
+
+    @staticmethod
+    def _resource_usage_events(mock_log_event):
+        return [c[1]["values"] for c in mock_log_event.call_args_list if c[0] == ("command_resource_usage",)]
+
+    @unittest.skipUnless(os.path.isdir("/proc"), "needs /proc")
+    @patch('idseq_dag.util.command.log.log_event')
+    def test_peak_rss(self, _mock_log_event):
+        '''WHEN a command allocates memory, THEN its peak RSS and cpu time are logged when it ends'''
+        with command.CommandTracker(update_period=0.2) as ct:
+            # The python subprocess runs under a shell, so this also checks walking the process tree
+            ct.proc = subprocess.Popen(["/bin/sh", "-c", f"{sys.executable} -c '{self.ALLOCATE_200MB}'; true"])
+            ct.wait()
+
+        usage, = self._resource_usage_events(_mock_log_event)
+        self.assertEqual(usage["cid"], f"Command {ct.id}")
+        self.assertGreaterEqual(usage["peak_rss_mb"], 200)
+        self.assertGreater(usage["cpu_seconds"], 0)
+        self.assertEqual(usage["num_processes"], 2)
+        self.assertGreaterEqual(usage["peak_threads"], 2)
+        self.assertEqual(ct.proc.returncode, 0)
+
+    @unittest.skipUnless(os.path.isdir("/proc"), "needs /proc")
+    @patch('idseq_dag.util.command.log.log_event')
+    def test_short_command(self, _mock_log_event):
+        '''WHEN a command ends before the first update, THEN its usage is sampled when it exits'''
+        with command.CommandTracker() as ct:
+            ct.proc = subprocess.Popen(["/bin/sh", "-c", f"{sys.executable} -c '{self.ALLOCATE_200MB_AND_EXIT}'; exit 3"])
+            self.assertEqual(ct.wait(), 3)
+
+        usage, = self._resource_usage_events(_mock_log_event)
+        self.assertEqual(usage["num_samples"], 1)
+        # The python subprocess was reaped by the shell before the sample
+        self.assertGreater(usage["cpu_seconds"], 0.1)
+        self.assertGreaterEqual(usage["peak_rss_mb"], 200)
+
+    @patch('idseq_dag.util.command.log.log_event')
+    def test_execute_logs_usage(self, _mock_log_event):
+        '''WHEN execute runs a command, THEN its resource usage is logged'''
+        output = command.execute(command_patterns.SingleCommand(cmd="echo", args=["hi"]), capture_stdout=True,
+                                 stdin=subprocess.DEVNULL)
+        self.assertEqual(output, b"hi\n")
+        self.assertEqual(len(self._resource_usage_events(_mock_log_event)), int(os.path.isdir("/proc")))
+
+
+def _load_offset(offset):
+    return {"offset": offset}
+
+
+def _add_offset(x):
+    return x + command.worker_resource("offset")
+
+
+def _exit_with(code):
+    sys.exit(code)
+
+
+def _raise_value_error(message):
+    raise ValueError(message)
+
+
+@command.run_in_subprocess
+def _map_in_subprocess(output_file):
+    with command.WorkerPool(2, _load_offset, (100,)) as pool:
+        results = pool.map(_add_offset, range(3))
+    with open(output_file, "w") as f:
+        f.write(str(results))
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+    '''Tests for WorkerPool, the persistent alternative to run_in_subprocess'''
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = command.WorkerPool(2, _load_offset, (10,))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def test_map(self):
+        '''WHEN the initializer loads a resource, THEN every call in every worker can use it'''
+        self.assertEqual(self.pool.map(_add_offset, range(100)), list(range(10, 110)))
+        self.assertEqual(self.pool.run(_add_offset, 5), 15)
+
+    def test_exit_codes(self):
+        '''WHEN a call exits, THEN it fails only with a non-zero code, like run_in_subprocess'''
+        self.assertIsNone(self.pool.run(_exit_with, 0))
+        with self.assertRaisesRegex(RuntimeError, r"Failed _exit_with with code 3 on \[3\]"):
+            self.pool.run(_exit_with, 3)
+
+    def test_exception(self):
+        '''WHEN a call raises, THEN the other calls finish, and the error is raised with code 1'''
+        with self.assertRaisesRegex(RuntimeError, r"Failed _raise_value_error with code 1 on \['first'\]") as cm:
+            self.pool.map(_raise_value_error, ["first", "second"])
+        self.assertIsInstance(cm.exception.__cause__, ValueError)
+        # The pool is still usable
+        self.assertEqual(self.pool.run(_add_offset, 1), 11)
+
+    def test_pool_in_subprocess(self):
+        '''WHEN a run_in_subprocess function starts a pool after its parent did, THEN its workers are spawned'''
+        output_file = f"/tmp/worker_pool_test_{os.getpid()}.txt"
+        try:
+            _map_in_subprocess(output_file)
+            self.assertEqual(file_contents(output_file), "[100, 101, 102]")
+        finally:
+            os.remove(output_file)
@@ -1,11 +1,16 @@
+import gzip
 import os
 import sys
 import tempfile
+import threading
 import unittest
+from unittest.mock import patch
 
-from idseq_dag.util.count import count_reads
+import idseq_dag.util.count as count
+from idseq_dag.util.count import count_reads, load_duplicate_cluster_sizes, shared_duplicate_cluster_sizes
 from idseq_dag.exceptions import InvalidInputFileError
 
+
 class TestCountReads(unittest.TestCase):
     def test_count_reads(self):
         expect_reads = {
@@ -31,3 +36,118 @@ class TestCountReads(unittest.TestCase):
                 tf.flush()
             with self.assertRaises(InvalidInputFileError):
                 count_reads(tf.name)
+
+    def test_count_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for filename, contents in [("reads.fasta", b">read_1\nACGT\n>read_2\nACGT\n"),
+                                       ("reads.fasta.gz", gzip.compress(b">read_1\nACGT\n>read_2\nACGT\n"))]:
+                path = os.path.join(tmp, filename)
+                with open(path, "wb") as f:
+                    f.write(contents)
+                self.assertEqual(count_reads(path), 2)
+                with patch.object(count, "_count_in_chunks") as mock_count_in_chunks, \
+                        patch.object(count, "_count_in_file") as mock_count_in_file:
+                    self.assertEqual(count_reads(path), 2)
+                mock_count_in_chunks.assert_not_called()
+                mock_count_in_file.assert_not_called()
+
+            # A changed file is counted again
+            with open(os.path.join(tmp, "reads.fasta"), "a") as f:
+                f.write(">read_3\nACGT\n")
+            self.assertEqual(count_reads(os.path.join(tmp, "reads.fasta")), 3)
+            # Nothing is written next to the inputs
+            self.assertEqual(sorted(os.listdir(tmp)), ["reads.fasta", "reads.fasta.gz"])
+
+    def test_count_reads_chunk_boundaries(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fasta = os.path.join(tmp, "reads.fasta")
+            # ">" inside sequences must not be counted, wherever the chunks split the file
+            with open(fasta, "w") as f:
+                f.write("".join(f">read_{i}\nAC>GT\n" for i in range(100)))
+            with gzip.open(fasta + ".gz", "wb") as f:
+                f.write(b"".join(f">read_{i}\nAC>GT\n".encode() for i in range(100)))
+            with patch.object(count, "COUNT_READ_SIZE", 7):
+                self.assertEqual(count_reads(fasta), 100)
+                self.assertEqual(count_reads(fasta + ".gz"), 100)
+
+    def test_count_reads_gzip_members(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fastq = os.path.join(tmp, "reads.fastq.gz")
+            record = b"@read\nACGT\n+\nIIII\n"
+            # Like the output of cat a.fastq.gz b.fastq.gz
+            with open(fastq, "wb") as f:
+                f.write(gzip.compress(record * 3) + gzip.compress(record * 2))
+            self.assertEqual(count_reads(fastq), 5)
+
+            truncated = os.path.join(tmp, "truncated.fastq.gz")
+            with open(truncated, "wb") as f:
+                f.write(gzip.compress(record * 3)[:-10])
+            with self.assertRaises(EOFError):
+                count_reads(truncated)
+
+
+class TestSharedDuplicateClusterSizes(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.tsv = os.path.join(self.tmp.name, "duplicate_cluster_sizes.tsv")
+        with open(self.tsv, "w") as f:
+            f.write("".join(f"{i % 3 + 1}\tread_{i}\n" for i in range(1000)))
+        count._recent_duplicate_cluster_sizes.clear()
+
+    def tearDown(self):
+        count._recent_duplicate_cluster_sizes.clear()
+        self.tmp.cleanup()
+
+    def _write_tsvs(self, num_tsvs):
+        tsvs = [os.path.join(self.tmp.name, f"duplicate_cluster_sizes_{i}.tsv") for i in range(num_tsvs)]
+        for i, tsv in enumerate(tsvs):
+            with open(tsv, "w") as f:
+                f.write(f"{i}\tread_0\n")
+        return tsvs
+
+    def test_shared_between_threads(self):
+        results = []
+        with patch.object(count, "_read_duplicate_cluster_sizes", wraps=count._read_duplicate_cluster_sizes) as mock_read:
+            threads = [threading.Thread(target=lambda: results.append(shared_duplicate_cluster_sizes(self.tsv)))
+                       for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        mock_read.assert_called_once()
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(results[0], load_duplicate_cluster_sizes(self.tsv))
+        # The loading locks are dropped once loaded
+        self.assertEqual(count._shared_duplicate_cluster_sizes_loading, {})
+
+    def test_read_only(self):
+        duplicate_cluster_sizes = shared_duplicate_cluster_sizes(self.tsv)
+        with self.assertRaises(TypeError):
+            duplicate_cluster_sizes["read_0"] = 5
+        with self.assertRaises(TypeError):
+            duplicate_cluster_sizes.update({"read_0": 5})
+        self.assertEqual(duplicate_cluster_sizes["read_0"], 1)
+
+    def test_shared_between_sequential_users(self):
+        with patch.object(count, "_read_duplicate_cluster_sizes", wraps=count._read_duplicate_cluster_sizes) as mock_read:
+            for _ in range(3):
+                self.assertEqual(len(shared_duplicate_cluster_sizes(self.tsv)), 1000)
+        mock_read.assert_called_once()
+
+    def test_freed_and_reloaded(self):
+        duplicate_cluster_sizes = shared_duplicate_cluster_sizes(self.tsv)
+        self.assertEqual(len(count._shared_duplicate_cluster_sizes), 1)
+        del duplicate_cluster_sizes
+        # Still one of the most recently used
+        self.assertEqual(len(count._shared_duplicate_cluster_sizes), 1)
+        for tsv in self._write_tsvs(count.SHARED_DUPLICATE_CLUSTER_SIZES_CACHE_SIZE):
+            shared_duplicate_cluster_sizes(tsv)
+        self.assertNotIn(self.tsv, [path for path, _, _ in count._shared_duplicate_cluster_sizes])
+        self.assertEqual(len(count._shared_duplicate_cluster_sizes), count.SHARED_DUPLICATE_CLUSTER_SIZES_CACHE_SIZE)
+
+        duplicate_cluster_sizes = shared_duplicate_cluster_sizes(self.tsv)
+        with open(self.tsv, "a") as f:
+            f.write("7\tread_new\n")
+        # A rewritten file is parsed again
+        self.assertEqual(shared_duplicate_cluster_sizes(self.tsv)["read_new"], 7)
+        self.assertNotIn("read_new", duplicate_cluster_sizes)
@@ -0,0 +1,68 @@
+import io
+import os
+import random
+import re
+import threading
+import unittest
+from tempfile import TemporaryDirectory
+
+from idseq_dag.s3quilt.s3quilt_pure import S3ChunkDownloader
+
+
+class FakeS3Client(object):
+    ''' Serves ranged get_object calls from an in-memory object, and records the ranges requested '''
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = map(int, re.fullmatch(r"bytes=(\d+)-(\d+)", Range).groups())
+        with self.lock:
+            self.ranges.append((start, end + 1))
+        return {"Body": io.BytesIO(self.data[start:end + 1])}
+
+
+class TestS3ChunkDownloader(unittest.TestCase):
+    def setUp(self):
+        self.data = random.Random(0).randbytes(10000)
+        self.client = FakeS3Client(self.data)
+
+    def _downloader(self, **kwargs):
+        downloader = S3ChunkDownloader("bucket", "key", concurrency=4, **kwargs)
+        downloader._client = self.client
+        return downloader
+
+    def test_coalesced_requests(self):
+        starts = [5000, 0, 110, 100, 9000, 300]
+        lengths = [10, 100, 20, 50, 0, 50]
+        chunks = self._downloader(max_gap=50).download_chunks(starts, lengths)
+        self.assertEqual(chunks, [self.data[s:s + length] for s, length in zip(starts, lengths)])
+        # Adjacent, overlapping and nearby chunks share a request; empty chunks need none
+        self.assertCountEqual(self.client.ranges, [(0, 150), (300, 350), (5000, 5010)])
+
+    def test_max_gap_zero(self):
+        self._downloader(max_gap=0).download_chunks([0, 100, 201], [100, 100, 10])
+        self.assertCountEqual(self.client.ranges, [(0, 200), (201, 211)])
+
+    def test_max_request_size(self):
+        self._downloader(max_gap=0, max_request_size=250).download_chunks(list(range(0, 1000, 100)), [100] * 10)
+        self.assertCountEqual(self.client.ranges, [(0, 200), (200, 400), (400, 600), (600, 800), (800, 1000)])
+
+    def test_download_chunks_to_file(self):
+        randgen = random.Random(1)
+        starts = [randgen.randrange(9000) for _ in range(200)]
+        lengths = [randgen.randrange(1000) for _ in range(200)]
+        with TemporaryDirectory() as tmp:
+            output_file = os.path.join(tmp, "chunks")
+            self._downloader().download_chunks_to_file(output_file, starts, lengths)
+            with open(output_file, "rb") as f:
+                self.assertEqual(f.read(), b"".join(self.data[s:s + length] for s, length in zip(starts, lengths)))
+        self.assertLess(len(self.client.ranges), 200)
+
+    def test_failed_request(self):
+        def get_object(**kwargs):
+            raise IOError("connection reset")
+        self.client.get_object = get_object
+        with self.assertRaisesRegex(Exception, "Failed to download chunk: connection reset"):
+            self._downloader().download_chunks([0], [10])
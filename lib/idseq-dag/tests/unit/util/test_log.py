@@ -1,11 +1,15 @@
 import datetime
 import io
+import json
 import logging
+import threading
+import time
 import unittest
 from unittest.mock import patch, call, Mock
 
 # Module under test
 import idseq_dag.util.log as log
+from idseq_dag.util.trace_lock import TraceLock
 
 class TestLog(unittest.TestCase):
     '''Tests for `util/log.py`'''
@@ -91,3 +95,70 @@ class TestLog(unittest.TestCase):
         self.assertRegex('{"time": "2019-05-28T21:06:46.728", "msg": "test message", "data": {"abc": 1, "f2": "<<non-serializable: bytes>>"}, "thread": "MainThread", "pid": 6, "level": "INFO"}', LOG_OUTPUT_REGEX)
         # actual message
         self.assertRegex(out_str, LOG_OUTPUT_REGEX)
+
+
+class TestChromeTrace(unittest.TestCase):
+    '''Tests for converting JSON logs to Chrome traces'''
+
+    def setUp(self):
+        self.output = io.StringIO()
+        self.handler = logging.StreamHandler(self.output)
+        self.handler.setFormatter(log.JsonFormatter())
+        self.logger = logging.getLogger(log.__name__)
+        self.level = self.logger.level
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(self.level)
+
+    def _trace(self):
+        trace_file = io.StringIO()
+        log.write_chrome_trace(io.StringIO(self.output.getvalue() + "not a json line\n"), trace_file)
+        return json.loads(trace_file.getvalue())["traceEvents"]
+
+    def test_threads_and_nested_contexts(self):
+        lock = TraceLock("test_lock", threading.RLock(), debug=False)
+
+        def step(name):
+            with log.log_context("dag_step", {"step": name}):
+                with log.log_context("substep_run", {"step": name}):
+                    with lock:
+                        time.sleep(0.05)
+                log.log_event("step_event", {"step": name})
+
+        threads = [threading.Thread(target=step, args=(f"step_{i}",), name=f"step_{i}") for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        with self.assertRaises(RuntimeError):
+            with log.log_context("failing", {}):
+                raise RuntimeError("failed")
+        events = self._trace()
+
+        thread_names = {e["tid"]: e["args"]["name"] for e in events if e["ph"] == "M"}
+        self.assertCountEqual(thread_names.values(), ["step_0", "step_1", "MainThread"])
+        spans = [e for e in events if e["ph"] == "X"]
+        for name in ("step_0", "step_1"):
+            tid = next(tid for tid, thread_name in thread_names.items() if thread_name == name)
+            by_name = {e["name"]: e for e in spans if e["tid"] == tid}
+            dag_step, substep, hold = by_name["dag_step"], by_name["substep_run"], by_name["hold test_lock"]
+            self.assertEqual(dag_step["args"]["values"], {"step": name})
+            # Nested spans lie within their parents
+            self.assertLessEqual(dag_step["ts"], substep["ts"])
+            self.assertLessEqual(substep["ts"] + substep["dur"], dag_step["ts"] + dag_step["dur"])
+            self.assertGreaterEqual(hold["dur"], 40000)
+        # One of the steps waited for the other to release the lock
+        waits = [e for e in spans if e["name"] == "wait test_lock"]
+        self.assertEqual(len(waits), 1)
+        self.assertGreaterEqual(waits[0]["dur"], 30000)
+        self.assertEqual(len([e for e in events if e["ph"] == "i" and e["name"] == "step_event"]), 2)
+        failing, = [e for e in spans if e["name"] == "failing"]
+        self.assertEqual((failing["cat"], failing["args"]["error_type"]), ("error", "RuntimeError"))
+
+    def test_unfinished_context(self):
+        log.log_event("ctx_start", {"step": "a"}, extra_fields={"context_name": "unfinished", "uid": "abc"})
+        events = self._trace()
+        self.assertEqual([(e["ph"], e["name"]) for e in events if e["ph"] != "M"], [("B", "unfinished")])
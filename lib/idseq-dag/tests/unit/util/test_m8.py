@@ -0,0 +1,73 @@
+import io
+import json
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+from idseq_dag.util.m8 import _write_taxon_counts_json, build_should_keep_filter
+
+
+class TestWriteTaxonCountsJson(unittest.TestCase):
+    def _assert_same_as_json_dump(self, taxon_counts_rows):
+        expected = io.StringIO()
+        json.dump({"pipeline_output": {"taxon_counts_attributes": taxon_counts_rows}}, expected)
+        actual = io.StringIO()
+        _write_taxon_counts_json(actual, iter(taxon_counts_rows))
+        self.assertEqual(actual.getvalue(), expected.getvalue())
+
+    def test_empty(self):
+        self._assert_same_as_json_dump([])
+
+    def test_rows(self):
+        self._assert_same_as_json_dump([
+            {"tax_id": "37124", "tax_level": 1, "genus_taxid": "11019", "count": 3, "dcr": 1.5,
+             "e_value": -12.25, "count_type": "NT", "source_count_type": ["NR", "NT"]},
+            {"tax_id": "-200", "tax_level": 2, "genus_taxid": "-200", "count": 1, "dcr": 1.0,
+             "e_value": float("nan"), "count_type": "NT"},
+        ])
+
+
+class TestBuildShouldKeepFilter(unittest.TestCase):
+    LINEAGES = [
+        ("9606", "9605", "9604"),
+        ("37124", "11019", "11018"),
+        ("573", "570", "543"),
+        ("-100", "570", "543"),
+        ("-100", "-200", "543"),
+        ("1234", "-200", "-300"),
+    ]
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.deny_list = self._write("deny.txt", ["570"])
+        self.allow_list = self._write("allow.txt", ["543", "11018"])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _write(self, name, taxids):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "w") as f:
+            f.write("".join(f"{taxid}\n" for taxid in taxids))
+        return path
+
+    def test_deny_list(self):
+        should_keep = build_should_keep_filter(None, None, self.deny_list)
+        self.assertEqual([should_keep(lineage) for lineage in self.LINEAGES], [False, True, False, False, True, True])
+
+    def test_allow_list(self):
+        should_keep = build_should_keep_filter(None, self.allow_list, None)
+        self.assertEqual([should_keep(list(lineage)) for lineage in self.LINEAGES], [False, True, True, True, True, False])
+
+    def test_memo_matches_uncached(self):
+        for cache_size in [1, 2, 100]:
+            should_keep = build_should_keep_filter(self.deny_list, self.allow_list, None, cache_size=cache_size)
+            uncached = build_should_keep_filter(self.deny_list, self.allow_list, None, cache_size=0)
+            for lineage in self.LINEAGES * 3:
+                self.assertEqual(should_keep(lineage), uncached(lineage), f"{lineage} cache_size={cache_size}")
+
+    def test_non_string_taxids(self):
+        should_keep = build_should_keep_filter(None, None, None)
+        self.assertTrue(should_keep(("9607",)))
+        with self.assertRaises(AssertionError):
+            should_keep((9607,))
@@ -1,11 +1,16 @@
+import os
 import unittest
-from tempfile import TemporaryFile
+from tempfile import TemporaryDirectory, TemporaryFile
 
-from idseq_dag.util.parsing import BlastnOutput6Reader, BlastnOutput6Writer
+import numpy as np
+
+from idseq_dag.util.parsing import BlastnOutput6Reader, BlastnOutput6Writer, BlastnOutput6BatchReader
 from idseq_dag.util.parsing import BlastnOutput6NTReader, BlastnOutput6NTWriter
 from idseq_dag.util.parsing import BlastnOutput6NTRerankedReader, BlastnOutput6NTRerankedWriter
+from idseq_dag.util.parsing import BlastnOutput6NTRerankedBatchReader
 from idseq_dag.util.parsing import HitSummaryReader, HitSummaryWriter
 from idseq_dag.util.parsing import HitSummaryMergedReader, HitSummaryMergedWriter
+from idseq_dag.util.parsing import _ColumnarSidecarWriter, _SidecarTSVReader, _TypedDictTSVWriter, sidecar_path
 
 from tests.unit.unittest_helpers import relative_file_path
 
@@ -60,6 +65,59 @@ class TestBlastnOutput6Reader(unittest.TestCase):
         self.assertEqual(rows[0]["qseqid"], "1")
 
 
+class TestBlastnOutput6BatchReader(unittest.TestCase):
+    def test_read(self):
+        blastn_input_6 = [
+            "# a comment",  # a comment
+            "1	MK468611.1	100.0	126	0	0	1	126	8433	8308	1.1e-74	290.5",
+            "2	MK468611.1	90.0	126	0	0	1	126	8433	8308		290.5", # missing evalue
+            "3	MK468612.1	95.0	120	1	0	1	120	8433	8308	1e-50	200",
+        ]
+        batches = list(BlastnOutput6BatchReader(blastn_input_6, batch_size=2))
+        self.assertEqual([len(b["qseqid"]) for b in batches], [2, 1])
+        self.assertEqual(batches[0]["qseqid"], ["1", "2"])
+        self.assertEqual(batches[0]["pident"].tolist(), [100.0, 90.0])
+        self.assertEqual(batches[0]["length"].dtype.kind, "i")
+        self.assertNotEqual(batches[0]["evalue"][1], batches[0]["evalue"][1])  # NaN
+        self.assertEqual(batches[1]["sseqid"], ["MK468612.1"])
+
+    def test_read_error_too_many_columns(self):
+        blastn_input_6 = [
+            "1	MK468611.1	100.0	126	0	0	1	126	8433	8308	1.1e-74	290.5	1",
+        ]
+        with self.assertRaises(Exception):
+            next(BlastnOutput6BatchReader(blastn_input_6))
+
+    def test_read_error_wrong_data_type(self):
+        blastn_input_6 = [
+            "1	MK468611.1	not_num	126	0	0	1	126	8433	8308	1.1e-74	290.5",
+        ]
+        with self.assertRaises(Exception):
+            next(BlastnOutput6BatchReader(blastn_input_6))
+
+    def test_filtration_matches_row_reader(self):
+        blastn_input_6 = [
+            "# a comment",  # a comment
+            "1	MK468611.1	100.0	126	0	0	1	126	8433	8308	1.1e-74	290.5",
+            "2	MK468611.1	135.0	126	0	0	1	126	8433	8308	1.1e-74	290.5",  # pident too high
+            "3 	MK468611.1	-0.25	126	0	0	1	126	8433	8308	1.1e-74	290.5",  # pident too low
+            "4	MK468611.1	-0.25	126	0	0	1	126	8433	8308	NaN	290.5",  # NaN error
+            "5	MK468611.1	-0.25	126	0	0	1	126	8433	8308	1	290.5",  # error too high
+            "6	MK468611.1	99.0	20	0	0	1	20	8433	8308	1e-10	50.0",  # too short
+            "7	MK468611.1	99.0	40	0	0	1	40	8433	8308	1e-10	80.0",
+        ] * 5
+
+        expected = list(BlastnOutput6Reader(blastn_input_6, filter_invalid=True, min_alignment_length=36))
+        batches = list(BlastnOutput6BatchReader(blastn_input_6, filter_invalid=True, min_alignment_length=36, batch_size=3))
+        self.assertEqual([len(b["qseqid"]) for b in batches], [3, 3, 3, 1])
+        rows = [
+            {field: (column[i] if isinstance(column, list) else column[i].item()) for field, column in batch.items()}
+            for batch in batches
+            for i in range(len(batch["qseqid"]))
+        ]
+        self.assertEqual(rows, expected)
+
+
 class TestBlastnOutput6Writer(unittest.TestCase):
     def test_write(self):
         with TemporaryFile("w") as f:
@@ -217,6 +275,17 @@ class TestBlastnOutput6NTRerankedReader(unittest.TestCase):
         self.assertEqual(rows[0]["qseqid"], "1")
 
 
+class TestBlastnOutput6NTRerankedBatchReader(unittest.TestCase):
+    def test_read(self):
+        blastn_input_6 = [
+            "1	MK468611.1	100.0	126	0	0	1	126	8433	8308	1.1e-74	290.5	11	22	0.1	33",
+        ]
+        batch = next(BlastnOutput6NTRerankedBatchReader(blastn_input_6))
+        self.assertEqual(batch["qcov"].tolist(), [0.1])
+        self.assertEqual(batch["hsp_count"].tolist(), [33])
+        self.assertEqual(batch["slen"].tolist(), [22])
+
+
 class TestBlastnOutput6NTRerankedWriter(unittest.TestCase):
     def test_write(self):
         with TemporaryFile("w") as f:
@@ -366,3 +435,108 @@ class TestHitSummaryMergedWriter(unittest.TestCase):
             with self.assertRaises(Exception):
                 writer.writerow({"bad key": 1})
 
+
+
+class TestHitSummarySidecar(unittest.TestCase):
+    ROWS = [
+        {"read_id": "read_id_1", "level": 1, "taxid": 20, "accession_id": "accession_id_1",
+         "species_taxid": 30, "genus_taxid": -200, "family_taxid": "60"},
+        {"read_id": "read_id_2", "level": -1, "taxid": "-1", "accession_id": None},
+        {"read_id": "read_id_3", "level": 1, "taxid": 21, "accession_id": "accession_id_3",
+         "species_taxid": 31, "genus_taxid": 41, "family_taxid": 61},
+    ]
+
+    def _write(self, path, writer_cls, rows):
+        with open(path, "w") as f, writer_cls(f, sidecar=True) as writer:
+            for row in rows:
+                writer.writerow(row)
+
+    def _read(self, path, reader_cls):
+        with open(path) as f:
+            return list(reader_cls(f))
+
+    def _read_tsv(self, path, reader_cls):
+        os.rename(sidecar_path(path), path + ".moved")
+        try:
+            return self._read(path, reader_cls)
+        finally:
+            os.rename(path + ".moved", sidecar_path(path))
+
+    def test_rows_match_tsv(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "hitsummary.tab")
+            self._write(path, HitSummaryWriter, self.ROWS)
+            self.assertTrue(os.path.isfile(sidecar_path(path)))
+            for reader_cls in [HitSummaryReader, HitSummaryMergedReader]:
+                rows = self._read(path, reader_cls)
+                self.assertEqual(rows, self._read_tsv(path, reader_cls))
+                self.assertEqual(rows[0]["level"], 1)
+                self.assertEqual(rows[1]["accession_id"], "")
+
+    def test_merged_rows_match_tsv(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "hitsummary2.tab")
+            merged_rows = [dict(row, contig_id="*", source_count_type="NT") for row in self.ROWS]
+            self._write(path, HitSummaryMergedWriter, merged_rows)
+            self.assertEqual(self._read(path, HitSummaryMergedReader), self._read_tsv(path, HitSummaryMergedReader))
+
+    def test_chunks(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "hitsummary.tab")
+            rows = [dict(self.ROWS[0], read_id=f"read_id_{i}") for i in range(10)]
+            with open(path, "w") as f:
+                writer = HitSummaryWriter(f)
+                sidecar = _ColumnarSidecarWriter(sidecar_path(path), writer.fieldnames, chunk_size=3)
+                for row in rows:
+                    writer.writerow(row)
+                    sidecar.append(row)
+                f.flush()
+                tsv_stat = os.fstat(f.fileno())
+                sidecar.close(tsv_stat.st_size, tsv_stat.st_mtime_ns)
+            self.assertEqual(self._read(path, HitSummaryReader), self._read_tsv(path, HitSummaryReader))
+
+    def test_numeric_columns_are_stored_as_numbers(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "hitsummary.tab")
+            self._write(path, HitSummaryWriter, self.ROWS)
+            with np.load(sidecar_path(path)) as npz:
+                self.assertEqual(npz["level.0"].tolist(), [1, -1, 1])
+                self.assertEqual(npz["level.0"].dtype, np.int8)
+                # A column with a value that is not an int is stored as text
+                self.assertEqual(npz["taxid.0"].dtype, np.uint8)
+                self.assertEqual(npz["read_id.0"].dtype, np.uint8)
+
+    def test_float_columns(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "values.tab")
+            schema = [("name", str), ("score", float), ("count", int)]
+            rows = [{"name": "a", "score": 1.5, "count": 2}, {"name": "b", "score": 1e-300, "count": 3}]
+            with open(path, "w") as f:
+                _TypedDictTSVWriter(f, schema).writerows(rows)
+                f.flush()
+                sidecar = _ColumnarSidecarWriter(sidecar_path(path), [field for field, _ in schema])
+                for row in rows:
+                    sidecar.append(row)
+                tsv_stat = os.fstat(f.fileno())
+                sidecar.close(tsv_stat.st_size, tsv_stat.st_mtime_ns)
+            with np.load(sidecar_path(path)) as npz:
+                self.assertEqual(npz["score.0"].dtype, np.float64)
+            with open(path) as f:
+                rows_read = list(_SidecarTSVReader(f, schema))
+            self.assertEqual(rows_read, rows)
+
+    def test_stale_sidecar_is_ignored(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "hitsummary.tab")
+            self._write(path, HitSummaryWriter, self.ROWS)
+            with open(path, "a") as f:
+                HitSummaryWriter(f).writerow({"read_id": "read_id_4", "level": 1})
+            self.assertEqual([row["read_id"] for row in self._read(path, HitSummaryReader)],
+                             ["read_id_1", "read_id_2", "read_id_3", "read_id_4"])
+
+    def test_no_sidecar_on_error(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "hitsummary.tab")
+            with self.assertRaises(ValueError):
+                self._write(path, HitSummaryWriter, self.ROWS + [{"bad key": 1}])
+            self.assertEqual(os.listdir(tmp), ["hitsummary.tab"])
@@ -0,0 +1,330 @@
+import gzip
+import json
+import os
+import subprocess
+import tarfile
+import threading
+import time
+import unittest
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+import boto3
+from botocore.stub import Stubber
+
+import idseq_dag.util.s3 as s3
+
+from tests.benchmarks.local_s3 import local_s3
+
+AWS_ENV = {"AWS_ACCESS_KEY_ID": "test", "AWS_SECRET_ACCESS_KEY": "test", "AWS_DEFAULT_REGION": "us-west-2"}
+
+
+@patch.dict(os.environ, AWS_ENV)
+class TestS3Client(unittest.TestCase):
+    def test_shared_across_threads(self):
+        clients = []
+        threads = [threading.Thread(target=lambda: clients.append(s3.s3_client())) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(map(id, clients))), 1)
+        self.assertIs(clients[0], s3.s3_client())
+        self.assertEqual(clients[0].meta.config.retries["mode"], "adaptive")
+        self.assertEqual(clients[0].meta.config.max_pool_connections, s3.MAX_CONCURRENT_BOTO_OPERATIONS)
+
+    def test_check_s3_presence(self):
+        with Stubber(s3.s3_client()) as stubber:
+            stubber.add_response("head_object", {"ContentLength": 0}, {"Bucket": "bucket", "Key": "results/empty.txt"})
+            stubber.add_response("head_object", {"ContentLength": 0}, {"Bucket": "bucket", "Key": "results/empty.txt"})
+            stubber.add_client_error("head_object", "404", http_status_code=404,
+                                     expected_params={"Bucket": "bucket", "Key": "results/missing.txt"})
+            self.assertTrue(s3.check_s3_presence("s3://bucket/results/empty.txt"))
+            self.assertFalse(s3.check_s3_presence("s3://bucket/results/empty.txt", allow_zero_byte_files=False))
+            self.assertFalse(s3.check_s3_presence("s3://bucket/results/missing.txt"))
+            stubber.assert_no_pending_responses()
+
+    def test_get_s3_object_by_path(self):
+        with Stubber(s3.s3_client()) as stubber:
+            stubber.add_client_error("get_object", "NoSuchKey", http_status_code=404,
+                                     expected_params={"Bucket": "bucket", "Key": "missing.json"})
+            stubber.add_client_error("get_object", "AccessDenied", http_status_code=403)
+            self.assertIsNone(s3.get_s3_object_by_path("s3://bucket/missing.json"))
+            with self.assertRaises(s3.botocore.exceptions.ClientError):
+                s3.get_s3_object_by_path("s3://bucket/secret.json")
+
+
+class TestCheckS3PresenceForFileList(unittest.TestCase):
+    NUM_FILES = 200
+    LATENCY = 0.005
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.results_dir = os.path.join(self.tmp.name, "bucket", "results")
+        os.makedirs(os.path.join(self.results_dir, "subdir"))
+        self.files = [f"output_{i}.txt" for i in range(self.NUM_FILES - 1)] + ["subdir/nested.txt"]
+        for f in self.files + ["unrelated.txt"]:
+            with open(os.path.join(self.results_dir, f), "w") as out_f:
+                out_f.write(f)
+        open(os.path.join(self.results_dir, "empty.txt"), "w").close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _check(self, file_list, max_keys=1000, check=s3.check_s3_presence_for_file_list, **kwargs):
+        ''' Returns (present, number of requests) '''
+        with local_s3(self.tmp.name, self.LATENCY, max_keys) as server, \
+                patch.object(s3, "s3_client", return_value=boto3.session.Session().client("s3", config=s3.BOTO_CONFIG)):
+            present = check("s3://bucket/results", file_list, **kwargs)
+            return present, server.num_requests
+
+    def test_single_listing(self):
+        present, num_requests = self._check(self.files)
+        self.assertTrue(present)
+        self.assertEqual(num_requests, 1)
+
+        def check_each(s3_dir, file_list):
+            return all(s3.check_s3_presence(os.path.join(s3_dir, f)) for f in file_list)
+        present, num_requests = self._check(self.files, check=check_each)
+        self.assertTrue(present)
+        self.assertEqual(num_requests, self.NUM_FILES)
+
+    def test_paginated(self):
+        present, num_requests = self._check(self.files, max_keys=64)
+        self.assertTrue(present)
+        self.assertEqual(num_requests, 4)
+        # Listing stops at the page with the last of the files
+        present, num_requests = self._check(sorted(self.files)[:70], max_keys=64)
+        self.assertTrue(present)
+        self.assertEqual(num_requests, 2)
+
+    def test_missing_and_empty(self):
+        self.assertFalse(self._check(self.files + ["missing.txt"])[0])
+        self.assertTrue(self._check(self.files + ["empty.txt"])[0])
+        self.assertFalse(self._check(self.files + ["empty.txt"], allow_zero_byte_files=False)[0])
+
+    def test_outside_dir(self):
+        os.makedirs(os.path.join(self.tmp.name, "bucket", "inputs"))
+        open(os.path.join(self.tmp.name, "bucket", "inputs", "reads.fq"), "w").close()
+        present, num_requests = self._check(self.files + ["../inputs/reads.fq"])
+        self.assertTrue(present)
+        self.assertEqual(num_requests, 2)
+        self.assertFalse(self._check(self.files + ["../inputs/missing.fq"])[0])
+
+
+@patch.object(s3, "NATIVE_DOWNLOAD_PART_SIZE", 1000)
+@patch.object(s3, "NATIVE_DOWNLOAD_CONCURRENCY", 4)
+@patch.object(s3, "NATIVE_DOWNLOAD_WINDOW", 6)
+class TestNativeDownload(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.bucket_dir = os.path.join(self.tmp.name, "bucket")
+        self.out_dir = os.path.join(self.tmp.name, "out")
+        os.makedirs(os.path.join(self.tmp.name, "ref"))
+        os.makedirs(self.bucket_dir)
+        os.makedirs(self.out_dir)
+        self.files = {f"ref/part_{i}.txt": os.urandom(3000).hex().encode() for i in range(5)}
+        for path, content in self.files.items():
+            with open(os.path.join(self.tmp.name, path), "wb") as f:
+                f.write(content)
+        with tarfile.open(os.path.join(self.bucket_dir, "ref.tar"), "w") as tar:
+            tar.add(os.path.join(self.tmp.name, "ref"), arcname="ref")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _fetch(self, key, **kwargs):
+        with local_s3(self.tmp.name) as server, \
+                patch.object(s3, "s3_client", return_value=boto3.session.Session().client("s3", config=s3.BOTO_CONFIG)):
+            result = s3.fetch_from_s3(f"s3://bucket/{key}", os.path.join(self.out_dir, key), **kwargs)
+            return result, server.num_requests
+
+    def test_untar_lz4(self):
+        subprocess.run(["lz4", "-q", os.path.join(self.bucket_dir, "ref.tar"), os.path.join(self.bucket_dir, "ref.tar.lz4")], check=True)
+        size = os.path.getsize(os.path.join(self.bucket_dir, "ref.tar.lz4"))
+        result, num_requests = self._fetch("ref.tar.lz4", auto_unzip=True, auto_untar=True)
+        self.assertEqual(result, os.path.join(self.out_dir, "ref"))
+        for path, content in self.files.items():
+            with open(os.path.join(self.out_dir, path), "rb") as f:
+                self.assertEqual(f.read(), content)
+        # Only the extracted files are written
+        self.assertCountEqual(os.listdir(self.out_dir), ["ref", "tmp_downloads"])
+        self.assertEqual(os.listdir(os.path.join(self.out_dir, "tmp_downloads")), [])
+        self.assertEqual(num_requests, 1 + -(-size // 1000))
+
+    def test_gzip(self):
+        with open(os.path.join(self.bucket_dir, "ref.tar"), "rb") as f:
+            content = f.read()
+        with gzip.open(os.path.join(self.bucket_dir, "ref.tar.gz"), "wb") as f:
+            f.write(content)
+        result, _num_requests = self._fetch("ref.tar.gz", auto_unzip=True)
+        self.assertEqual(result, os.path.join(self.out_dir, "ref.tar"))
+        with open(result, "rb") as f:
+            self.assertEqual(f.read(), content)
+
+    def test_empty(self):
+        open(os.path.join(self.bucket_dir, "empty.txt"), "w").close()
+        result, _num_requests = self._fetch("empty.txt")
+        self.assertEqual(os.path.getsize(result), 0)
+
+    def test_missing(self):
+        result, num_requests = self._fetch("missing.tar.lz4", auto_unzip=True, auto_untar=True, okay_if_missing=True)
+        self.assertIsNone(result)
+        self.assertEqual(num_requests, 1)
+
+    def test_corrupt(self):
+        with open(os.path.join(self.bucket_dir, "ref.tar.lz4"), "wb") as f:
+            f.write(b"not lz4")
+        with local_s3(self.tmp.name), \
+                patch.object(s3, "s3_client", return_value=boto3.session.Session().client("s3", config=s3.BOTO_CONFIG)):
+            with self.assertRaises(subprocess.CalledProcessError):
+                s3._native_download("s3://bucket/ref.tar.lz4", 'set -o pipefail; lz4 -dc > "${output}"',
+                                    {"output": os.path.join(self.out_dir, "ref.tar")})
+
+    def test_failed_part(self):
+        # The script can't tell that its input was cut short, so the download error is raised
+        def ranged_parts(*args):
+            yield b"first part"
+            raise IOError("connection reset")
+        output = os.path.join(self.out_dir, "output")
+        with local_s3(self.tmp.name), \
+                patch.object(s3, "s3_client", return_value=boto3.session.Session().client("s3", config=s3.BOTO_CONFIG)), \
+                patch.object(s3, "_ranged_parts", ranged_parts):
+            with self.assertRaisesRegex(IOError, "connection reset"):
+                s3._native_download("s3://bucket/ref.tar", 'cat > "${output}"', {"output": output})
+
+
+class TestReferenceCache(unittest.TestCase):
+    SIZES = {"index.tar": 30000, "small_0.db": 1000, "small_1.db": 1000, "small_2.db": 1000}
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp.name, "bucket", "refs"))
+        os.makedirs(os.path.join(self.tmp.name, "index"))
+        with open(os.path.join(self.tmp.name, "index", "index.dat"), "wb") as f:
+            f.write(os.urandom(self.SIZES["index.tar"]))
+        with tarfile.open(os.path.join(self.tmp.name, "bucket", "refs", "index.tar"), "w") as tar:
+            tar.add(os.path.join(self.tmp.name, "index"), arcname="index")
+        for name, size in self.SIZES.items():
+            if name.endswith(".db"):
+                with open(os.path.join(self.tmp.name, "bucket", "refs", name), "wb") as f:
+                    f.write(os.urandom(size))
+        self.ref_dir = os.path.join(self.tmp.name, "ref")
+        os.makedirs(self.ref_dir)
+        self.sentinel = os.path.join(self.ref_dir, "purge_sentinel", "purge_nothing_newer_than_me")
+        self.patches = [patch.dict(s3.config, {"REF_DIR": self.ref_dir, "PURGE_SENTINEL": self.sentinel}),
+                        patch.object(s3, "MAX_DISK_USED_FRACTION", 1.0)]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.tmp.cleanup()
+
+    def _fetch(self, names, **kwargs):
+        ''' Returns the local paths and the number of S3 requests to fetch names '''
+        with local_s3(self.tmp.name) as server, \
+                patch.object(s3, "s3_client", return_value=boto3.session.Session().client("s3", config=s3.BOTO_CONFIG)):
+            paths = [s3.fetch_reference(f"s3://bucket/refs/{name}", self.ref_dir, **kwargs) for name in names]
+            return paths, server.num_requests
+
+    def _manifest(self):
+        with open(os.path.join(self.ref_dir, s3.REFERENCE_MANIFEST)) as f:
+            return json.load(f)
+
+    def _cached(self):
+        return sorted(os.path.basename(path) for path in self._manifest())
+
+    def _make_space(self, quota):
+        os.makedirs(os.path.dirname(self.sentinel), exist_ok=True)
+        with open(self.sentinel, "w"):
+            pass
+        with patch.dict(s3.config, {"REF_DIR_QUOTA": quota}):
+            s3.really_make_space()
+
+    def test_manifest(self):
+        paths, num_requests = self._fetch(["index.tar", "small_0.db"])
+        self.assertEqual(paths, [os.path.join(self.ref_dir, "s3__bucket__refs", name) for name in ["index", "small_0.db"]])
+        self.assertGreater(num_requests, 0)
+        manifest = self._manifest()
+        entry = manifest["s3__bucket__refs/small_0.db"]
+        self.assertEqual(entry["src"], "s3://bucket/refs/small_0.db")
+        self.assertEqual(entry["size"], 1000)
+        self.assertTrue(entry["etag"])
+        self.assertEqual(manifest["s3__bucket__refs/index"]["size"], 30000)
+        # Cache hits don't go to S3, not even for the compressed versions fetch_reference prefers
+        last_access = entry["last_access"]
+        paths_again, num_requests = self._fetch(["index.tar", "small_0.db"])
+        self.assertEqual(paths_again, paths)
+        self.assertEqual(num_requests, 0)
+        self.assertGreater(self._manifest()["s3__bucket__refs/small_0.db"]["last_access"], last_access)
+
+    def test_size_aware_eviction(self):
+        self._fetch(["index.tar", "small_0.db", "small_1.db", "small_2.db"])
+        # Age alone would evict the index, the least recently used, to free 500 bytes
+        self._make_space(quota=sum(self.SIZES.values()) - 500)
+        self.assertEqual(self._cached(), ["index", "small_1.db", "small_2.db"])
+        self.assertFalse(os.path.exists(os.path.join(self.ref_dir, "s3__bucket__refs", "small_0.db")))
+        # When no single reference frees enough, the least recently used go first
+        self._make_space(quota=1000)
+        self.assertEqual(self._cached(), ["small_2.db"])
+
+    def test_used_since_sentinel(self):
+        self._fetch(["index.tar", "small_0.db", "small_1.db"])
+        os.makedirs(os.path.dirname(self.sentinel))
+        with open(self.sentinel, "w"):
+            pass
+        time.sleep(0.01)
+        # This stage's roll call
+        self._fetch(["small_0.db"], touch_only=True)
+        with patch.dict(s3.config, {"REF_DIR_QUOTA": 0}):
+            s3.really_make_space()
+        self.assertEqual(self._cached(), ["small_0.db"])
+
+    def test_pinned(self):
+        self._fetch(["index.tar", "small_0.db", "small_1.db"])
+        with s3.pinned_references():
+            self._fetch(["index.tar", "small_0.db"])
+            self.assertEqual(self._manifest()["s3__bucket__refs/index"]["pins"], {str(os.getpid()): 1})
+            self._make_space(quota=0)
+            self.assertEqual(self._cached(), ["index", "small_0.db"])
+        self.assertEqual(self._manifest()["s3__bucket__refs/index"]["pins"], {})
+        self._make_space(quota=0)
+        self.assertEqual(self._cached(), [])
+
+    def test_pinned_by_exited_process(self):
+        self._fetch(["small_0.db"])
+        pid = subprocess.run(["sh", "-c", "echo $$"], capture_output=True, check=True).stdout.decode().strip()
+        manifest_path = os.path.join(self.ref_dir, s3.REFERENCE_MANIFEST)
+        manifest = self._manifest()
+        manifest["s3__bucket__refs/small_0.db"]["pins"] = {pid: 1}
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+        self._make_space(quota=0)
+        self.assertEqual(self._cached(), [])
+
+    def test_downloaded_before_manifest(self):
+        old_dir = os.path.join(self.ref_dir, "s3__bucket__old")
+        os.makedirs(old_dir)
+        with open(os.path.join(old_dir, "old.db"), "wb") as f:
+            f.write(os.urandom(2000))
+        os.utime(os.path.join(old_dir, "old.db"), (0, 0))
+        self._fetch(["small_0.db"])
+        self._make_space(quota=1000)
+        self.assertEqual(self._cached(), ["small_0.db"])
+        self.assertFalse(os.path.exists(os.path.join(old_dir, "old.db")))
+
+
+class TestChooseEvictions(unittest.TestCase):
+    def test_choose_evictions(self):
+        gb, mb = 2**30, 2**20
+        entries = {"nt_index": {"size": 30 * gb, "last_access": 1},
+                   "lineages.db": {"size": 50 * mb, "last_access": 2},
+                   "adapters.fasta": {"size": 1 * mb, "last_access": 3},
+                   "host_index": {"size": 10 * gb, "last_access": 4}}
+        self.assertEqual(s3._choose_evictions(entries, 10 * mb), ["lineages.db"])
+        self.assertEqual(s3._choose_evictions(entries, 1 * gb), ["host_index"])
+        self.assertEqual(s3._choose_evictions(entries, 35 * gb), ["nt_index", "host_index"])
+        self.assertEqual(s3._choose_evictions(entries, 0), [])
+        self.assertEqual(s3._choose_evictions(entries, float("inf")), ["nt_index", "lineages.db", "adapters.fasta", "host_index"])
@@ -0,0 +1,88 @@
+import random
+import unittest
+from unittest.mock import patch
+
+from idseq_dag.util.top_hits import BlastCandidate, LineageCache, _get_lineage, _intersects
+
+
+class TestLineageCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = LineageCache(max_size=2)
+        cache.put("A", ("1", "2", "3"))
+        cache.put("B", ("4", "5", "6"))
+        # Touch A so B is the least recently used entry
+        self.assertEqual(cache.get("A"), ("1", "2", "3"))
+        cache.put("C", ("7", "8", "9"))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("B"))
+        self.assertEqual(cache.get("C"), ("7", "8", "9"))
+        self.assertEqual(cache.stats(), {
+            "max_size": 2,
+            "size": 2,
+            "hits": 2,
+            "misses": 1,
+            "evictions": 1,
+            "hit_rate": 2 / 3,
+        })
+
+    def test_get_lineage_uses_cache(self):
+        accession2taxid_dict = {"MK468611": "37124"}
+        lineage_map = {"37124": ("37124", "11019", "11018")}
+        cache = LineageCache(max_size=10)
+        for _ in range(3):
+            self.assertEqual(
+                _get_lineage("MK468611.1", lineage_map, accession2taxid_dict, cache),
+                ("37124", "11019", "11018"),
+            )
+        self.assertEqual(_get_lineage("XX000001.1", lineage_map, accession2taxid_dict, cache), ("-100", "-200", "-300"))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    @patch('idseq_dag.util.log.log_event')
+    def test_log_stats(self, mock_log_event):
+        cache = LineageCache(max_size=10)
+        cache.get("A")
+        cache.log_stats("get_top_m8_nt")
+        mock_log_event.assert_called_once_with("lineage_cache_stats", values={
+            "context_name": "get_top_m8_nt",
+            "max_size": 10,
+            "size": 0,
+            "hits": 0,
+            "misses": 1,
+            "evictions": 0,
+            "hit_rate": 0.0,
+        })
+
+
+def _random_hsps(rng, num_hsps, qlen):
+    hsps = []
+    for i in range(num_hsps):
+        # Mostly short fragments, some long ones, a few of zero length, either strand
+        length = rng.choice([0, rng.randint(1, 20), rng.randint(20, qlen // 2), rng.randint(qlen // 2, qlen - 1)])
+        qstart = rng.randint(1, qlen - length)
+        qend = qstart + length
+        if rng.random() < 0.5:
+            qstart, qend = qend, qstart
+        hsps.append({
+            "qseqid": "NODE_1", "sseqid": "MK468611.1", "qstart": qstart, "qend": qend,
+            "sstart": 1, "send": 1 + length, "bitscore": float(num_hsps - i), "hsp_index": i,
+        })
+    return hsps
+
+
+class TestBlastCandidate(unittest.TestCase):
+    def test_optimize_matches_greedy_scan(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            hsps = _random_hsps(rng, rng.randint(1, 150), qlen=rng.choice([50, 500, 5000]))
+            # The original quadratic implementation of BlastCandidate.optimize
+            expected = [hsps[0]]
+            for hsp in hsps[1:]:
+                if not _intersects(hsp, expected):
+                    expected.append(hsp)
+            candidate = BlastCandidate(hsps)
+            candidate.optimize()
+            self.assertEqual(
+                [hsp["hsp_index"] for hsp in candidate.optimal_cover],
+                [hsp["hsp_index"] for hsp in expected],
+            )
+            self.assertEqual(candidate.total_score, sum(hsp["bitscore"] for hsp in expected))
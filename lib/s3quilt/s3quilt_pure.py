@@ -5,6 +5,7 @@ This module provides parallel S3 object chunk downloading capabilities
 without requiring Go dependencies.
 """
 
+import itertools
 import os
 import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -14,11 +15,19 @@ from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError
 from botocore import UNSIGNED
 
+# A ranged GET costs tens of milliseconds before its first byte, in which S3 could have
+# sent hundreds of kilobytes, so chunks this close are cheaper to fetch with one request
+# along with the bytes between them.
+DEFAULT_MAX_GAP = 64 * 1024
+# Merged requests stay small enough to keep the downloads of a long run of chunks parallel
+DEFAULT_MAX_REQUEST_SIZE = 8 * 1024 * 1024
+
 
 class S3ChunkDownloader:
     """Handles parallel downloading of S3 object chunks."""
     
-    def __init__(self, bucket: str, key: str, concurrency: int = 50):
+    def __init__(self, bucket: str, key: str, concurrency: int = 50,
+                 max_gap: int = DEFAULT_MAX_GAP, max_request_size: int = DEFAULT_MAX_REQUEST_SIZE):
         """
         Initialize the S3 chunk downloader.
         
@@ -26,19 +35,29 @@ class S3ChunkDownloader:
             bucket: S3 bucket name
             key: S3 object key
             concurrency: Number of concurrent downloads (default: 50)
+            max_gap: Merge chunks separated by at most this many bytes into one request
+            max_request_size: Don't merge chunks into requests larger than this
         """
         self.bucket = bucket
         self.key = key
         self.concurrency = concurrency
+        self.max_gap = max_gap
+        self.max_request_size = max_request_size
         self.region = None
         self.anonymous = False
         self._client = None
+        self._client_lock = threading.Lock()
         
     def _get_s3_client(self) -> boto3.client:
         """Get or create S3 client with proper configuration."""
-        if self._client is not None:
+        # The download threads all ask for the client at once, and should share the first one
+        with self._client_lock:
+            if self._client is None:
+                self._client = self._create_s3_client()
             return self._client
-            
+
+    def _create_s3_client(self) -> boto3.client:
+        """Create an S3 client for the bucket's region, anonymous if there are no credentials."""
         # Try to detect region and credentials
         try:
             # First, try with default credentials to detect region
@@ -67,154 +86,139 @@ class S3ChunkDownloader:
         
         # Create the final client with proper configuration
         if self.anonymous:
-            self._client = boto3.client('s3',
-                                      region_name=self.region,
-                                      config=Config(signature_version=UNSIGNED))
-        else:
-            self._client = boto3.client('s3', region_name=self.region)
-            
-        return self._client
+            return boto3.client('s3',
+                                region_name=self.region,
+                                config=Config(signature_version=UNSIGNED))
+        return boto3.client('s3', region_name=self.region)
     
-    def _download_chunk(self, start: int, length: int, idx: int) -> Tuple[int, Union[str, bytes]]:
+    def _get_range(self, start: int, end: int) -> bytes:
         """
-        Download a single chunk from S3.
-        
+        Download bytes [start, end) of the S3 object in a single ranged GET.
+
         Args:
             start: Starting byte position in S3 object
-            length: Number of bytes to download
-            idx: Index of this chunk for ordering
-            
+            end: Byte position in S3 object to stop before
+
         Returns:
-            Tuple of (index, chunk_data)
+            The bytes of the range, as they come off the wire
         """
         client = self._get_s3_client()
-        range_header = f'bytes={start}-{start + length - 1}'
-        
         response = client.get_object(
             Bucket=self.bucket,
             Key=self.key,
-            Range=range_header
+            Range=f'bytes={start}-{end - 1}'
         )
-        
-        chunk_data = response['Body'].read()
-        return idx, chunk_data.decode('utf-8', errors='replace')
-    
-    def _write_chunk_to_file(self, start: int, length: int, local_offset: int, 
-                           output_file_handle) -> None:
+        return response['Body'].read()
+
+    def _coalesced_requests(self, starts: List[int],
+                            lengths: List[int]) -> List[Tuple[int, int, List[int]]]:
         """
-        Download a chunk and write it directly to a file at the specified offset.
-        
-        Args:
-            start: Starting byte position in S3 object
-            length: Number of bytes to download
-            local_offset: Offset in the local file to write to
-            output_file_handle: File handle to write to
+        Plan the ranged GETs for a list of chunks, merging chunks that overlap or are
+        separated by at most max_gap bytes into one request, as long as the request stays
+        under max_request_size. Empty chunks need no request.
+
+        Returns:
+            List of (start, end, chunk indexes) per request
         """
-        client = self._get_s3_client()
-        range_header = f'bytes={start}-{start + length - 1}'
-        
-        response = client.get_object(
-            Bucket=self.bucket,
-            Key=self.key,
-            Range=range_header
-        )
-        
-        chunk_data = response['Body'].read()
-        
-        # Thread-safe file writing at specific offset
-        with threading.Lock():
-            output_file_handle.seek(local_offset)
-            output_file_handle.write(chunk_data)
-    
-    def download_chunks(self, starts: List[int], lengths: List[int]) -> List[str]:
+        requests = []
+        for i in sorted((i for i in range(len(starts)) if lengths[i] > 0), key=starts.__getitem__):
+            chunk_start, chunk_end = starts[i], starts[i] + lengths[i]
+            if requests:
+                start, end, chunks = requests[-1]
+                if chunk_start - end <= self.max_gap and max(end, chunk_end) - start <= self.max_request_size:
+                    requests[-1] = (start, max(end, chunk_end), chunks + [i])
+                    continue
+            requests.append((chunk_start, chunk_end, [i]))
+        return requests
+
+    def _download_coalesced(self, starts: List[int], lengths: List[int], on_chunk) -> None:
+        """
+        Download the chunks with coalesced requests in parallel, calling
+        on_chunk(idx, data) for every chunk, where data is a memoryview into the
+        response of the request it was part of.
+        """
+        def download_request(start, end, chunks):
+            data = memoryview(self._get_range(start, end))
+            for i in chunks:
+                on_chunk(i, data[starts[i] - start:starts[i] - start + lengths[i]])
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(download_request, *request)
+                       for request in self._coalesced_requests(starts, lengths)]
+            for future in as_completed(futures):
+                future.result()
+
+    def download_chunks(self, starts: List[int], lengths: List[int]) -> List[bytes]:
         """
         Download multiple chunks from S3 object in parallel.
-        
+
         Args:
             starts: List of starting byte positions
             lengths: List of chunk lengths (must match starts length)
-            
+
         Returns:
-            List of chunk data as strings, ordered by input order
-            
+            List of chunk data as bytes, ordered by input order
+
         Raises:
             ValueError: If starts and lengths lists have different lengths
             Exception: If any download fails
         """
         if len(starts) != len(lengths):
             raise ValueError("starts and lengths must have the same length")
-        
-        results = [None] * len(starts)
-        
-        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
-            # Submit all download tasks
-            future_to_idx = {
-                executor.submit(self._download_chunk, starts[i], lengths[i], i): i
-                for i in range(len(starts))
-            }
-            
-            # Collect results as they complete
-            for future in as_completed(future_to_idx):
-                try:
-                    idx, chunk_data = future.result()
-                    results[idx] = chunk_data
-                except Exception as e:
-                    raise Exception(f"Failed to download chunk: {e}") from e
-        
+
+        results = [b''] * len(starts)
+
+        def store(idx, data):
+            results[idx] = bytes(data)
+
+        try:
+            self._download_coalesced(starts, lengths, store)
+        except Exception as e:
+            raise Exception(f"Failed to download chunk: {e}") from e
         return results
-    
-    def download_chunks_to_file(self, output_file_path: str, starts: List[int], 
-                              lengths: List[int]) -> None:
+
+    def download_chunks_to_file(self, output_file_path: str, starts: List[int],
+                                lengths: List[int]) -> None:
         """
-        Download multiple chunks from S3 object and write them to a file.
-        
+        Download multiple chunks from S3 object and write them to a file, one after
+        another in input order. Each chunk is written with os.pwrite at its own offset,
+        so the writing threads don't need to share a file position or a lock.
+
         Args:
             output_file_path: Path to output file
             starts: List of starting byte positions
             lengths: List of chunk lengths (must match starts length)
-            
+
         Raises:
             ValueError: If starts and lengths lists have different lengths
             Exception: If any download fails
         """
         if len(starts) != len(lengths):
             raise ValueError("starts and lengths must have the same length")
-        
-        # Calculate total file size and create file
-        total_size = sum(lengths)
-        
+
+        local_offsets = list(itertools.accumulate(lengths, initial=0))
+
         with open(output_file_path, 'wb') as output_file:
+            fd = output_file.fileno()
             # Pre-allocate file space
-            output_file.seek(total_size - 1)
-            output_file.write(b'\0')
-            output_file.seek(0)
-            
-            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
-                # Calculate local offsets
-                local_offset = 0
-                futures = []
-                
-                for i in range(len(starts)):
-                    future = executor.submit(
-                        self._write_chunk_to_file, 
-                        starts[i], 
-                        lengths[i], 
-                        local_offset,
-                        output_file
-                    )
-                    futures.append(future)
-                    local_offset += lengths[i]
-                
-                # Wait for all downloads to complete
-                for future in as_completed(futures):
-                    try:
-                        future.result()
-                    except Exception as e:
-                        raise Exception(f"Failed to download chunk to file: {e}") from e
+            os.ftruncate(fd, local_offsets[-1])
+
+            def write(idx, data):
+                offset = local_offsets[idx]
+                while data:
+                    written = os.pwrite(fd, data, offset)
+                    data = data[written:]
+                    offset += written
+
+            try:
+                self._download_coalesced(starts, lengths, write)
+            except Exception as e:
+                raise Exception(f"Failed to download chunk to file: {e}") from e
 
 
 def download_chunks(bucket: str, key: str, starts: List[int], 
-                   lengths: List[int], concurrency: int = 50) -> List[str]:
+                   lengths: List[int], concurrency: int = 50,
+                   max_gap: int = DEFAULT_MAX_GAP) -> List[str]:
     """
     Download multiple chunks from an S3 object in parallel.
     
@@ -224,17 +228,18 @@ def download_chunks(bucket: str, key: str, starts: List[int],
         starts: List of starting byte positions
         lengths: List of chunk lengths
         concurrency: Number of concurrent downloads (default: 50)
+        max_gap: Merge chunks separated by at most this many bytes into one request
         
     Returns:
         List of chunk data as strings
     """
-    downloader = S3ChunkDownloader(bucket, key, concurrency)
-    return downloader.download_chunks(starts, lengths)
+    downloader = S3ChunkDownloader(bucket, key, concurrency, max_gap)
+    return [data.decode('utf-8', errors='replace') for data in downloader.download_chunks(starts, lengths)]
 
 
 def download_chunks_to_file(bucket: str, key: str, output_file_path: str,
                           starts: List[int], lengths: List[int], 
-                          concurrency: int = 50) -> None:
+                          concurrency: int = 50, max_gap: int = DEFAULT_MAX_GAP) -> None:
     """
     Download multiple chunks from an S3 object and save to a file.
     
@@ -245,6 +250,7 @@ def download_chunks_to_file(bucket: str, key: str, output_file_path: str,
         starts: List of starting byte positions
         lengths: List of chunk lengths
         concurrency: Number of concurrent downloads (default: 50)
+        max_gap: Merge chunks separated by at most this many bytes into one request
     """
-    downloader = S3ChunkDownloader(bucket, key, concurrency)
+    downloader = S3ChunkDownloader(bucket, key, concurrency, max_gap)
     downloader.download_chunks_to_file(output_file_path, starts, lengths)
\ No newline at end of file